@@ -1,11 +1,112 @@
+import asyncio
+import logging
+import os
 import socket
 import struct
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from abc import ABC, abstractmethod
 
 
 USBIP_DIR_OUT = 0
 USBIP_DIR_IN = 1
 
+USB_SPEED_FULL = 2
+USB_SPEED_HIGH = 3
+
+# Per-subsystem loggers. URB and device traffic is logged at DEBUG, and the hot path checks
+# isEnabledFor first, so at INFO and above it does no formatting at all.
+server_log = logging.getLogger('usbip.server')
+urb_log = logging.getLogger('usbip.urb')
+device_log = logging.getLogger('usbip.device')
+
+ENODEV = 19
+EPIPE = 32  # Endpoint stalled
+ECONNRESET = 104
+
+# Upper bounds of the histogram buckets of messages sent per sendmsg
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+IOV_MAX = 1024  # Buffers a single sendmsg accepts on Linux
+
+MSG_MORE = getattr(socket, 'MSG_MORE', 0)  # Linux: hold the header back until the sendfile payload follows it
+
+# Upper bounds, in seconds, of the URB latency histogram buckets
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+USBIP_CMD_SUBMIT = 0x1
+USBIP_CMD_UNLINK = 0x2
+USBIP_RET_SUBMIT = 0x3
+USBIP_RET_UNLINK = 0x4
+
+URB_ISO_ASAP = 0x2  # transfer_flags: start an isochronous URB at the next free frame
+
+# USBIPSession states
+SESSION_HANDSHAKE = 'handshake'  # OP_REQ_DEVLIST and OP_REQ_IMPORT
+SESSION_IMPORTED = 'imported'  # USBIP_CMD_SUBMIT and USBIP_CMD_UNLINK for the imported device
+SESSION_CLOSED = 'closed'
+
+
+class StructCodec:
+    '''
+    Compiled layout of a BaseStructure subclass. Nested structures are flattened into the
+    parent format so a whole message is encoded or decoded by a single struct.Struct call.
+    '''
+
+    def __init__(self, structure_class):
+        byte_order = structure_class._byte_order_
+        body = ''
+        layout = []  # (field name, nested structure class or None, number of flat values)
+        for field in structure_class._fields_:
+            if isinstance(field[1], BaseStructure):
+                nested = field[1]._codec()
+                if nested.byte_order != byte_order:
+                    raise TypeError(f'{structure_class.__name__}.{field[0]}: nested byte order does not match')
+                body += nested.body
+                layout.append((field[0], type(field[1]), nested.count))
+            else:
+                body += field[1]
+                layout.append((field[0], None, 1))
+        self.byte_order = byte_order
+        self.body = body
+        self.layout = layout
+        self.struct = struct.Struct(byte_order + body)
+        self.count = sum(count for _, _, count in layout)
+        self.flat = all(nested is None for _, nested, _ in layout)
+        self.names = [name for name, _, _ in layout]
+
+    def values(self, structure):
+        if self.flat:
+            return [getattr(structure, name, 0) for name in self.names]
+        values = []
+        for name, nested, _ in self.layout:
+            if nested is None:
+                values.append(getattr(structure, name, 0))
+            else:
+                values.extend(getattr(structure, name).values())
+        return values
+
+    def assign(self, structure, values):
+        if self.flat:
+            structure.init_from_dict(**dict(zip(self.names, values)))
+            return
+        position = 0
+        for name, nested, count in self.layout:
+            if nested is None:
+                setattr(structure, name, values[position])
+            else:
+                child = getattr(structure, name, None)
+                if not isinstance(child, nested):
+                    child = nested()
+                    setattr(structure, name, child)
+                child._codec().assign(child, values[position:position + count])
+            position += count
+
 
 class BaseStructure(ABC):
     def __init__(self, **kwargs):
@@ -15,38 +116,43 @@ class BaseStructure(ABC):
                 if not hasattr(self, field[0]):
                     setattr(self, field[0], field[2])
 
+    @classmethod
+    def _codec(cls):
+        # Compiled once per subclass, on first use
+        codec = cls.__dict__.get('_codec_')
+        if codec is None:
+            codec = StructCodec(cls)
+            cls._codec_ = codec
+        return codec
+
     def init_from_dict(self, **kwargs):
         for key, value in kwargs.items():
             setattr(self, key, value)
 
     def size(self):
-        return struct.calcsize(self.format())
+        return self._codec().struct.size
 
     def format(self):
-        pack_format = self._byte_order_
-        for field in self._fields_:
-            if isinstance(field[1], BaseStructure):
-                pack_format += str(field[1].size()) + 's'
-            else:
-                pack_format += field[1]
-        return pack_format
+        return self._codec().struct.format
+
+    def values(self):
+        return self._codec().values(self)
 
     def pack(self):
-        values = []
-        for field in self._fields_:
-            if isinstance(field[1], BaseStructure):
-                values.append(getattr(self, field[0], 0).pack())
-            else:
-                values.append(getattr(self, field[0], 0))
-        return struct.pack(self.format(), *values)
+        codec = self._codec()
+        return codec.struct.pack(*codec.values(self))
+
+    def pack_into(self, buffer, offset=0):
+        codec = self._codec()
+        codec.struct.pack_into(buffer, offset, *codec.values(self))
 
     def unpack(self, buf):
-        values = struct.unpack(self.format(), buf)
-        keys_vals = {}
-        for i, val in enumerate(values):
-            keys_vals[self._fields_[i][0]] = val
+        codec = self._codec()
+        codec.assign(self, codec.struct.unpack(buf))
 
-        self.init_from_dict(**keys_vals)
+    def unpack_from(self, buffer, offset=0):
+        codec = self._codec()
+        codec.assign(self, codec.struct.unpack_from(buffer, offset))
 
     @property
     @abstractmethod
@@ -80,7 +186,16 @@ class OP_REP_DevList(BaseStructure):
     _byte_order_ = '>'
     _fields_ = [
         ('base', USBIPHeader()),
-        ('nExportedDevice', 'I'),
+        ('nExportedDevice', 'I')
+    ]
+
+
+class OP_REP_DevListDevice(BaseStructure):
+    '''
+    One exported device in OP_REP_DevList, followed by bNumInterfaces USBInterface entries
+    '''
+    _byte_order_ = '>'
+    _fields_ = [
         ('usbPath', '256s'),
         ('busID', '32s'),
         ('busnum', 'I'),
@@ -94,8 +209,7 @@ class OP_REP_DevList(BaseStructure):
         ('bDeviceProtocol', 'B'),
         ('bConfigurationValue', 'B'),
         ('bNumConfigurations', 'B'),
-        ('bNumInterfaces', 'B'),
-        ('interfaces', USBInterface())
+        ('bNumInterfaces', 'B')
     ]
 
 
@@ -128,7 +242,7 @@ class USBIP_RET_Submit(BaseStructure):
         ('devid', 'I', 0),
         ('direction', 'I', 0),
         ('ep', 'I', 0),
-        ('status', 'I'),
+        ('status', 'i'),  # 0 or a negative errno
         ('actual_length', 'I'),
         ('start_frame', 'I', 0),
         ('number_of_packets', 'I', 0xffffffff),
@@ -136,6 +250,9 @@ class USBIP_RET_Submit(BaseStructure):
         ('padding', 'Q', 0)
     ]
 
+    def pack_header(self):
+        return BaseStructure.pack(self)
+
     def pack(self):
         packed_data = BaseStructure.pack(self)
         packed_data += self.data
@@ -159,6 +276,32 @@ class USBIP_CMD_Submit(BaseStructure):
     ]
 
 
+class USBIP_CMD_Unlink(BaseStructure):
+    _byte_order_ = '>'
+    _fields_ = [
+        ('command', 'I'),
+        ('seqnum', 'I'),
+        ('devid', 'I'),
+        ('direction', 'I'),
+        ('ep', 'I'),
+        ('unlink_seqnum', 'I'),  # seqnum of the USBIP_CMD_Submit to unlink
+        ('padding', '24s')
+    ]
+
+
+class USBIP_RET_Unlink(BaseStructure):
+    _byte_order_ = '>'
+    _fields_ = [
+        ('command', 'I', USBIP_RET_UNLINK),
+        ('seqnum', 'I'),
+        ('devid', 'I', 0),
+        ('direction', 'I', 0),
+        ('ep', 'I', 0),
+        ('status', 'i'),  # -ECONNRESET if the URB was unlinked, 0 if it had already completed
+        ('padding', '24s', b'')
+    ]
+
+
 class StandardDeviceRequest(BaseStructure):
     _byte_order_ = '<'  # USB uses little-endian
     _fields_ = [
@@ -256,15 +399,376 @@ class EndpointDescriptor(BaseStructure):
     ]
 
 
+class RawDescriptor:
+    '''
+    Descriptors that are not decoded, packed back as they were read
+    '''
+
+    def __init__(self, data):
+        self.data = bytes(data)
+
+    def pack(self):
+        return self.data
+
+
+def parse_configuration(blob):
+    '''
+    Rebuilds DeviceConfiguration, interface and endpoint objects from a configuration descriptor blob
+    '''
+    configuration = DeviceConfiguration()
+    configuration.unpack_from(blob)
+    configuration.interfaces = []
+    interfaces = {}
+    last = None
+    offset = configuration.bLength
+    while offset + 2 <= len(blob) and blob[offset] >= 2:
+        length, descriptor_type = blob[offset], blob[offset + 1]
+        data = blob[offset:offset + length]
+        if descriptor_type == 0x04:
+            last = InterfaceDescriptor()
+            last.unpack_from(data)
+            last.endpoints = []
+            if last.bInterfaceNumber not in interfaces:
+                interfaces[last.bInterfaceNumber] = []
+                configuration.interfaces.append(interfaces[last.bInterfaceNumber])
+            interfaces[last.bInterfaceNumber].append(last)
+            interface = last
+        elif descriptor_type == 0x05 and last is not None:
+            last = EndpointDescriptor()
+            last.unpack_from(data)
+            interface.endpoints.append(last)
+        elif last is not None:
+            if hasattr(last, 'class_descriptor'):  # Several class descriptors follow the same interface or endpoint
+                last.class_descriptor.data += bytes(data)
+            else:
+                last.class_descriptor = RawDescriptor(data)
+        offset += length
+    return configuration
+
+
+def endpoint_types(configurations):
+    '''
+    {(ep, direction): usbmon transfer type} of every endpoint in `configurations`
+    '''
+    types = {}
+    usbmon_types = {0x0: 2, 0x1: 0, 0x2: 3, 0x3: 1}  # bmAttributes transfer type -> usbmon type
+    for configuration in configurations:
+        for interface in configuration.interfaces:
+            for interface_alternative in interface:
+                for endpoint in interface_alternative.endpoints:
+                    key = (endpoint.bEndpointAddress & 0x0F, endpoint.bEndpointAddress >> 7)
+                    types[key] = usbmon_types[endpoint.bmAttributes & 0x3]
+    return types
+
+
+class USBIPReader:
+    '''
+    Exact-length framing on top of a stream socket. Data is received with recv_into into a
+    reusable bytearray and handed out as memoryview slices, which stay valid until the next read.
+    '''
+
+    def __init__(self, connection, capacity=64 * 1024):
+        self.connection = connection
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first unread byte
+        self.end = 0  # end of received data
+
+    def available(self):
+        return self.end - self.start
+
+    def reserve(self, size):
+        # Make room for `size` unread bytes at the front of the buffer
+        pending = self.end - self.start
+        if size > len(self.buffer):
+            # Views handed out earlier keep the old buffer alive, so allocate a new one
+            buffer = bytearray(max(size, 2 * len(self.buffer)))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        elif self.start:
+            self.view[:pending] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+    def feed(self, data):
+        '''
+        Appends bytes that were received by another reader of the connection
+        '''
+        self.reserve(self.end - self.start + len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def consume(self, size):
+        data = self.view[self.start:self.start + size]
+        self.start += size
+        return data
+
+    def read_exactly(self, size):
+        '''
+        Returns a memoryview of exactly `size` bytes, or None if the peer closed the connection
+        '''
+        if self.end - self.start < size:
+            if self.start + size > len(self.buffer):
+                self.reserve(size)
+            while self.end - self.start < size:
+                received = self.connection.recv_into(self.view[self.end:])
+                if not received:
+                    return None
+                self.end += received
+        return self.consume(size)
+
+
+class AsyncUSBIPReader(USBIPReader):
+    '''
+    USBIPReader for non-blocking sockets driven by an asyncio event loop
+    '''
+
+    def __init__(self, connection, loop, capacity=64 * 1024):
+        super().__init__(connection, capacity)
+        self.loop = loop
+
+    async def read_exactly(self, size):
+        if self.end - self.start < size:
+            if self.start + size > len(self.buffer):
+                self.reserve(size)
+            while self.end - self.start < size:
+                received = await self.loop.sock_recv_into(self.connection, self.view[self.end:])
+                if not received:
+                    return None
+                self.end += received
+        return self.consume(size)
+
+
 class USBRequest():
     def __init__(self, **kwargs):
         for key, value in kwargs.items():
             setattr(self, key, value)
 
 
+class IsoPacketDescriptors:
+    '''
+    The usbip_iso_packet_descriptor array of an isochronous URB, kept flat in one array('I') as
+    offset, length, actual_length, status for each packet, and converted from and to its big-endian
+    wire format in a single pass
+    '''
+    descriptor_size = 16
+
+    def __init__(self, values):
+        self.values = values
+
+    @classmethod
+    def from_bytes(cls, data):
+        values = array('I')
+        values.frombytes(data)
+        if sys.byteorder == 'little':
+            values.byteswap()
+        return cls(values)
+
+    @classmethod
+    def from_lengths(cls, lengths):
+        # Packets laid out back to back, as a host driver builds them
+        values = array('I', bytes(16 * len(lengths)))
+        offset = 0
+        for i, length in enumerate(lengths):
+            values[4 * i] = offset
+            values[4 * i + 1] = length
+            offset += length
+        return cls(values)
+
+    def to_bytes(self):
+        values = array('I', self.values)
+        if sys.byteorder == 'little':
+            values.byteswap()
+        return values.tobytes()
+
+    @property
+    def count(self):
+        return len(self.values) // 4
+
+    def offsets(self):
+        return self.values[0::4]
+
+    def lengths(self):
+        return self.values[1::4]
+
+    def actual_lengths(self):
+        return self.values[2::4]
+
+    def error_count(self):
+        return sum(1 for status in self.values[3::4] if status)
+
+    def fill(self, available, lengths=None):
+        '''
+        Sets the actual lengths of IN packets filled in order from `available` contiguous bytes,
+        each up to its requested length, or `lengths[i]` bytes when given. Returns the bytes used.
+        '''
+        values = self.values
+        remaining = available
+        for i in range(self.count):
+            length = values[4 * i + 1] if lengths is None else min(lengths[i], values[4 * i + 1])
+            length = min(length, remaining)
+            values[4 * i + 2] = length
+            values[4 * i + 3] = 0
+            remaining -= length
+        return available - remaining
+
+    def complete_all(self):
+        # Every OUT packet fully transferred
+        self.values[2::4] = self.values[1::4]
+        self.values[3::4] = array('I', bytes(4 * self.count))
+        return sum(self.values[1::4])
+
+    def packets(self, buffer):
+        '''
+        The packets of an OUT transfer buffer, as memoryviews
+        '''
+        view = memoryview(buffer)
+        values = self.values
+        return [view[values[i]:values[i] + values[i + 1]] for i in range(0, len(values), 4)]
+
+
+class Histogram:
+    '''
+    Fixed-bucket histogram, counts[i] holds the observations <= bounds[i] and above bounds[i - 1]
+    '''
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # The last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        self.counts = [count + other_count for count, other_count in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+    def copy(self):
+        histogram = Histogram(self.bounds)
+        histogram.counts = list(self.counts)
+        histogram.sum = self.sum
+        histogram.count = self.count
+        return histogram
+
+
+class DeviceMetrics:
+    '''
+    Counters and latency histograms of one device. Recording is a few dict updates under an
+    uncontended lock, cheap enough to stay on. See metrics.py for the Prometheus exposition.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.urbs = {}  # (ep, direction) -> URBs submitted
+        self.bytes = {}  # (ep, direction) -> payload bytes moved
+        self.control_requests = {}  # (bmRequestType, bRequest) -> count
+        self.unhandled = {}  # (bmRequestType, bRequest) -> count
+        self.latency = {}  # (ep, direction) -> Histogram of header receipt to send_usb_ret, in seconds
+
+    def record_submit(self, usb_req):
+        key = (usb_req.ep, usb_req.direction)
+        with self.lock:
+            self.urbs[key] = self.urbs.get(key, 0) + 1
+            if usb_req.transfer_buffer:
+                self.bytes[key] = self.bytes.get(key, 0) + len(usb_req.transfer_buffer)
+            if usb_req.ep == 0:
+                request = (usb_req.setup[0], usb_req.setup[1])
+                self.control_requests[request] = self.control_requests.get(request, 0) + 1
+
+    def record_complete(self, usb_req, length):
+        key = (usb_req.ep, usb_req.direction)
+        with self.lock:
+            if usb_req.direction == USBIP_DIR_IN and length:
+                self.bytes[key] = self.bytes.get(key, 0) + length
+            received = getattr(usb_req, 'received', None)
+            if received is not None:
+                histogram = self.latency.get(key)
+                if histogram is None:
+                    histogram = self.latency[key] = Histogram()
+                histogram.observe(time.perf_counter() - received)
+
+    def record_unhandled(self, usb_req):
+        request = (usb_req.setup[0], usb_req.setup[1])
+        with self.lock:
+            self.unhandled[request] = self.unhandled.get(request, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict(urbs=dict(self.urbs), bytes=dict(self.bytes), control_requests=dict(self.control_requests),
+                        unhandled=dict(self.unhandled),
+                        latency={key: histogram.copy() for key, histogram in self.latency.items()})
+
+
+class ContainerMetrics:
+    '''
+    Connection and management counters of a USBContainer
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict(connections=0, device_lists=0, imports=0, failed_imports=0, rejected_urbs=0,
+                             unlinks=0, send_batches=0, sent_messages=0)
+        self.active_sessions = 0
+        self.batch_sizes = Histogram(BATCH_BUCKETS)  # messages per sendmsg
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def record_batch(self, messages):
+        with self.lock:
+            self.counters['send_batches'] += 1
+            self.counters['sent_messages'] += messages
+            self.batch_sizes.observe(messages)
+
+    def session_started(self, handed_off=False):
+        with self.lock:
+            if not handed_off:  # Already counted by the worker that accepted it
+                self.counters['connections'] += 1
+            self.active_sessions += 1
+
+    def session_ended(self):
+        with self.lock:
+            self.active_sessions -= 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counters, active_sessions=self.active_sessions, batch_sizes=self.batch_sizes.copy())
+
+
+def control_request(bmRequestType, bRequest, descriptor_type=None):
+    '''
+    Registers a USBDevice method as the handler of a control request, called as
+    handler(control_req, usb_req). With a descriptor type the handler only gets requests whose wValue
+    high byte matches it. Can be stacked to register one method for several requests.
+    '''
+    def register(handler):
+        handler.control_requests = getattr(handler, 'control_requests', ()) + ((bmRequestType, bRequest, descriptor_type),)
+        return handler
+    return register
+
+
+def collect_control_table(cls):
+    # Registrations of base classes first, so subclasses can replace them
+    table = {}
+    for klass in reversed(cls.__mro__):
+        for name, attribute in vars(klass).items():
+            for key in getattr(attribute, 'control_requests', ()):
+                table[key] = name
+    return table
+
+
 class USBDevice(ABC):
     '''
-    Abstract Base Class
+    Abstract Base Class. Control requests are dispatched through control_table, which subclasses
+    extend by decorating methods with @control_request. Requests missing from the table go to
+    handle_device_specific_control and are stalled by default.
     '''
 
     @property
@@ -275,10 +779,33 @@ class USBDevice(ABC):
     @abstractmethod
     def device_descriptor(self): pass
 
+    speed = USB_SPEED_FULL
+    control_table = {}  # (bmRequestType, bRequest, descriptor type or None) -> method name
+    compiled = None  # device_spec.CompiledDevice the descriptors come from, if any
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.control_table = collect_control_table(cls)
+        if cls.__dict__.get('compiled') is not None:
+            cls.device_descriptor = cls.compiled.device_descriptor
+            cls.configurations = cls.compiled.configurations
+
     def __init__(self):
+        self.pending_urbs = {}  # (ep, direction) -> {seqnum: usb_req} in submission order
+        self.urb_lock = threading.Lock()
+        self.descriptor_table = None  # built on first GET_DESCRIPTOR, see get_descriptor_table
+        self.capture = None  # optional capture.CaptureRing recording every URB
+        self.recorder = None  # optional replay.TraceRecorder
+        self.metrics = DeviceMetrics()
+        self.iso_frames = {}  # (ep, direction) -> first frame after the last scheduled isochronous URB
+        self.bind_control_handlers()
         self.generate_raw_configuration()
 
     def generate_raw_configuration(self):
+        if self.compiled is not None:
+            self.all_configurations = self.compiled.raw_configuration  # Packed and validated once per spec
+            self.endpoint_types = self.compiled.endpoint_types
+            return
         all_configurations = bytearray()
         for configuration in self.configurations:
             all_configurations.extend(configuration.pack())
@@ -292,77 +819,247 @@ class USBDevice(ABC):
                         if hasattr(endpoint, 'class_descriptor'):
                             all_configurations.extend(endpoint.class_descriptor.pack())
         self.all_configurations = all_configurations
+        self.endpoint_types = endpoint_types(self.configurations)
+
+    def transfer_type(self, ep, direction):
+        # usbmon transfer type: 0 isochronous, 1 interrupt, 2 control, 3 bulk
+        return self.endpoint_types.get((ep, direction), 2)
+
+    def descriptor_entries(self):
+        '''
+        Extra GET_DESCRIPTOR responses, as {(descriptor type, index, language): bytes}. Language is the
+        wIndex of string descriptor requests and 0 for every other type.
+        '''
+        if self.compiled is not None:
+            return dict(self.compiled.entries)
+        return {}
+
+    def get_descriptor_table(self):
+        if self.descriptor_table is None:
+            table = {(0x01, 0, 0): self.device_descriptor.pack(),  # Device Descriptor
+                     (0x02, 0, 0): bytes(self.all_configurations)}  # Configuration Descriptor
+            table.update(self.descriptor_entries())
+            self.descriptor_table = table
+        return self.descriptor_table
+
+    def invalidate_descriptors(self):
+        '''
+        Must be called after changing any descriptor or string the device reports. Devices built from
+        a compiled spec keep the configuration packed by the spec.
+        '''
+        self.generate_raw_configuration()
+        self.descriptor_table = None
+
+    def send_usb_ret(self, usb_req, usb_res, usb_len, status=0, iso_packets=None):
+        if device_log.isEnabledFor(logging.DEBUG):
+            device_log.debug('Sending seqnum %x status %d length %d: %s', usb_req.seqnum, status, usb_len, HexDump(usb_res))
+        if self.capture is not None:
+            self.capture.record_complete(self, usb_req, usb_res, usb_len, status)
+        if self.recorder is not None:
+            self.recorder.record_complete(usb_req, usb_res, status)
+        self.metrics.record_complete(usb_req, usb_len)
+        ret = USBIP_RET_Submit(command=USBIP_RET_SUBMIT,
+                               seqnum=usb_req.seqnum,
+                               status=status,
+                               actual_length=usb_len)
+        if iso_packets is None:
+            header = ret.pack_header()
+            # usb_res may be a memoryview of the device's backing store, or a FileRegion sent with
+            # os.sendfile, either way it is not copied
+            self.connection.send_buffers((header, usb_res) if usb_res else (header,))
+            return
+        ret.init_from_dict(start_frame=usb_req.start_frame, number_of_packets=iso_packets.count,
+                           error_count=iso_packets.error_count())
+        self.connection.send_buffers((ret.pack_header(), usb_res, iso_packets.to_bytes()))
+
+    def iso_start_frame(self, usb_req):
+        '''
+        Frame an isochronous URB starts in. URB_ISO_ASAP URBs follow the previous URB on the endpoint,
+        or start now if the endpoint fell behind.
+        '''
+        key = (usb_req.ep, usb_req.direction)
+        now = int(time.monotonic() * (8000 if self.speed >= USB_SPEED_HIGH else 1000))  # (micro)frame number
+        if usb_req.flags & URB_ISO_ASAP:
+            start = max(self.iso_frames.get(key, now), now)
+        else:
+            start = usb_req.start_frame
+        self.iso_frames[key] = start + usb_req.iso_packets.count * max(usb_req.interval, 1)
+        return start & 0xFFFFFFFF
+
+    def send_iso_ret(self, usb_req, data=b'', lengths=None, status=0):
+        '''
+        Completes an isochronous URB. IN packets are filled in order from the contiguous buffer
+        `data`, each up to its requested length or with `lengths[i]` bytes, and the data is sent
+        without padding, as the protocol expects. OUT packets are reported as fully written.
+        '''
+        iso_packets = usb_req.iso_packets
+        if usb_req.direction == USBIP_DIR_IN:
+            actual_length = iso_packets.fill(len(data), lengths)
+            data = data[:actual_length]
+        else:
+            actual_length = iso_packets.complete_all()
+            data = b''
+        self.send_usb_ret(usb_req, data, actual_length, status, iso_packets)
+
+    def ack_out(self, usb_req):
+        '''
+        Completes an OUT URB, reporting its whole transfer buffer as written
+        '''
+        self.send_usb_ret(usb_req, b'', len(usb_req.transfer_buffer or b''))
+
+    def park_urb(self, usb_req):
+        '''
+        Keeps an URB pending until the device has data for it, see complete_parked_urb
+        '''
+        with self.urb_lock:
+            self.pending_urbs.setdefault((usb_req.ep, usb_req.direction), {})[usb_req.seqnum] = usb_req
+
+    def pop_parked_urb(self, ep, direction=USBIP_DIR_IN):
+        # Oldest pending URB on the endpoint, or None
+        with self.urb_lock:
+            pending = self.pending_urbs.get((ep, direction))
+            if not pending:
+                return None
+            return pending.pop(next(iter(pending)))
+
+    def complete_parked_urb(self, ep, data, status=0):
+        '''
+        Completes the oldest pending IN URB on `ep` with `data`, truncated to what the host asked for.
+        Returns False if no URB was waiting.
+        '''
+        usb_req = self.pop_parked_urb(ep)
+        if usb_req is None:
+            return False
+        data = data[:usb_req.transfer_buffer_length]
+        self.send_usb_ret(usb_req, data, len(data), status)
+        return True
 
-    def send_usb_ret(self, usb_req, usb_res, usb_len, status=0):
-        print(f'Sending {bytes_to_string(usb_res)}')
-        self.connection.sendall(USBIP_RET_Submit(command=0x3,
-                                                 seqnum=usb_req.seqnum,
-                                                 status=status,
-                                                 actual_length=usb_len,
-                                                 data=usb_res).pack())
+    def reset(self):
+        '''
+        Returns the device to the state of a freshly plugged device, called when the client that
+        imported it disconnects. URBs still pending belong to the gone client and are dropped.
+        Subclasses reset their own state and call this. Descriptor tables are kept, so the next
+        import costs nothing.
+        '''
+        with self.urb_lock:
+            self.pending_urbs = {}
+            self.iso_frames = {}
+
+    def flush(self):
+        '''
+        Writes out whatever the device still holds back, called before the server exits
+        '''
+        pass
 
+    def storage_counters(self):
+        '''
+        Counters and gauges of the device's storage for the metrics, see metrics.STORAGE_METRICS
+        '''
+        return {}
+
+    def unlink_urb(self, seqnum):
+        '''
+        Drops a pending URB. Returns it, or None if it was not pending (already completed or in progress)
+        '''
+        with self.urb_lock:
+            for pending in self.pending_urbs.values():
+                usb_req = pending.pop(seqnum, None)
+                if usb_req is not None:
+                    return usb_req
+        return None
+
+    @control_request(0x80, 0x06)  # GET_DESCRIPTOR
+    @control_request(0x81, 0x06)  # GET_DESCRIPTOR for an interface
     def handle_get_descriptor(self, control_req, usb_req):
-        handled = False
         descriptor_type, descriptor_index = control_req.wValue.to_bytes(length=2, byteorder='big')
-        print(f"handle_get_descriptor {descriptor_type:n} {descriptor_index:n}")
-        if descriptor_type == 0x01:  # Device Descriptor
-            handled = True
-            ret = self.device_descriptor.pack()
-            self.send_usb_ret(usb_req, ret, len(ret))
-        elif descriptor_type == 0x02:  # Configuration Descriptor
-            handled = True
-            ret = self.all_configurations[:control_req.wLength]
-            self.send_usb_ret(usb_req, ret, len(ret))
-
-        return handled
-
+        device_log.debug('handle_get_descriptor %d %d', descriptor_type, descriptor_index)
+        language = control_req.wIndex if descriptor_type == 0x03 else 0
+        ret = self.get_descriptor_table().get((descriptor_type, descriptor_index, language))
+        if ret is None:
+            self.stall(usb_req)
+            return
+        ret = ret[:control_req.wLength]
+        self.send_usb_ret(usb_req, ret, len(ret))
+
+    @control_request(0x80, 0x00)  # GET_STATUS
+    def handle_get_status(self, control_req, usb_req):
+        attributes = self.configurations[0].bmAttributes
+        is_self_powered = (attributes >> 6) & 1
+        is_remote_wakeup = (attributes >> 5) & 1
+        ret = 0x0000 | (is_remote_wakeup << 1) | (is_self_powered)
+        self.send_usb_ret(usb_req, ret.to_bytes(length=2, byteorder='little'), 2)
+
+    @control_request(0x00, 0x09)  # SET_CONFIGURATION
     def handle_set_configuration(self, control_req, usb_req):
         # Only supports 1 configuration
-        print(f"handle_set_configuration {control_req.wValue:n}")
+        device_log.debug('handle_set_configuration %d', control_req.wValue)
         self.send_usb_ret(usb_req, b'', 0)
-        return True
+
+    def stall(self, usb_req):
+        self.send_usb_ret(usb_req, b'', 0, -EPIPE)
+
+    def bind_control_handlers(self):
+        '''
+        Turns control_table into {(bmRequestType, bRequest): bound method}. Requests registered per
+        descriptor type map to {descriptor type or None: bound method} instead.
+        '''
+        handlers = {}
+        for (request_type, request, descriptor_type), name in self.control_table.items():
+            handler = getattr(self, name)
+            entry = handlers.get((request_type, request))
+            if descriptor_type is None and not isinstance(entry, dict):
+                handlers[(request_type, request)] = handler
+                continue
+            if not isinstance(entry, dict):
+                entry = handlers[(request_type, request)] = {} if entry is None else {None: entry}
+            entry[descriptor_type] = handler
+        self.control_handlers = handlers
 
     def handle_usb_control(self, usb_req):
+        setup = usb_req.setup
+        handler = self.control_handlers.get((setup[0], setup[1]))
+        if type(handler) is dict:
+            handler = handler.get(setup[3], handler.get(None))  # setup[3] is the descriptor type in wValue
         control_req = StandardDeviceRequest()
-        control_req.unpack(usb_req.setup)
-        handled = False
-        print(f"  UC Request Type {control_req.bmRequestType}")
-        print(f"  UC Request {control_req.bRequest}")
-        print(f"  UC Value  {control_req.wValue}")
-        print(f"  UC Index  {control_req.wIndex}")
-        print(f"  UC Length {control_req.wLength}")
-        if control_req.bmRequestType == 0x80:  # Data flows IN, from Device to Host
-            if control_req.bRequest == 0x00:  # GET_STATUS
-                attributes = self.configurations[0].bmAttributes
-                is_self_powered = attributes & (1 << 6)
-                is_remote_wakeup = attributes & (1 << 5)
-                ret = 0x0000 | (is_remote_wakeup << 1) | (is_self_powered)
-                self.send_usb_ret(usb_req, ret, 2)
-                handled = True
-
-            elif control_req.bRequest == 0x06:  # GET_DESCRIPTOR
-                handled = self.handle_get_descriptor(control_req, usb_req)
-
-        elif control_req.bmRequestType == 0x00:  # Data flows OUT, from Host to Device
-            if control_req.bRequest == 0x09:  # Set Configuration
-                handled = self.handle_set_configuration(control_req, usb_req)
-
-        if not handled:
+        control_req.unpack(setup)
+        if device_log.isEnabledFor(logging.DEBUG):
+            device_log.debug('control bmRequestType %02x bRequest %02x wValue %04x wIndex %04x wLength %d',
+                             control_req.bmRequestType, control_req.bRequest, control_req.wValue,
+                             control_req.wIndex, control_req.wLength)
+        if handler is not None:
+            handler(control_req, usb_req)
+            return
+        try:
             self.handle_device_specific_control(control_req, usb_req)
+        except NotImplementedError:
+            self.metrics.record_unhandled(usb_req)
+            self.stall(usb_req)
 
     def handle_usb_request(self, usb_req):
+        self.metrics.record_submit(usb_req)
+        if self.capture is not None:
+            self.capture.record_submit(self, usb_req)
+        if self.recorder is not None:
+            self.recorder.record_submit(usb_req)
+        if usb_req.iso_packets is not None:
+            usb_req.start_frame = self.iso_start_frame(usb_req)
         if usb_req.ep == 0:  # Endpoint 0 is always the control endpoint
             self.handle_usb_control(usb_req)
         else:
             self.handle_data(usb_req)
 
+    def handle_device_specific_control(self, control_req, usb_req):
+        '''
+        Called for control requests missing from control_table. Stalls them by default.
+        '''
+        raise NotImplementedError
+
     @abstractmethod
     def handle_data(self, usb_req):
         pass
 
-    @abstractmethod
-    def handle_device_specific_control(self, usb_req):
-        pass
+
+USBDevice.control_table = collect_control_table(USBDevice)
 
 
 def bytes_to_string(bytes):
@@ -371,109 +1068,609 @@ def bytes_to_string(bytes):
     return None
 
 
+class HexDump:
+    '''
+    Log argument that hex formats a buffer only if the record is emitted, showing at most `limit` bytes
+    '''
+    __slots__ = ('data', 'limit')
+
+    def __init__(self, data, limit=64):
+        self.data = data
+        self.limit = limit
+
+    def __str__(self):
+        data = self.data
+        if isinstance(data, FileRegion):
+            data = data[:self.limit + 1].tobytes()
+        if data is None or len(self.data) <= self.limit:
+            return str(bytes_to_string(data))
+        return f'{bytes_to_string(data[:self.limit])}... ({len(self.data)} bytes)'
+
+
+class FileRegion:
+    '''
+    Payload that is sent straight from a file with os.sendfile, without ever being read into user
+    space. Can be sliced like bytes. `fd` must stay open until the reply is sent.
+    '''
+    __slots__ = ('fd', 'offset', 'length')
+
+    def __init__(self, fd, offset, length):
+        self.fd = fd
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        start, stop, step = index.indices(self.length)
+        if step != 1:
+            raise ValueError('file regions only support contiguous slices')
+        return FileRegion(self.fd, self.offset + start, max(0, stop - start))
+
+    def tobytes(self):
+        # Only for capture and recording, the reply itself is never read
+        return os.pread(self.fd, self.length, self.offset)
+
+    def __bytes__(self):
+        return self.tobytes()
+
+    def sendfile(self, sock):
+        offset, end = self.offset, self.offset + self.length
+        while offset < end:
+            sent = os.sendfile(sock.fileno(), self.fd, offset, end - offset)
+            if not sent:
+                raise EOFError(f'file region ends past the end of fd {self.fd}')
+            offset += sent
+
+    async def sock_sendfile(self, loop, sock):
+        offset, end = self.offset, self.offset + self.length
+        while offset < end:
+            try:
+                sent = os.sendfile(sock.fileno(), self.fd, offset, end - offset)
+            except (BlockingIOError, InterruptedError):
+                await sock_writable(loop, sock)
+                continue
+            if not sent:
+                raise EOFError(f'file region ends past the end of fd {self.fd}')
+            offset += sent
+
+
+def advance_buffers(buffers, sent):
+    # Drops the first `sent` bytes of a list of memoryviews
+    while sent:
+        if sent < len(buffers[0]):
+            buffers[0] = buffers[0][sent:]
+            break
+        sent -= len(buffers.pop(0))
+    return buffers
+
+
+def split_file_regions(buffers):
+    # Yields (buffers, FileRegion or None) runs: what sendmsg sends, then what follows it by sendfile
+    start = 0
+    for i, buffer in enumerate(buffers):
+        if isinstance(buffer, FileRegion):
+            yield buffers[start:i], buffer
+            start = i + 1
+    yield buffers[start:] if start else buffers, None
+
+
+def sendmsg_all(sock, buffers):
+    '''
+    sendall for several buffers, gathered by sendmsg without joining them. FileRegion buffers are
+    sent with os.sendfile in between.
+    '''
+    for run, region in split_file_regions(buffers):
+        send_run(sock, run, MSG_MORE if region is not None else 0)
+        if region is not None:
+            region.sendfile(sock)
+
+
+def send_run(sock, buffers, flags):
+    if not hasattr(sock, 'sendmsg'):  # Windows
+        sock.sendall(b''.join(buffers))
+        return
+    buffers = [memoryview(buffer).cast('B') for buffer in buffers if len(buffer)]
+    while buffers:
+        advance_buffers(buffers, sock.sendmsg(buffers[:IOV_MAX], (), flags))
+
+
+async def sock_writable(loop, sock):
+    writable = loop.create_future()
+    loop.add_writer(sock.fileno(), lambda: writable.done() or writable.set_result(None))
+    try:
+        await writable
+    finally:
+        loop.remove_writer(sock.fileno())
+
+
+async def sock_sendmsg_all(loop, sock, buffers):
+    '''
+    sendmsg_all for a non-blocking socket driven by `loop`
+    '''
+    for run, region in split_file_regions(buffers):
+        await sock_send_run(loop, sock, run, MSG_MORE if region is not None else 0)
+        if region is not None:
+            await region.sock_sendfile(loop, sock)
+
+
+async def sock_send_run(loop, sock, buffers, flags):
+    if not hasattr(sock, 'sendmsg'):
+        await loop.sock_sendall(sock, b''.join(buffers))
+        return
+    buffers = [memoryview(buffer).cast('B') for buffer in buffers if len(buffer)]
+    while buffers:
+        try:
+            advance_buffers(buffers, sock.sendmsg(buffers[:IOV_MAX], (), flags))
+        except (BlockingIOError, InterruptedError):
+            await sock_writable(loop, sock)
+
+
+class SocketConnection:
+    '''
+    Blocking client connection. Messages from the serving thread are queued and sent in one
+    sendmsg by flush, which the server calls before it blocks on the socket, or once `max_batch`
+    messages are waiting. URBs completed from other threads are sent right away, after whatever is
+    queued. Everything happens under a lock to keep messages from interleaving.
+    '''
+
+    def __init__(self, sock, max_batch=64, metrics=None):
+        self.sock = sock
+        self.max_batch = max_batch
+        self.metrics = metrics
+        self.owner = threading.get_ident()
+        self.lock = threading.Lock()
+        self.pending = []  # buffers of the queued messages
+        self.pending_messages = 0
+
+    def sendall(self, data):
+        self.send_buffers((data,))
+
+    def send_buffers(self, buffers):
+        with self.lock:
+            self.pending.extend(buffers)
+            self.pending_messages += 1
+            if self.pending_messages >= self.max_batch or threading.get_ident() != self.owner:
+                self.flush_locked()
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        if not self.pending_messages:
+            return
+        pending, messages = self.pending, self.pending_messages
+        self.pending = []
+        self.pending_messages = 0
+        if self.metrics is not None:
+            self.metrics.record_batch(messages)
+        sendmsg_all(self.sock, pending)
+
+
+class AsyncConnection:
+    '''
+    Write side of an asyncio client connection. send_buffers may be called from the event loop or
+    from handler threads; messages are queued and a writer task sends everything queued, up to
+    `max_batch` messages, with one sendmsg. While the server holds the queue, because it is still
+    dispatching received URBs, the writer waits for flush or a full batch.
+    '''
+
+    def __init__(self, sock, loop, max_batch=64, metrics=None):
+        self.sock = sock
+        self.loop = loop
+        self.max_batch = max_batch
+        self.metrics = metrics
+        self.loop_thread = threading.get_ident()
+        self.queue = deque()
+        self.ready = asyncio.Event()
+        self.held = False
+        self.closing = False
+        self.writer = loop.create_task(self.write_loop())
+
+    def sendall(self, data):
+        self.send_buffers((data,))
+
+    def send_buffers(self, buffers):
+        if threading.get_ident() == self.loop_thread:
+            self.enqueue(buffers)
+        else:
+            self.loop.call_soon_threadsafe(self.enqueue, buffers)
+
+    def enqueue(self, buffers):
+        if not self.writer.done():
+            self.queue.append(buffers)
+            if not self.held or len(self.queue) >= self.max_batch:
+                self.ready.set()
+
+    def hold(self):
+        self.held = True
+
+    def flush(self):
+        self.held = False
+        if self.queue:
+            self.ready.set()
+
+    async def write_loop(self):
+        try:
+            while self.queue or not self.closing:
+                if not self.queue:
+                    await self.ready.wait()
+                    self.ready.clear()
+                    continue
+                batch = []
+                messages = 0
+                while self.queue and messages < self.max_batch:
+                    batch.extend(self.queue.popleft())
+                    messages += 1
+                if self.metrics is not None:
+                    self.metrics.record_batch(messages)
+                await sock_sendmsg_all(self.loop, self.sock, batch)
+        except OSError:
+            self.queue.clear()
+
+    async def close(self):
+        # Let the writer drain what is already queued before closing the socket
+        self.held = False
+        self.closing = True
+        self.ready.set()
+        await self.writer
+        self.sock.close()
+
+
+class ImportHandoff:
+    '''
+    Yielded by USBIPSession.protocol when another worker process owns the device being imported
+    '''
+
+    def __init__(self, busid):
+        self.busid = busid
+
+
+IMPORT_FAILED = USBIPHeader(command=3, status=1).pack()  # Unknown or busy bus id, the reply ends after the status
+
+
+class USBIPSession:
+    '''
+    State of one client connection. `protocol` is a generator that yields either the number of
+    bytes it needs next or a USBRequest that the caller must dispatch before resuming it, so the
+    same state machine runs under the blocking server and the asyncio server.
+
+    A session starts in SESSION_HANDSHAKE, moves to SESSION_IMPORTED once a device is imported and
+    ends in SESSION_CLOSED, where the device is reset and released for the next client.
+    '''
+
+    def __init__(self, container, connection):
+        self.container = container
+        self.connection = connection
+        self.device = None
+        self.state = SESSION_HANDSHAKE
+
+    def import_device(self, busid):
+        '''
+        Returns the OP_REP_IMPORT reply, packed when the device was added
+        '''
+        usb_dev = self.container.attach_device(busid, self)
+        if usb_dev is None:
+            self.container.metrics.count('failed_imports')
+            return IMPORT_FAILED
+        usb_dev.connection = self.connection
+        self.device = usb_dev
+        self.state = SESSION_IMPORTED
+        return self.container.import_reply(usb_dev)
+
+    def close(self):
+        if self.state == SESSION_CLOSED:
+            return
+        self.state = SESSION_CLOSED
+        if self.device is not None:
+            # Reset before releasing, the next client must not see URBs or settings of this one
+            self.device.reset()
+            self.container.detach_device(self.device, self)
+            self.device = None
+
+    def protocol(self, busid=None):
+        '''
+        With `busid`, the OP_REQ_IMPORT for it was received by another worker which handed the
+        connection over
+        '''
+        req = USBIPHeader()
+        cmd = USBIP_CMD_Submit()
+        cmd_size = cmd.size()
+        unlink = USBIP_CMD_Unlink()
+        if busid is not None:
+            server_log.info('attach device %s handed over by another worker', busid)
+            self.container.metrics.count('imports')
+            self.connection.sendall(self.import_device(busid))
+        while self.state == SESSION_HANDSHAKE:
+            data = yield req.size()
+            req.unpack(data)
+            server_log.debug('OP command %x', req.command)
+            if req.command == 0x8005:  # OP_REQ_DEVLIST
+                server_log.info('list of devices')
+                self.container.metrics.count('device_lists')
+                self.connection.sendall(self.container.handle_device_list())
+            elif req.command == 0x8003:  # OP_REQ_IMPORT
+                busid = bytes((yield 32)).rstrip(b'\0').decode('ascii', 'replace')
+                if not self.container.owns(busid):
+                    # The owner counts the import
+                    server_log.info('handing device %s over to worker %d', busid, self.container.shard_owner[busid])
+                    yield ImportHandoff(busid)
+                    return
+                server_log.info('attach device %s', busid)
+                self.container.metrics.count('imports')
+                self.connection.sendall(self.import_device(busid))
+
+        while 1:
+            header = yield cmd_size
+            received = time.perf_counter()
+            if header[3] == USBIP_CMD_UNLINK:  # command is a big-endian 32-bit field
+                unlink.unpack(header)
+                urb_log.debug('unlink seqnum %x', unlink.unlink_seqnum)
+                self.handle_unlink(unlink)
+                continue
+            cmd.unpack(header)
+            transfer_buffer = None
+            iso_packets = None
+            out_length = cmd.transfer_buffer_length if cmd.direction == USBIP_DIR_OUT else 0
+            if 0 < cmd.number_of_packets < 0xffffffff:
+                # Isochronous: the packet descriptors follow the data, read both at once
+                data = yield out_length + cmd.number_of_packets * IsoPacketDescriptors.descriptor_size
+                transfer_buffer = data[:out_length] if cmd.direction == USBIP_DIR_OUT else None
+                iso_packets = IsoPacketDescriptors.from_bytes(data[out_length:])
+            elif cmd.direction == USBIP_DIR_OUT:
+                transfer_buffer = yield cmd.transfer_buffer_length
+            if urb_log.isEnabledFor(logging.DEBUG):
+                urb_log.debug('submit seqnum %x devid %x direction %d ep %d flags %x length %d start %d '
+                              'packets %d interval %d setup %s data %s',
+                              cmd.seqnum, cmd.devid, cmd.direction, cmd.ep, cmd.transfer_flags,
+                              cmd.transfer_buffer_length, cmd.start_frame, cmd.number_of_packets,
+                              cmd.interval, HexDump(cmd.setup), HexDump(transfer_buffer))
+            yield USBRequest(seqnum=cmd.seqnum,
+                             devid=cmd.devid,
+                             direction=cmd.direction,
+                             ep=cmd.ep,
+                             flags=cmd.transfer_flags,
+                             numberOfPackets=cmd.number_of_packets,
+                             interval=cmd.interval,
+                             setup=cmd.setup,
+                             transfer_buffer_length=cmd.transfer_buffer_length,
+                             transfer_buffer=transfer_buffer,
+                             start_frame=cmd.start_frame,
+                             iso_packets=iso_packets,
+                             received=received)
+
+    def handle_unlink(self, unlink):
+        self.container.metrics.count('unlinks')
+        status = 0
+        if unlink.devid == self.device.devid and self.device.unlink_urb(unlink.unlink_seqnum) is not None:
+            status = -ECONNRESET  # The unlinked URB never gets a USBIP_RET_SUBMIT
+        self.connection.sendall(USBIP_RET_Unlink(seqnum=unlink.seqnum, status=status).pack())
+
+    def dispatch(self, usb_req):
+        if usb_req.devid != self.device.devid:
+            # Only the imported device is reachable through this connection
+            self.container.metrics.count('rejected_urbs')
+            self.connection.sendall(USBIP_RET_Submit(command=USBIP_RET_SUBMIT, seqnum=usb_req.seqnum, status=-ENODEV,
+                                                     actual_length=0, error_count=0, data=b'').pack())
+            return
+        self.device.handle_usb_request(usb_req)
+
+
 class USBContainer:
-    usb_devices = []
+    '''
+    Exports USB devices over USB/IP. `tcp_nodelay` turns off Nagle's algorithm on client sockets,
+    `send_buffer_size` and `receive_buffer_size` set SO_SNDBUF and SO_RCVBUF when given, and
+    `max_batch` bounds the replies merged into one sendmsg.
+    '''
+    busnum = 1
+
+    def __init__(self, tcp_nodelay=True, send_buffer_size=None, receive_buffer_size=None, max_batch=64):
+        self.tcp_nodelay = tcp_nodelay
+        self.send_buffer_size = send_buffer_size
+        self.receive_buffer_size = receive_buffer_size
+        self.max_batch = max_batch
+        self.usb_devices = []
+        self.devices_by_busid = {}
+        self.attached = {}  # busid -> session using the device
+        self.lock = threading.Lock()
+        self.metrics = ContainerMetrics()
+        # Handshake replies, packed on first use and kept across attaches
+        self.import_replies = {}  # busid -> OP_REP_IMPORT
+        self.device_list = None  # OP_REP_DEVLIST
+        # Set in worker processes, see workers.py
+        self.shard_owner = None  # busid -> index of the worker owning the device
+        self.worker_index = None
+        self.handoff = None  # handoff(conn, busid, buffered) passes a connection to the owning worker
 
     def add_usb_device(self, usb_device):
+        port = len(self.usb_devices) + 1
+        usb_device.busnum = self.busnum
+        usb_device.devnum = port + 1
+        usb_device.devid = (usb_device.busnum << 16) | usb_device.devnum  # as computed by the vhci driver
+        usb_device.busid = f'{self.busnum}-{port}'
+        usb_device.usb_path = f'/sys/devices/pci0000:00/0000:00:01.2/usb{self.busnum}/{usb_device.busid}'
         self.usb_devices.append(usb_device)
-
-    def handle_attach(self):
-        usb_dev = self.usb_devices[0]
+        self.devices_by_busid[usb_device.busid] = usb_device
+        self.invalidate_device_tables()
+
+    def invalidate_device_tables(self):
+        '''
+        Must be called after changing the descriptors of an exported device
+        '''
+        self.import_replies = {}
+        self.device_list = None
+
+    def owns(self, busid):
+        # Devices of unknown bus ids are owned by everyone, the import fails wherever it lands
+        return self.shard_owner is None or self.shard_owner.get(busid, self.worker_index) == self.worker_index
+
+    def attach_device(self, busid, session):
+        with self.lock:
+            usb_dev = self.devices_by_busid.get(busid)
+            if usb_dev is None or busid in self.attached:
+                return None
+            self.attached[busid] = session
+            return usb_dev
+
+    def detach_device(self, usb_dev, session):
+        with self.lock:
+            if self.attached.get(usb_dev.busid) is session:
+                del self.attached[usb_dev.busid]
+
+    def device_fields(self, usb_dev):
         device_descriptor = usb_dev.device_descriptor
-        return OP_REP_Import(base=USBIPHeader(command=3, status=0),
-                             usbPath='/sys/devices/pci0000:00/0000:00:01.2/usb1/1-1'.encode('ascii'),
-                             busID='1-1'.encode('ascii'),
-                             busnum=1,
-                             devnum=2,
-                             speed=2,
-                             idVendor=device_descriptor.idVendor,
-                             idProduct=device_descriptor.idProduct,
-                             bcdDevice=device_descriptor.bcdDevice,
-                             bDeviceClass=device_descriptor.bDeviceClass,
-                             bDeviceSubClass=device_descriptor.bDeviceSubClass,
-                             bDeviceProtocol=device_descriptor.bDeviceProtocol,
-                             bConfigurationValue=usb_dev.configurations[0].bConfigurationValue,
-                             bNumConfigurations=device_descriptor.bNumConfigurations,
-                             bNumInterfaces=usb_dev.configurations[0].bNumInterfaces)
+        return dict(usbPath=usb_dev.usb_path.encode('ascii'),
+                    busID=usb_dev.busid.encode('ascii'),
+                    busnum=usb_dev.busnum,
+                    devnum=usb_dev.devnum,
+                    speed=usb_dev.speed,
+                    idVendor=device_descriptor.idVendor,
+                    idProduct=device_descriptor.idProduct,
+                    bcdDevice=device_descriptor.bcdDevice,
+                    bDeviceClass=device_descriptor.bDeviceClass,
+                    bDeviceSubClass=device_descriptor.bDeviceSubClass,
+                    bDeviceProtocol=device_descriptor.bDeviceProtocol,
+                    bConfigurationValue=usb_dev.configurations[0].bConfigurationValue,
+                    bNumConfigurations=device_descriptor.bNumConfigurations,
+                    bNumInterfaces=usb_dev.configurations[0].bNumInterfaces)
+
+    def handle_attach(self, usb_dev):
+        return OP_REP_Import(base=USBIPHeader(command=3, status=0), **self.device_fields(usb_dev))
+
+    def import_reply(self, usb_dev):
+        reply = self.import_replies.get(usb_dev.busid)
+        if reply is None:
+            reply = self.import_replies[usb_dev.busid] = self.handle_attach(usb_dev).pack()
+        return reply
 
     def handle_device_list(self):
-        usb_dev = self.usb_devices[0]
-        device_descriptor = usb_dev.device_descriptor
-        return OP_REP_DevList(base=USBIPHeader(command=5, status=0),
-                              nExportedDevice=1,
-                              usbPath='/sys/devices/pci0000:00/0000:00:01.2/usb1/1-1'.encode('ascii'),
-                              busID='1-1'.encode('ascii'),
-                              busnum=1,
-                              devnum=2,
-                              speed=2,
-                              idVendor=device_descriptor.idVendor,
-                              idProduct=device_descriptor.idProduct,
-                              bcdDevice=device_descriptor.bcdDevice,
-                              bDeviceClass=device_descriptor.bDeviceClass,
-                              bDeviceSubClass=device_descriptor.bDeviceSubClass,
-                              bDeviceProtocol=device_descriptor.bDeviceProtocol,
-                              bConfigurationValue=usb_dev.configurations[0].bConfigurationValue,
-                              bNumConfigurations=device_descriptor.bNumConfigurations,
-                              bNumInterfaces=usb_dev.configurations[0].bNumInterfaces,
-                              interfaces=USBInterface(bInterfaceClass=usb_dev.configurations[0].interfaces[0][0].bInterfaceClass,
-                                                      bInterfaceSubClass=usb_dev.configurations[0].interfaces[0][0].bInterfaceSubClass,
-                                                      bInterfaceProtocol=usb_dev.configurations[0].interfaces[0][0].bInterfaceProtocol))
+        if self.device_list is None:
+            self.device_list = self.pack_device_list()
+        return self.device_list
+
+    def pack_device_list(self):
+        reply = bytearray(OP_REP_DevList(base=USBIPHeader(command=5, status=0),
+                                         nExportedDevice=len(self.usb_devices)).pack())
+        for usb_dev in self.usb_devices:
+            reply.extend(OP_REP_DevListDevice(**self.device_fields(usb_dev)).pack())
+            for interface in usb_dev.configurations[0].interfaces:
+                reply.extend(USBInterface(bInterfaceClass=interface[0].bInterfaceClass,
+                                          bInterfaceSubClass=interface[0].bInterfaceSubClass,
+                                          bInterfaceProtocol=interface[0].bInterfaceProtocol).pack())
+        return bytes(reply)
+
+    def configure_socket(self, conn):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self.tcp_nodelay))
+        if self.send_buffer_size:
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer_size)
+        if self.receive_buffer_size:
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer_size)
+
+    def serve_connection(self, conn):
+        self.configure_socket(conn)
+        connection = SocketConnection(conn, self.max_batch, self.metrics)
+        session = USBIPSession(self, connection)
+        reader = USBIPReader(conn)
+        protocol = session.protocol()
+        step = next(protocol)
+        self.metrics.session_started()
+        try:
+            while 1:
+                if isinstance(step, USBRequest):
+                    session.dispatch(step)
+                    step = next(protocol)
+                elif isinstance(step, ImportHandoff):
+                    self.handoff(conn, step.busid, bytes(reader.view[reader.start:reader.end]))
+                    break
+                else:
+                    if reader.available() < step:
+                        connection.flush()  # Everything received so far is answered, send the replies together
+                    data = reader.read_exactly(step)
+                    if data is None:
+                        break
+                    step = protocol.send(data)
+        except ConnectionError:
+            pass
+        finally:
+            try:
+                connection.flush()
+            except OSError:
+                pass
+            session.close()
+            self.metrics.session_ended()
 
     def run(self, ip='0.0.0.0', port=3240):
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind((ip, port))
         s.listen()
-        attached = False
-        req = USBIPHeader()
         while 1:
             conn, addr = s.accept()
-            print('Connection address:', addr)
+            server_log.info('Connection address: %s', addr)
+            self.serve_connection(conn)
+            server_log.info('Close connection %s', addr)
+            conn.close()
+
+    async def serve_connection_async(self, conn, addr, executor, busid=None, buffered=b''):
+        loop = asyncio.get_running_loop()
+        self.configure_socket(conn)
+        connection = AsyncConnection(conn, loop, self.max_batch, self.metrics)
+        session = USBIPSession(self, connection)
+        reader = AsyncUSBIPReader(conn, loop)
+        reader.feed(buffered)
+        protocol = session.protocol(busid)
+        step = next(protocol)
+        self.metrics.session_started(handed_off=busid is not None)
+        try:
             while 1:
-                if not attached:
-                    data = conn.recv(8)
-                    if not data:
-                        break
-                    req.unpack(data)
-                    print('Header Packet')
-                    print('command:', hex(req.command))
-                    if req.command == 0x8005:  # OP_REQ_DEVLIST
-                        print('list of devices')
-                        conn.sendall(self.handle_device_list().pack())
-                    elif req.command == 0x8003:  # OP_REQ_IMPORT
-                        print('attach device')
-                        conn.recv(32)  # receive bus id
-                        conn.sendall(self.handle_attach().pack())
-                        attached = True
+                if isinstance(step, USBRequest):
+                    # Device handlers may block, run them off the event loop so other sessions keep going.
+                    # The session waits for its own handler, which keeps its URBs in order.
+                    connection.hold()
+                    await loop.run_in_executor(executor, session.dispatch, step)
+                    step = next(protocol)
+                elif isinstance(step, ImportHandoff):
+                    self.handoff(conn, step.busid, bytes(reader.view[reader.start:reader.end]))
+                    break
                 else:
-                    print('----------------')
-                    print('handles requests')
-                    cmd = USBIP_CMD_Submit()
-                    cmd_header_data = conn.recv(cmd.size())
-                    cmd.unpack(cmd_header_data)
-                    transfer_buffer = conn.recv(cmd.transfer_buffer_length) if cmd.direction == USBIP_DIR_OUT else None
-                    print(f"usbip cmd {cmd.command:x}")
-                    print(f"usbip seqnum {cmd.seqnum:x}")
-                    print(f"usbip devid {cmd.devid:x}")
-                    print(f"usbip direction {cmd.direction:x}")
-                    print(f"usbip ep {cmd.ep:x}")
-                    print(f"usbip flags {cmd.transfer_flags:x}")
-                    print(f"usbip transfer buffer length {cmd.transfer_buffer_length:x}")
-                    print(f"usbip start {cmd.start_frame:x}")
-                    print(f"usbip number of packets {cmd.number_of_packets:x}")
-                    print(f"usbip interval {cmd.interval:x}")
-                    print(f"usbip setup {bytes_to_string(cmd.setup)}")
-                    print(f"usbip transfer buffer {bytes_to_string(transfer_buffer)}")
-                    usb_req = USBRequest(seqnum=cmd.seqnum,
-                                         devid=cmd.devid,
-                                         direction=cmd.direction,
-                                         ep=cmd.ep,
-                                         flags=cmd.transfer_flags,
-                                         numberOfPackets=cmd.number_of_packets,
-                                         interval=cmd.interval,
-                                         setup=cmd.setup,
-                                         transfer_buffer=transfer_buffer)
-                    self.usb_devices[0].connection = conn
-                    self.usb_devices[0].handle_usb_request(usb_req)
-            print('Close connection\n')
-            conn.close()
+                    if reader.available() < step:
+                        connection.flush()  # Everything received so far is answered, send the replies together
+                    data = await reader.read_exactly(step)
+                    if data is None:
+                        break
+                    step = protocol.send(data)
+        except ConnectionError:
+            pass
+        finally:
+            server_log.info('Close connection %s', addr)
+            session.close()
+            self.metrics.session_ended()
+            await connection.close()
+
+    async def serve(self, ip='0.0.0.0', port=3240, executor=None, reuse_port=False):
+        loop = asyncio.get_running_loop()
+        if executor is None:
+            executor = ThreadPoolExecutor()
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)  # Worker processes share the port
+        s.bind((ip, port))
+        s.listen()
+        s.setblocking(False)
+        sessions = set()
+        while 1:
+            conn, addr = await loop.sock_accept(s)
+            server_log.info('Connection address: %s', addr)
+            conn.setblocking(False)
+            task = loop.create_task(self.serve_connection_async(conn, addr, executor))
+            sessions.add(task)
+            task.add_done_callback(sessions.discard)
+
+    def run_async(self, ip='0.0.0.0', port=3240, executor=None):
+        '''
+        Serves every client connection concurrently on an asyncio event loop
+        '''
+        asyncio.run(self.serve(ip, port, executor))
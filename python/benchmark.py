@@ -0,0 +1,254 @@
+import argparse
+import importlib
+import json
+import logging
+import os
+import random
+import struct
+import tempfile
+import threading
+import time
+
+from USBIP import USBContainer, USBIP_DIR_IN, USBIP_DIR_OUT, USB_SPEED_HIGH
+from device_spec import CompiledDevice, compile_spec, spec_hash, spec_path
+from mass_storage import CommandBlockWrapper, CommandStatusWrapper, CBW_SIGNATURE
+from samsung_T5_emulate import SamsungT5
+from scheduler import InterruptEndpoint, TimerWheel
+from storage import FLUSH_POLICIES, MmapDiskImage, parse_size
+from usbip_client import USBIPClient
+
+USBHID = importlib.import_module('hid-mouse').USBHID
+
+
+def polled_mouse_spec(bInterval=1):
+    # The HID mouse spec with another polling interval
+    with open(spec_path('hid-mouse.json')) as spec_file:
+        spec = json.load(spec_file)
+    for configuration in spec['configurations']:
+        for interface in configuration['interfaces']:
+            for setting in interface:
+                for endpoint in setting['endpoints']:
+                    endpoint['bInterval'] = bInterval
+    return CompiledDevice(compile_spec(spec), spec_hash(spec))
+
+
+class BenchmarkMouse(USBHID):
+    '''
+    The HID mouse as a high speed device polled every microframe, on a timer wheel with 50 us ticks.
+    The mouse's 10 ms bInterval and the shared wheel's 1 ms ticks would set the pace of hid-polling
+    and hide the server's own latency.
+    '''
+    compiled = polled_mouse_spec()
+    speed = USB_SPEED_HIGH
+
+    def __init__(self):
+        super().__init__()
+        self.interrupt_in = InterruptEndpoint(self, self.compiled.endpoint(0x81), poll=self.random_report,
+                                              wheel=TimerWheel(tick=0.00005))
+
+
+class BenchmarkResult:
+    '''
+    URB count, payload bytes and per-URB latency (submit to RET_SUBMIT) of one workload
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.urbs = 0
+        self.bytes = 0
+        self.latencies = []  # nanoseconds
+        self.started = None
+        self.elapsed = 0
+        self.cpu_started = None
+        self.cpu = 0  # process CPU nanoseconds, client and server together
+
+    def transfer(self, client, ep, direction, length=0, setup=b'', data=b''):
+        if self.started is None:
+            self.started = time.perf_counter_ns()
+            self.cpu_started = time.process_time_ns()
+        start = time.perf_counter_ns()
+        status, response = client.transfer(ep, direction, length, setup, data)
+        end = time.perf_counter_ns()
+        self.latencies.append(end - start)
+        self.elapsed = end - self.started
+        self.cpu = time.process_time_ns() - self.cpu_started
+        self.urbs += 1
+        self.bytes += len(data) + len(response)
+        return status, response
+
+    def percentile(self, p):
+        if not self.latencies:
+            return 0
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+    def summary(self):
+        seconds = self.elapsed / 1e9 or float('inf')
+        return dict(workload=self.name, urbs=self.urbs, bytes=self.bytes, seconds=self.elapsed / 1e9,
+                    urbs_per_second=self.urbs / seconds, mb_per_second=self.bytes / seconds / 1e6,
+                    p50_us=self.percentile(50) / 1e3, p99_us=self.percentile(99) / 1e3,
+                    cpu_seconds=self.cpu / 1e9)
+
+
+class BulkOnlyClient:
+    '''
+    Host side of the Bulk-Only Transport: CBW, optional data stage, CSW
+    '''
+
+    def __init__(self, client, in_ep=1, out_ep=2):
+        self.client = client
+        self.in_ep = in_ep
+        self.out_ep = out_ep
+        self.tag = 0
+        self.csw = CommandStatusWrapper()
+
+    def command(self, result, cdb, length=0, data=None):
+        '''
+        Runs one SCSI command, reading `length` bytes or writing `data`. Returns the data read.
+        '''
+        self.tag += 1
+        if data is not None:
+            length = len(data)
+        cbw = CommandBlockWrapper(dCBWSignature=CBW_SIGNATURE, dCBWTag=self.tag, dCBWDataTransferLength=length,
+                                  bmCBWFlags=0x80 if data is None else 0x00, bCBWLUN=0, bCBWCBLength=len(cdb),
+                                  CBWCB=cdb)
+        result.transfer(self.client, self.out_ep, USBIP_DIR_OUT, data=cbw.pack())
+        response = b''
+        if data is not None:
+            result.transfer(self.client, self.out_ep, USBIP_DIR_OUT, data=data)
+        elif length:
+            _, response = result.transfer(self.client, self.in_ep, USBIP_DIR_IN, length)
+        _, csw = result.transfer(self.client, self.in_ep, USBIP_DIR_IN, self.csw.size())
+        self.csw.unpack(csw)
+        if self.csw.dCSWTag != self.tag or self.csw.bCSWStatus != 0:
+            raise RuntimeError(f'SCSI command {cdb[0]:#x} failed with CSW status {self.csw.bCSWStatus}')
+        return response
+
+    def capacity(self, result):
+        last_lba, block_size = struct.unpack('>II', self.command(result, bytes([0x25] + [0] * 9), 8))
+        return last_lba + 1, block_size
+
+
+def enumeration_storm(client, result, args):
+    # What a host reads while enumerating, repeated
+    status, data = client.get_descriptor(0x01, length=18)
+    manufacturer, product, serial_number = data[14:17]
+    status, data = client.get_descriptor(0x02, length=9)
+    total_length, = struct.unpack_from('<H', data, 2)
+    for _ in range(args.iterations):
+        result.transfer(client, 0, USBIP_DIR_IN, 8, struct.pack('<BBHHH', 0x80, 0x06, 0x0100, 0, 8))
+        result.transfer(client, 0, USBIP_DIR_IN, 18, struct.pack('<BBHHH', 0x80, 0x06, 0x0100, 0, 18))
+        result.transfer(client, 0, USBIP_DIR_IN, 9, struct.pack('<BBHHH', 0x80, 0x06, 0x0200, 0, 9))
+        result.transfer(client, 0, USBIP_DIR_IN, total_length, struct.pack('<BBHHH', 0x80, 0x06, 0x0200, 0, total_length))
+        result.transfer(client, 0, USBIP_DIR_IN, 255, struct.pack('<BBHHH', 0x80, 0x06, 0x0300, 0, 255))
+        for index in (manufacturer, product, serial_number):
+            if index:
+                result.transfer(client, 0, USBIP_DIR_IN, 255, struct.pack('<BBHHH', 0x80, 0x06, 0x0300 | index, 0x0409, 255))
+        result.transfer(client, 0, USBIP_DIR_IN, 2, struct.pack('<BBHHH', 0x80, 0x00, 0, 0, 2))
+
+
+def hid_polling(client, result, args):
+    for _ in range(args.polls):
+        args.hid.move(1, 1)  # A report for every poll, the random ones stop after 100
+        result.transfer(client, 1, USBIP_DIR_IN, 4)
+
+
+def bot_workload(write, sequential):
+    def workload(client, result, args):
+        bot = BulkOnlyClient(client)
+        block_count, block_size = bot.capacity(BenchmarkResult('setup'))
+        blocks = args.transfer_size // block_size
+        data = os.urandom(blocks * block_size) if write else None
+        rng = random.Random(0)
+        lba = 0
+        for _ in range(max(1, args.bytes // (blocks * block_size))):
+            if sequential:
+                if lba + blocks > block_count:
+                    lba = 0
+            else:
+                lba = rng.randrange(block_count // blocks) * blocks
+            cdb = struct.pack('>BBIBHB', 0x2A if write else 0x28, 0, lba, 0, blocks, 0)
+            bot.command(result, cdb, blocks * block_size, data)
+            lba += blocks
+    return workload
+
+
+# name -> (bus id, workload)
+WORKLOADS = {
+    'enumeration': ('1-1', enumeration_storm),
+    'hid-polling': ('1-2', hid_polling),
+    'bot-sequential-read': ('1-1', bot_workload(write=False, sequential=True)),
+    'bot-random-read': ('1-1', bot_workload(write=False, sequential=False)),
+    'bot-sequential-write': ('1-1', bot_workload(write=True, sequential=True)),
+    'bot-random-write': ('1-1', bot_workload(write=True, sequential=False)),
+}
+
+
+def connect(port, timeout=5):
+    deadline = time.monotonic() + timeout
+    while 1:
+        try:
+            return USBIPClient('127.0.0.1', port)
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def run_workload(name, args):
+    busid, workload = WORKLOADS[name]
+    client = connect(args.port)
+    try:
+        client.import_device(busid)
+        result = BenchmarkResult(name)
+        workload(client, result, args)
+        return result
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Loopback USB/IP throughput and latency benchmark')
+    parser.add_argument('workloads', nargs='*', default=list(WORKLOADS),
+                        help=f'workloads to run, all by default: {", ".join(WORKLOADS)}')
+    parser.add_argument('--port', type=int, default=3241, help='local port for the benchmarked server')
+    parser.add_argument('--asyncio', action='store_true', help='benchmark run_async instead of run')
+    parser.add_argument('--size', default='64M', help='size of the T5 disk image')
+    parser.add_argument('--iterations', type=int, default=200, help='enumeration sequences')
+    parser.add_argument('--polls', type=int, default=100, help='HID interrupt URBs')
+    parser.add_argument('--transfer-size', type=parse_size, default='64K', help='bytes per SCSI READ/WRITE')
+    parser.add_argument('--bytes', type=parse_size, default='32M', help='bytes moved by each BOT workload')
+    parser.add_argument('--nagle', action='store_true', help="leave Nagle's algorithm on for the server sockets")
+    parser.add_argument('--max-batch', type=int, default=64, help='most replies the server merges into one sendmsg')
+    parser.add_argument('--no-sendfile', action='store_true', help='send large reads from the mapped image instead of with sendfile')
+    parser.add_argument('--io-threads', type=int, default=4, help='storage I/O threads of the T5, 0 for inline I/O')
+    parser.add_argument('--write-cache', choices=FLUSH_POLICIES, help='flush policy of a block cache in front of the image')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+    for name in args.workloads:
+        if name not in WORKLOADS:
+            parser.error(f'unknown workload {name}')
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as directory:
+        storage = MmapDiskImage(os.path.join(directory, 't5.img'), size=parse_size(args.size),
+                                sendfile=not args.no_sendfile)
+        usb_container = USBContainer(tcp_nodelay=not args.nagle, max_batch=args.max_batch)
+        usb_container.add_usb_device(SamsungT5(storage=storage, capture_bytes=0, io_threads=args.io_threads,
+                                                write_cache=args.write_cache))
+        args.hid = BenchmarkMouse()
+        usb_container.add_usb_device(args.hid)
+        serve = usb_container.run_async if args.asyncio else usb_container.run
+        threading.Thread(target=serve, kwargs=dict(ip='127.0.0.1', port=args.port), daemon=True).start()
+
+        results = []
+        print(f'{"workload":<22}{"URBs":>9}{"URBs/s":>11}{"MB/s":>9}{"p50 us":>9}{"p99 us":>9}{"CPU s":>8}')
+        for name in args.workloads:
+            summary = run_workload(name, args).summary()
+            results.append(summary)
+            print(f'{name:<22}{summary["urbs"]:>9}{summary["urbs_per_second"]:>11.0f}{summary["mb_per_second"]:>9.1f}'
+                  f'{summary["p50_us"]:>9.0f}{summary["p99_us"]:>9.0f}{summary["cpu_seconds"]:>8.2f}')
+        if args.json:
+            with open(args.json, 'w') as output:
+                json.dump(results, output, indent=2)
+        storage.close()
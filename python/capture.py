@@ -0,0 +1,134 @@
+import threading
+import time
+from collections import deque
+
+from USBIP import BaseStructure, USBIP_DIR_IN
+
+
+LINKTYPE_USB_LINUX_MMAPPED = 220
+
+# usbmon transfer types
+XFER_ISOCHRONOUS = 0
+XFER_INTERRUPT = 1
+XFER_CONTROL = 2
+XFER_BULK = 3
+
+RECORD_OVERHEAD = 160  # Approximate memory used by one record besides its payload
+
+
+class PcapHeader(BaseStructure):
+    _byte_order_ = '<'
+    _fields_ = [
+        ('magic_number', 'I', 0xa1b2c3d4),
+        ('version_major', 'H', 2),
+        ('version_minor', 'H', 4),
+        ('thiszone', 'i', 0),
+        ('sigfigs', 'I', 0),
+        ('snaplen', 'I', 0xffff),
+        ('network', 'I', LINKTYPE_USB_LINUX_MMAPPED)
+    ]
+
+
+class PcapRecordHeader(BaseStructure):
+    _byte_order_ = '<'
+    _fields_ = [
+        ('ts_sec', 'I'),
+        ('ts_usec', 'I'),
+        ('incl_len', 'I'),
+        ('orig_len', 'I')
+    ]
+
+
+class UsbmonPacketHeader(BaseStructure):
+    '''
+    Header of a Linux usbmon binary (mmapped) packet, as read by Wireshark
+    '''
+    _byte_order_ = '<'
+    _fields_ = [
+        ('id', 'Q'),  # URB id, matches a submission with its completion
+        ('type', 'B'),  # 'S'ubmission or 'C'ompletion
+        ('xfer_type', 'B'),
+        ('epnum', 'B'),  # Endpoint number, bit 7 set for IN
+        ('devnum', 'B'),
+        ('busnum', 'H'),
+        ('flag_setup', 'B'),  # 0 if setup holds a setup packet
+        ('flag_data', 'B'),  # 0 if data follows the header
+        ('ts_sec', 'q'),
+        ('ts_usec', 'i'),
+        ('status', 'i'),
+        ('length', 'I'),  # Length of the URB data
+        ('len_cap', 'I'),  # Length of the data that was captured
+        ('setup', '8s'),
+        ('interval', 'i'),
+        ('start_frame', 'i'),
+        ('xfer_flags', 'I'),
+        ('ndesc', 'I', 0)
+    ]
+
+
+class CaptureRing:
+    '''
+    Bounded record of the URBs a device handled. Payloads are truncated to `snaplen` bytes and the
+    oldest records are dropped once the ring holds more than `max_bytes`.
+    '''
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, snaplen=256):
+        self.max_bytes = max_bytes
+        self.snaplen = snaplen
+        self.records = deque()
+        self.size = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def add(self, record):
+        payload = record[-1]
+        with self.lock:
+            self.records.append(record)
+            self.size += RECORD_OVERHEAD + len(payload)
+            while self.size > self.max_bytes and self.records:
+                self.size -= RECORD_OVERHEAD + len(self.records.popleft()[-1])
+                self.dropped += 1
+
+    def record_submit(self, device, usb_req):
+        # OUT payloads are captured on submission, IN payloads on completion
+        data = usb_req.transfer_buffer if usb_req.direction != USBIP_DIR_IN and usb_req.transfer_buffer else b''
+        self.add((time.time(), ord('S'), usb_req.seqnum, device.transfer_type(usb_req.ep, usb_req.direction),
+                  usb_req.ep | (0x80 if usb_req.direction == USBIP_DIR_IN else 0), device.devnum, device.busnum,
+                  bytes(usb_req.setup) if usb_req.ep == 0 else None, 0, usb_req.transfer_buffer_length,
+                  usb_req.interval, usb_req.flags, bytes(data[:self.snaplen])))
+
+    def record_complete(self, device, usb_req, data, length, status):
+        data = data if usb_req.direction == USBIP_DIR_IN and data else b''
+        self.add((time.time(), ord('C'), usb_req.seqnum, device.transfer_type(usb_req.ep, usb_req.direction),
+                  usb_req.ep | (0x80 if usb_req.direction == USBIP_DIR_IN else 0), device.devnum, device.busnum,
+                  None, status, length, usb_req.interval, usb_req.flags, bytes(data[:self.snaplen])))
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.records)
+
+
+def export_pcap(path, rings):
+    '''
+    Writes the records of one or more CaptureRings, merged by time, to a usbmon pcap file
+    '''
+    records = sorted((record for ring in rings for record in ring.snapshot()), key=lambda record: record[0])
+    header = UsbmonPacketHeader()
+    record_header = PcapRecordHeader()
+    with open(path, 'wb') as pcap:
+        pcap.write(PcapHeader().pack())
+        for timestamp, event, seqnum, xfer_type, epnum, devnum, busnum, setup, status, length, interval, flags, payload in records:
+            ts_sec, ts_usec = int(timestamp), int((timestamp % 1) * 1000000)
+            carries_data = (event == ord('S')) != bool(epnum & 0x80)  # OUT data on submission, IN data on completion
+            header.init_from_dict(id=(busnum << 40) | (devnum << 32) | seqnum, type=event, xfer_type=xfer_type, epnum=epnum, devnum=devnum,
+                                  busnum=busnum, flag_setup=0 if setup is not None else ord('-'),
+                                  flag_data=0 if payload else ord('<' if epnum & 0x80 else '>'),
+                                  ts_sec=ts_sec, ts_usec=ts_usec, status=status, length=length,
+                                  len_cap=len(payload), setup=setup or b'', interval=interval,
+                                  start_frame=0, xfer_flags=flags)
+            record_header.init_from_dict(ts_sec=ts_sec, ts_usec=ts_usec,
+                                         incl_len=header.size() + len(payload),
+                                         orig_len=header.size() + (length if carries_data else 0))
+            pcap.write(record_header.pack())
+            pcap.write(header.pack())
+            pcap.write(payload)
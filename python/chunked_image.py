@@ -0,0 +1,321 @@
+import argparse
+import logging
+import mmap
+import os
+import threading
+import uuid
+import zlib
+from collections import OrderedDict
+
+from USBIP import BaseStructure, FileRegion
+from storage import BlockStorage, MmapDiskImage, parse_size
+
+
+log = logging.getLogger('usbip.storage.chunked')
+
+CHUNKED_MAGIC = b'T5CHUNKS'
+OVERLAY_MAGIC = b'T5OVRLAY'
+CHUNKED_VERSION = 1
+
+CHUNK_COMPRESSED = 0x1
+
+
+class ChunkedHeader(BaseStructure):
+    '''
+    Header of base images and overlays. A base image has a ChunkIndexEntry per chunk at index_offset.
+    An overlay has a slot offset (Q) per chunk there, 0 for chunks still read from the base, and
+    the allocated slots from data_offset on.
+    '''
+    _byte_order_ = '<'
+    _fields_ = [
+        ('magic', '8s', CHUNKED_MAGIC),
+        ('version', 'I', CHUNKED_VERSION),
+        ('block_size', 'I', 512),
+        ('chunk_size', 'I'),
+        ('chunk_count', 'I'),
+        ('image_size', 'Q'),
+        ('index_offset', 'Q'),
+        ('data_offset', 'Q', 0),
+        ('allocated', 'Q', 0),  # overlay slots in use
+        ('image_id', '16s')  # of the base image, overlays check they sit on the one they were made for
+    ]
+
+
+class ChunkIndexEntry(BaseStructure):
+    _byte_order_ = '<'
+    _fields_ = [
+        ('offset', 'Q'),
+        ('length', 'I'),  # 0 for an all-zero chunk, which is not stored
+        ('flags', 'I')
+    ]
+
+
+def write_chunked_image(source, path, chunk_size=256 * 1024, level=6):
+    '''
+    Writes the blocks of `source`, any BlockStorage, as a base image of zlib compressed chunks.
+    All-zero chunks are left out and chunks that do not compress are stored as they are.
+    '''
+    if chunk_size % source.block_size:
+        raise ValueError(f'chunk size {chunk_size} is not a multiple of the {source.block_size} byte blocks')
+    chunk_blocks = chunk_size // source.block_size
+    chunk_count = -(-source.block_count // chunk_blocks)
+    header = ChunkedHeader(block_size=source.block_size, chunk_size=chunk_size, chunk_count=chunk_count,
+                           image_size=source.block_count * source.block_size, image_id=uuid.uuid4().bytes)
+    zero = bytes(chunk_size)
+    entries = []
+    with open(path, 'wb') as output:
+        output.write(bytes(header.size()))
+        for index in range(chunk_count):
+            lba = index * chunk_blocks
+            data = bytes(source.read(lba, min(chunk_blocks, source.block_count - lba)))
+            if data == zero[:len(data)]:
+                entries.append(ChunkIndexEntry(offset=0, length=0, flags=0))
+                continue
+            compressed = zlib.compress(data, level)
+            flags = CHUNK_COMPRESSED
+            if len(compressed) >= len(data):
+                compressed, flags = data, 0
+            entries.append(ChunkIndexEntry(offset=output.tell(), length=len(compressed), flags=flags))
+            output.write(compressed)
+        header.index_offset = output.tell()
+        for entry in entries:
+            output.write(entry.pack())
+        output.seek(0)
+        output.write(header.pack())
+    return header
+
+
+class BaseImage:
+    '''
+    Memory-mapped, read-only base image. Decompressed chunks are kept in an LRU of at most
+    `cache_bytes`, shared by every overlay on the image. Open it with open_base to share it.
+    '''
+
+    def __init__(self, path, cache_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.mapping = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mapping)
+        self.header = ChunkedHeader()
+        self.header.unpack_from(self.mapping)
+        if self.header.magic != CHUNKED_MAGIC or self.header.version != CHUNKED_VERSION:
+            raise ValueError(f'{path} is not a version {CHUNKED_VERSION} chunked image')
+        self.entry = ChunkIndexEntry()._codec().struct
+        self.cache_bytes = cache_bytes
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()  # chunk index -> decompressed bytes, least recently used first
+        self.cached_bytes = 0
+
+    def chunk(self, index):
+        '''
+        Returns (data, cached) for a chunk, data is None for an all-zero chunk
+        '''
+        offset, length, flags = self.entry.unpack_from(self.mapping, self.header.index_offset + index * self.entry.size)
+        if not length:
+            return None, True
+        if not flags & CHUNK_COMPRESSED:
+            return self.view[offset:offset + length], True
+        with self.lock:
+            data = self.cache.get(index)
+            if data is not None:
+                self.cache.move_to_end(index)
+                return data, True
+        # zlib releases the GIL, other chunks are served meanwhile
+        data = zlib.decompress(self.view[offset:offset + length])
+        with self.lock:
+            if index not in self.cache:
+                self.cache[index] = data
+                self.cached_bytes += len(data)
+                while self.cached_bytes > self.cache_bytes:
+                    _, evicted = self.cache.popitem(last=False)
+                    self.cached_bytes -= len(evicted)
+        return data, False
+
+
+base_images_lock = threading.Lock()
+base_images = {}  # real path -> BaseImage
+
+
+def open_base(path, cache_bytes=64 * 1024 * 1024):
+    '''
+    The BaseImage of `path`, opened once per process however many overlays use it
+    '''
+    key = os.path.realpath(path)
+    with base_images_lock:
+        base = base_images.get(key)
+        if base is None:
+            base = base_images[key] = BaseImage(path, cache_bytes)
+        return base
+
+
+class ChunkedImage(BlockStorage):
+    '''
+    Copy-on-write overlay on a chunked base image, or on nothing but zeros without one (then `size`
+    sets the size of a new overlay). The first write to a chunk gives it a slot in the overlay file
+    holding the whole chunk, uncompressed so later writes go straight to it. Chunks without a slot
+    are read from the base. The overlay is created sparse if missing. Without an overlay path,
+    the base is served read-only.
+    '''
+
+    def __init__(self, path, base=None, size=None, cache_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.base = open_base(base, cache_bytes) if isinstance(base, str) else base
+        self.lock = threading.Lock()
+        self.counters = dict(chunk_hits=0, chunk_misses=0)
+        self.fd = None
+        if path is None:
+            if self.base is None:
+                raise ValueError('a chunked image needs an overlay, a base or both')
+            self.header = self.base.header
+            self.read_only = True
+        elif os.path.exists(path):
+            self.open_overlay(path)
+        else:
+            self.create_overlay(path, size)
+        self.block_size = self.header.block_size
+        self.chunk_size = self.header.chunk_size
+
+    def create_overlay(self, path, size):
+        if self.base is not None:
+            base = self.base.header
+            header = ChunkedHeader(magic=OVERLAY_MAGIC, block_size=base.block_size, chunk_size=base.chunk_size,
+                                   chunk_count=base.chunk_count, image_size=base.image_size, image_id=base.image_id)
+        elif size is not None:
+            chunk_size = 256 * 1024
+            size -= size % 512
+            header = ChunkedHeader(magic=OVERLAY_MAGIC, chunk_size=chunk_size, chunk_count=-(-size // chunk_size),
+                                   image_size=size, image_id=bytes(16))
+        else:
+            raise ValueError(f'{path} does not exist, a new overlay needs a base or a size')
+        header.index_offset = header.size()
+        index_end = header.index_offset + header.chunk_count * 8
+        header.data_offset = -(-index_end // mmap.PAGESIZE) * mmap.PAGESIZE
+        with open(path, 'wb') as output:
+            output.write(header.pack())
+            output.truncate(header.data_offset)  # The index is a hole until chunks get slots
+        self.open_overlay(path)
+
+    def open_overlay(self, path):
+        self.fd = os.open(path, os.O_RDWR)
+        self.header = ChunkedHeader()
+        self.header.unpack(os.pread(self.fd, self.header.size(), 0))
+        if self.header.magic != OVERLAY_MAGIC or self.header.version != CHUNKED_VERSION:
+            raise ValueError(f'{path} is not a version {CHUNKED_VERSION} chunked image overlay')
+        expected = self.base.header.image_id if self.base is not None else bytes(16)
+        if self.header.image_id != expected:
+            raise ValueError(f'{path} was made for another base image')
+        # Header and index, the slots are read and written with pread and pwrite
+        self.mapping = mmap.mmap(self.fd, self.header.data_offset)
+        self.read_only = False
+
+    @property
+    def block_count(self):
+        return self.header.image_size // self.block_size
+
+    def pieces(self, offset, length):
+        # (chunk index, offset in the chunk, length, bytes before it) covering the byte range
+        done = 0
+        while done < length:
+            index, start = divmod(offset + done, self.chunk_size)
+            part = min(self.chunk_size - start, length - done)
+            yield index, start, part, done
+            done += part
+
+    def slot(self, index):
+        if self.fd is None:
+            return 0
+        entry = self.header.index_offset + index * 8
+        return int.from_bytes(self.mapping[entry:entry + 8], 'little')
+
+    def base_chunk(self, index):
+        if self.base is None:
+            return None
+        data, cached = self.base.chunk(index)
+        with self.base.lock:  # Counted from every storage thread
+            self.counters['chunk_hits' if cached else 'chunk_misses'] += 1
+        return data
+
+    def read(self, lba, count):
+        result = bytearray(count * self.block_size)
+        view = memoryview(result)
+        for index, start, length, done in self.pieces(lba * self.block_size, len(result)):
+            slot = self.slot(index)
+            if slot:
+                os.preadv(self.fd, [view[done:done + length]], slot + start)
+            else:
+                data = self.base_chunk(index)
+                if data is not None:
+                    view[done:done + length] = data[start:start + length]
+        return result
+
+    def read_region(self, lba, count):
+        offset, length = lba * self.block_size, count * self.block_size
+        index, start = divmod(offset, self.chunk_size)
+        if start + length > self.chunk_size:
+            return None
+        slot = self.slot(index)
+        return FileRegion(self.fd, slot + start, length) if slot else None
+
+    def write(self, lba, data):
+        data = memoryview(data)
+        with self.lock:
+            for index, start, length, done in self.pieces(lba * self.block_size, len(data)):
+                slot = self.slot(index)
+                if slot:
+                    os.pwrite(self.fd, data[done:done + length], slot + start)
+                    continue
+                slot = self.allocate(index, copy=length < self.chunk_size)
+                os.pwrite(self.fd, data[done:done + length], slot + start)
+                # Published once the data is in place, reads until then get the base
+                entry = self.header.index_offset + index * 8
+                self.mapping[entry:entry + 8] = slot.to_bytes(8, 'little')
+
+    def allocate(self, index, copy):
+        # Counted in the header first, a crash leaks the slot instead of handing it out twice
+        slot = self.header.data_offset + self.header.allocated * self.chunk_size
+        self.header.allocated += 1
+        self.header.pack_into(self.mapping)
+        os.ftruncate(self.fd, slot + self.chunk_size)
+        if copy:
+            data = self.base_chunk(index)
+            if data is not None:
+                os.pwrite(self.fd, data, slot)
+        return slot
+
+    def flush(self):
+        if self.fd is not None:
+            self.mapping.flush()
+            os.fsync(self.fd)
+
+    def snapshot(self):
+        counters = dict(self.counters)
+        if self.fd is not None:
+            counters['allocated_chunks'] = self.header.allocated
+        return counters
+
+    def close(self):
+        if self.fd is not None:
+            self.flush()
+            self.mapping.close()
+            os.close(self.fd)
+            self.fd = None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a raw disk image, or an overlay and its base, as a chunked base image')
+    parser.add_argument('source', help='raw image, or overlay with --base')
+    parser.add_argument('output', help='chunked image to write')
+    parser.add_argument('--base', help='base image of the source overlay')
+    parser.add_argument('--chunk-size', type=parse_size, default='256K', help='bytes per chunk')
+    parser.add_argument('--level', type=int, default=6, help='zlib compression level')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.base:
+        source = ChunkedImage(args.source, args.base)
+    else:
+        source = MmapDiskImage(args.source, read_only=True)
+    header = write_chunked_image(source, args.output, args.chunk_size, args.level)
+    source.close()
+    log.info('wrote %d chunks of %d bytes, %d bytes on disk', header.chunk_count, header.chunk_size,
+             os.path.getsize(args.output))
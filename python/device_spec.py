@@ -0,0 +1,350 @@
+import hashlib
+import json
+import logging
+import os
+import struct
+import tempfile
+import threading
+
+from USBIP import (DeviceDescriptor, DeviceConfiguration, DeviceQualifierDescriptor, InterfaceDescriptor,
+                   EndpointDescriptor, parse_configuration, endpoint_types)
+
+
+log = logging.getLogger('usbip.device.spec')
+
+SPEC_FORMAT = 2  # Part of the spec hash, bump it when the compiled form changes so old cache entries are ignored
+
+CACHE_DIR = os.environ.get('USBIP_DEVICE_CACHE') or os.path.join(os.path.expanduser('~'), '.cache', 'usbip-devices')
+
+SPEC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'devices')
+
+FIELD_BITS = {'B': 8, 'H': 16}
+
+
+class DeviceSpecError(ValueError):
+    pass
+
+
+def spec_path(name):
+    '''
+    Path of a device spec shipped in the devices directory
+    '''
+    return os.path.join(SPEC_DIR, name)
+
+
+def number(where, value, bits):
+    # Integers, or strings such as "0x04e8" for fields that read better in hex
+    if isinstance(value, str):
+        try:
+            value = int(value, 0)
+        except ValueError:
+            raise DeviceSpecError(f'{where}: {value!r} is not a number') from None
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise DeviceSpecError(f'{where}: {value!r} is not a number')
+    if not 0 <= value < 1 << bits:
+        raise DeviceSpecError(f'{where}: {value} does not fit in {bits} bits')
+    return value
+
+
+def hex_bytes(where, value):
+    '''
+    Bytes written as hex, whitespace is ignored and `#` starts a comment up to the end of the string
+    '''
+    if not isinstance(value, str):
+        raise DeviceSpecError(f'{where}: expected a hex string')
+    try:
+        return bytes.fromhex(''.join(value.split('#', 1)[0].split()))
+    except ValueError:
+        raise DeviceSpecError(f'{where}: {value!r} is not hex') from None
+
+
+def descriptor_list(where, values):
+    # Class specific descriptors, each one a hex string starting with its bLength
+    data = bytearray()
+    for i, value in enumerate(values):
+        descriptor = hex_bytes(f'{where}[{i}]', value)
+        if len(descriptor) < 2 or descriptor[0] != len(descriptor):
+            raise DeviceSpecError(f'{where}[{i}]: bLength {descriptor[0] if descriptor else None} '
+                                  f'does not match the {len(descriptor)} bytes given')
+        data.extend(descriptor)
+    return bytes(data)
+
+
+def structure_fields(where, values, structure_class, computed, extra=()):
+    '''
+    Checks the fields of one descriptor against its BaseStructure layout. Fields in `computed` are
+    filled in by the compiler, keys in `extra` are nested parts of the spec handled by the caller.
+    '''
+    if not isinstance(values, dict):
+        raise DeviceSpecError(f'{where}: expected an object')
+    layout = {field[0]: field for field in structure_class._fields_ if field[0] not in computed}
+    for name in values:
+        if name not in layout and name not in extra:
+            raise DeviceSpecError(f'{where}: unknown field {name}')
+    fields = {}
+    for name, field in layout.items():
+        if name in values:
+            fields[name] = number(f'{where}.{name}', values[name], FIELD_BITS[field[1]])
+        elif len(field) > 2:
+            fields[name] = field[2]
+        else:
+            raise DeviceSpecError(f'{where}: missing {name}')
+    return fields
+
+
+def check_string_index(where, index, strings):
+    if index > len(strings):
+        raise DeviceSpecError(f'{where}: string {index} is not defined, there are {len(strings)} strings')
+
+
+def compile_endpoint(where, values):
+    fields = structure_fields(where, values, EndpointDescriptor, ('bLength', 'bDescriptorType'), ('class_descriptors',))
+    address = fields['bEndpointAddress']
+    if address & 0x70 or not address & 0x0F:
+        raise DeviceSpecError(f'{where}: bEndpointAddress {address:#04x} is not an endpoint 1-15 address')
+    transfer_type = fields['bmAttributes'] & 0x3
+    if transfer_type == 0:
+        raise DeviceSpecError(f'{where}: control endpoints other than ep0 are not supported')
+    if transfer_type != 1 and fields['bmAttributes'] & 0x3C:
+        raise DeviceSpecError(f'{where}: bmAttributes synchronization and usage bits are for isochronous endpoints')
+    size, transactions = fields['wMaxPacketSize'] & 0x7FF, (fields['wMaxPacketSize'] >> 11) & 0x3
+    if fields['wMaxPacketSize'] >> 13 or size > 1024 or transactions > 2:
+        raise DeviceSpecError(f'{where}: invalid wMaxPacketSize {fields["wMaxPacketSize"]:#06x}')
+    if transactions and transfer_type == 2:
+        raise DeviceSpecError(f'{where}: bulk endpoints have no additional transactions per microframe')
+    if transfer_type in (1, 3) and not fields['bInterval']:
+        raise DeviceSpecError(f'{where}: {"isochronous" if transfer_type == 1 else "interrupt"} endpoints need a bInterval')
+    if transfer_type == 1 and fields['bInterval'] > 16:
+        raise DeviceSpecError(f'{where}: isochronous bInterval {fields["bInterval"]} is above 16')
+    return EndpointDescriptor(**fields).pack() + descriptor_list(f'{where}.class_descriptors',
+                                                                  values.get('class_descriptors', []))
+
+
+def compile_hid(where, values, entries):
+    # HID class descriptor, the report descriptor is served as its own GET_DESCRIPTOR entry
+    if not isinstance(values, dict):
+        raise DeviceSpecError(f'{where}: expected an object')
+    for name in values:
+        if name not in ('bcdHID', 'bCountryCode', 'report'):
+            raise DeviceSpecError(f'{where}: unknown field {name}')
+    if 'bcdHID' not in values or 'report' not in values:
+        raise DeviceSpecError(f'{where}: needs bcdHID and report')
+    if (0x21, 0, 0) in entries:
+        raise DeviceSpecError(f'{where}: only one HID interface is supported')
+    report = b''.join(hex_bytes(f'{where}.report[{i}]', item) for i, item in enumerate(values['report']))
+    if len(report) > 0xFFFF:
+        raise DeviceSpecError(f'{where}: report descriptor is longer than 65535 bytes')
+    hid = struct.pack('<BBHBBBH', 9, 0x21, number(f'{where}.bcdHID', values['bcdHID'], 16),
+                      number(f'{where}.bCountryCode', values.get('bCountryCode', 0), 8), 1, 0x22, len(report))
+    entries[(0x21, 0, 0)] = hid  # HID Descriptor
+    entries[(0x22, 0, 0)] = report  # Report Descriptor
+    return hid
+
+
+def compile_configuration(where, values, strings, entries):
+    fields = structure_fields(where, values, DeviceConfiguration,
+                              ('bLength', 'bDescriptorType', 'wTotalLength', 'bNumInterfaces'), ('interfaces',))
+    if not fields['bConfigurationValue']:
+        raise DeviceSpecError(f'{where}: bConfigurationValue 0 means unconfigured')
+    check_string_index(f'{where}.iConfiguration', fields['iConfiguration'], strings)
+    interfaces = values.get('interfaces')
+    if not interfaces:
+        raise DeviceSpecError(f'{where}: needs at least one interface')
+    body = bytearray()
+    for interface_number, alternates in enumerate(interfaces):
+        if not alternates:
+            raise DeviceSpecError(f'{where}.interfaces[{interface_number}]: needs at least one alternate setting')
+        for alternate_setting, alternate in enumerate(alternates):
+            path = f'{where}.interfaces[{interface_number}][{alternate_setting}]'
+            alternate_fields = structure_fields(path, alternate, InterfaceDescriptor,
+                                                ('bLength', 'bDescriptorType', 'bInterfaceNumber', 'bAlternateSetting',
+                                                 'bNumEndpoints'), ('endpoints', 'class_descriptors', 'hid'))
+            check_string_index(f'{path}.iInterface', alternate_fields['iInterface'], strings)
+            endpoints = alternate.get('endpoints', [])
+            addresses = [number(f'{path}.endpoints[{i}].bEndpointAddress', endpoint.get('bEndpointAddress'), 8)
+                         for i, endpoint in enumerate(endpoints)]
+            if len(set(addresses)) != len(addresses):
+                raise DeviceSpecError(f'{path}: endpoint addresses are not unique')
+            body.extend(InterfaceDescriptor(bInterfaceNumber=interface_number, bAlternateSetting=alternate_setting,
+                                            bNumEndpoints=len(endpoints), **alternate_fields).pack())
+            if 'hid' in alternate:
+                body.extend(compile_hid(f'{path}.hid', alternate['hid'], entries))
+            body.extend(descriptor_list(f'{path}.class_descriptors', alternate.get('class_descriptors', [])))
+            for i, endpoint in enumerate(endpoints):
+                body.extend(compile_endpoint(f'{path}.endpoints[{i}]', endpoint))
+    total_length = DeviceConfiguration().size() + len(body)
+    if total_length > 0xFFFF:
+        raise DeviceSpecError(f'{where}: wTotalLength {total_length} is above 65535')
+    return DeviceConfiguration(wTotalLength=total_length, bNumInterfaces=len(interfaces), **fields).pack() + bytes(body)
+
+
+def compile_bos(where, capabilities):
+    data = descriptor_list(where, capabilities)
+    if len(capabilities) > 0xFF or 5 + len(data) > 0xFFFF:
+        raise DeviceSpecError(f'{where}: too many device capabilities')
+    return struct.pack('<BBHB', 5, 0x0F, 5 + len(data), len(capabilities)) + data
+
+
+def compile_spec(spec):
+    '''
+    Validates a device spec and packs its descriptors. Lengths, counts, interface numbers and
+    alternate settings are computed. Returns plain data, see CompiledDevice.
+    '''
+    if not isinstance(spec, dict):
+        raise DeviceSpecError('a device spec is a JSON object')
+    for name in spec:
+        if name not in ('device', 'languages', 'strings', 'device_qualifier', 'bos', 'configurations'):
+            raise DeviceSpecError(f'unknown field {name}')
+    strings = spec.get('strings', [])
+    languages = [number(f'languages[{i}]', language, 16) for i, language in enumerate(spec.get('languages', []))]
+    if strings and not languages:
+        raise DeviceSpecError('strings need at least one language')
+    entries = {}
+    if languages:
+        # String Index 0 - List of supported languages
+        entries[(0x03, 0, 0)] = bytes([2 + 2 * len(languages), 0x03]) + struct.pack(f'<{len(languages)}H', *languages)
+    for index, string in enumerate(strings, 1):
+        if not isinstance(string, str):
+            raise DeviceSpecError(f'strings[{index - 1}]: expected a string')
+        encoded = string.encode('utf-16-le')
+        if len(encoded) > 253:
+            raise DeviceSpecError(f'strings[{index - 1}]: longer than a string descriptor can hold')
+        for language in languages:
+            entries[(0x03, index, language)] = bytes([2 + len(encoded), 0x03]) + encoded
+
+    device = structure_fields('device', spec.get('device'), DeviceDescriptor,
+                              ('bLength', 'bDescriptorType', 'bNumConfigurations'))
+    if device['bMaxPacketSize0'] not in (8, 16, 32, 64):
+        raise DeviceSpecError(f'device.bMaxPacketSize0: {device["bMaxPacketSize0"]} is not 8, 16, 32 or 64')
+    for name in ('iManufacturer', 'iProduct', 'iSerialNumber'):
+        check_string_index(f'device.{name}', device[name], strings)
+
+    configurations = spec.get('configurations')
+    if not configurations:
+        raise DeviceSpecError('needs at least one configuration')
+    blobs = [compile_configuration(f'configurations[{i}]', configuration, strings, entries)
+             for i, configuration in enumerate(configurations)]
+    values = [blob[5] for blob in blobs]
+    if len(set(values)) != len(values):
+        raise DeviceSpecError('bConfigurationValue is not unique')
+
+    if spec.get('device_qualifier'):
+        if device['bcdUSB'] < 0x0200:
+            raise DeviceSpecError('device_qualifier: only USB 2.0 and later devices have one')
+        entries[(0x06, 0, 0)] = DeviceQualifierDescriptor(
+            bcdUSB=device['bcdUSB'], bDeviceClass=device['bDeviceClass'], bDeviceSubClass=device['bDeviceSubClass'],
+            bDeviceProtocol=device['bDeviceProtocol'], bMaxPacketSize0=device['bMaxPacketSize0'],
+            bNumConfigurations=len(blobs)).pack()
+    if 'bos' in spec:
+        entries[(0x0F, 0, 0)] = compile_bos('bos', spec['bos'])
+
+    return dict(device=DeviceDescriptor(bNumConfigurations=len(blobs), **device).pack(), configurations=blobs,
+                entries=entries, strings=[None] + list(strings), languages=languages)
+
+
+class CompiledDevice:
+    '''
+    Descriptors of a compiled spec. USBDevice subclasses that set it as `compiled` take their device
+    descriptor and configurations from it, and serve the packed bytes without packing them again.
+    '''
+
+    def __init__(self, compiled, spec_hash):
+        self.spec_hash = spec_hash
+        self.device_descriptor = DeviceDescriptor()
+        self.device_descriptor.unpack(compiled['device'])
+        self.raw_configuration = b''.join(compiled['configurations'])
+        self.configurations = [parse_configuration(blob) for blob in compiled['configurations']]
+        self.endpoint_types = endpoint_types(self.configurations)
+        self.entries = compiled['entries']  # GET_DESCRIPTOR responses other than device and configuration
+        self.strings = compiled['strings']  # by string index, index 0 is None
+        self.languages = compiled['languages']
+
+    def endpoint(self, address):
+        '''
+        EndpointDescriptor of `address` in the first configuration, e.g. 0x81 for IN endpoint 1
+        '''
+        for interface in self.configurations[0].interfaces:
+            for interface_alternative in interface:
+                for endpoint in interface_alternative.endpoints:
+                    if endpoint.bEndpointAddress == address:
+                        return endpoint
+        raise KeyError(f'no endpoint {address:#04x}')
+
+
+def spec_hash(spec):
+    canonical = json.dumps(spec, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(f'{SPEC_FORMAT}:{canonical}'.encode('utf-8')).hexdigest()
+
+
+def encode_compiled(compiled):
+    # The result of compile_spec as JSON, descriptors as hex strings
+    return dict(device=compiled['device'].hex(),
+                configurations=[blob.hex() for blob in compiled['configurations']],
+                entries=[[*key, data.hex()] for key, data in compiled['entries'].items()],
+                strings=compiled['strings'], languages=compiled['languages'])
+
+
+def decode_compiled(values):
+    # Raises on anything encode_compiled would not have written
+    strings = values['strings']
+    if strings[0] is not None or not all(isinstance(string, str) for string in strings[1:]):
+        raise ValueError('malformed strings')
+    return dict(device=bytes.fromhex(values['device']),
+                configurations=[bytes.fromhex(blob) for blob in values['configurations']],
+                entries={(int(kind), int(index), int(language)): bytes.fromhex(data)
+                         for kind, index, language, data in values['entries']},
+                strings=strings, languages=[int(language) for language in values['languages']])
+
+
+def read_cache(cache_dir, key):
+    # JSON and hex, so a cache directory others can write to cannot run code in the emulator
+    try:
+        with open(os.path.join(cache_dir, f'{key}.json')) as cache_file:
+            return CompiledDevice(decode_compiled(json.load(cache_file)), key)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        log.warning('ignoring unreadable device spec cache entry %s', key, exc_info=True)
+        return None
+
+
+def write_cache(cache_dir, key, compiled):
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Written aside and renamed, so concurrent readers never see half a file
+        with tempfile.NamedTemporaryFile('w', dir=cache_dir, suffix='.tmp', delete=False) as cache_file:
+            json.dump(encode_compiled(compiled), cache_file)
+        os.replace(cache_file.name, os.path.join(cache_dir, f'{key}.json'))
+    except OSError:
+        log.warning('could not cache device spec in %s', cache_dir, exc_info=True)
+
+
+compiled_lock = threading.Lock()
+compiled_specs = {}  # spec hash -> CompiledDevice, shared by every device built from the same spec
+
+
+def load_device_spec(path, cache_dir=CACHE_DIR):
+    '''
+    Loads a JSON device spec. The compiled form is cached in `cache_dir`, keyed by the spec hash,
+    and kept in memory, so only the first device built from a spec validates and packs it.
+    `cache_dir=None` turns the disk cache off.
+    '''
+    with open(path) as spec_file:
+        spec = json.load(spec_file)
+    key = spec_hash(spec)
+    with compiled_lock:
+        device = compiled_specs.get(key)
+    if device is not None:
+        return device
+    device = read_cache(cache_dir, key) if cache_dir is not None else None
+    if device is None:
+        try:
+            compiled = compile_spec(spec)
+        except DeviceSpecError as error:
+            raise DeviceSpecError(f'{path}: {error}') from None
+        log.debug('compiled device spec %s (%s)', path, key)
+        if cache_dir is not None:
+            write_cache(cache_dir, key, compiled)
+        device = CompiledDevice(compiled, key)
+    with compiled_lock:
+        return compiled_specs.setdefault(key, device)
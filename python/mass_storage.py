@@ -0,0 +1,337 @@
+import logging
+import struct
+import threading
+from collections import deque
+
+from USBIP import BaseStructure, USBIP_DIR_OUT
+import scsi
+
+
+log = logging.getLogger('usbip.device.bot')
+
+CBW_SIGNATURE = 0x43425355  # 'USBC'
+CSW_SIGNATURE = 0x53425355  # 'USBS'
+
+CSW_PASSED = 0x00
+CSW_FAILED = 0x01
+CSW_PHASE_ERROR = 0x02
+
+# UAS information unit ids
+IU_ID_COMMAND = 0x01
+IU_ID_SENSE = 0x03
+IU_ID_RESPONSE = 0x04
+IU_ID_TASK_MGMT = 0x05
+IU_ID_READ_READY = 0x06
+IU_ID_WRITE_READY = 0x07
+
+# UAS task management functions and response codes
+TMF_ABORT_TASK = 0x01
+TMF_ABORT_TASK_SET = 0x02
+TMF_CLEAR_TASK_SET = 0x04
+TMF_LOGICAL_UNIT_RESET = 0x08
+TMF_IT_NEXUS_RESET = 0x10
+RC_TMF_COMPLETE = 0x00
+RC_INVALID_INFO_UNIT = 0x02
+RC_TMF_NOT_SUPPORTED = 0x04
+
+
+class CommandBlockWrapper(BaseStructure):
+    _byte_order_ = '<'
+    _fields_ = [
+        ('dCBWSignature', 'I'),
+        ('dCBWTag', 'I'),
+        ('dCBWDataTransferLength', 'I'),
+        ('bmCBWFlags', 'B'),  # Bit 7 set: data flows IN, from device to host
+        ('bCBWLUN', 'B'),
+        ('bCBWCBLength', 'B'),
+        ('CBWCB', '16s')
+    ]
+
+
+class CommandStatusWrapper(BaseStructure):
+    _byte_order_ = '<'
+    _fields_ = [
+        ('dCSWSignature', 'I', CSW_SIGNATURE),
+        ('dCSWTag', 'I'),
+        ('dCSWDataResidue', 'I'),
+        ('bCSWStatus', 'B')
+    ]
+
+
+class BulkOnlyTransport:
+    '''
+    USB Mass Storage Bulk-Only Transport. CBWs and data-out arrive on the bulk OUT endpoint, data-in
+    and CSWs leave on the bulk IN endpoint. IN URBs are parked on the device until there is
+    something to send. Commands whose storage I/O is still running complete from the disk's
+    executor threads, so the state is guarded by a lock.
+    '''
+
+    def __init__(self, device, disk, in_ep=1):
+        self.device = device
+        self.disk = disk
+        self.in_ep = in_ep
+        self.cbw = CommandBlockWrapper()
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.command = None  # SCSI command in its data-out phase
+            self.running = None  # SCSI command waiting for its storage I/O
+            self.tag = 0
+            self.expected = 0  # dCBWDataTransferLength of the current command
+            self.received = 0
+            self.in_queue = deque()  # data-in phases and CSWs waiting for IN URBs
+
+    def handle_data(self, usb_req):
+        with self.lock:
+            if usb_req.direction == USBIP_DIR_OUT:
+                if self.command is None:
+                    self.handle_cbw(usb_req.transfer_buffer)
+                else:
+                    self.handle_data_out(usb_req.transfer_buffer)
+                self.device.ack_out(usb_req)
+            else:
+                self.device.park_urb(usb_req)
+            self.pump()
+
+    def handle_cbw(self, data):
+        if len(data) != self.cbw.size():
+            log.warning('ignoring %d byte transfer outside of a data phase', len(data))
+            return
+        cbw = self.cbw
+        cbw.unpack(data)
+        if cbw.dCBWSignature != CBW_SIGNATURE:
+            log.warning('invalid CBW signature %x', cbw.dCBWSignature)
+            return
+        self.tag = cbw.dCBWTag
+        self.expected = cbw.dCBWDataTransferLength
+        command = self.disk.execute(cbw.CBWCB[:cbw.bCBWCBLength])
+        if command.data_out_length and (cbw.bmCBWFlags & 0x80 or self.expected == 0):
+            self.queue_csw(CSW_PHASE_ERROR, self.expected)
+            return
+        if self.expected and not cbw.bmCBWFlags & 0x80:
+            # Data-out phase. If the command failed the data is still accepted, and dropped.
+            self.command = command
+            self.received = 0
+            return
+        self.running = command
+        self.disk.when_complete(command, self.data_in_ready)
+
+    def data_in_ready(self, command):
+        with self.lock:
+            if command is not self.running:
+                return  # Reset while the storage was busy
+            self.running = None
+            if self.expected:
+                data_in = command.data_in if command.data_in is not None else b''
+                data_in = data_in[:self.expected]
+                self.in_queue.append(data_in)  # A short or empty data phase ends the data stage
+                residue = self.expected - len(data_in)
+            else:
+                residue = self.expected
+            self.queue_status(command, residue)
+            self.pump()
+
+    def handle_data_out(self, data):
+        data = data[:self.expected - self.received]
+        self.received += len(data)
+        command = self.command
+        if command.data_out_received < command.data_out_length:
+            self.disk.write_data(command, data)
+        if self.received >= self.expected:
+            self.command = None
+            self.running = command
+            self.disk.when_complete(command, self.data_out_done)
+
+    def data_out_done(self, command):
+        with self.lock:
+            if command is not self.running:
+                return
+            self.running = None
+            self.queue_status(command, self.expected - command.data_out_received)
+            self.pump()
+
+    def queue_status(self, command, residue):
+        if command.status == scsi.GOOD:
+            self.queue_csw(CSW_PASSED, residue)
+        else:
+            self.disk.sense = command.sense  # For the REQUEST SENSE the host sends next
+            self.queue_csw(CSW_FAILED, residue)
+
+    def queue_csw(self, status, residue):
+        self.in_queue.append(CommandStatusWrapper(dCSWTag=self.tag, dCSWDataResidue=residue, bCSWStatus=status).pack())
+
+    def pump(self):
+        # Hands queued data-in phases and CSWs to parked IN URBs, one queue entry per URB at most
+        while self.in_queue:
+            usb_req = self.device.pop_parked_urb(self.in_ep)
+            if usb_req is None:
+                return
+            data = self.in_queue[0]
+            length = usb_req.transfer_buffer_length
+            if len(data) > length:
+                self.in_queue[0] = data[length:]
+                data = data[:length]
+            else:
+                self.in_queue.popleft()
+            self.device.send_usb_ret(usb_req, data, len(data))
+
+
+class UASCommand:
+    def __init__(self, tag, command):
+        self.tag = tag
+        self.command = command
+        self.data_in = None  # set once the command's storage I/O is done
+        self.data_out_remaining = command.data_out_length
+
+
+class UASTransport:
+    '''
+    USB Attached SCSI without streams. Command IUs arrive on the command pipe and are tagged, so
+    any number of commands can be outstanding. Commands with a data phase take turns on the data
+    pipes: the device announces each one with a READ READY or WRITE READY IU on the status pipe,
+    and finishes every command with a SENSE IU carrying its tag. Reads join the data queue once
+    their storage I/O is done, so a slow read does not hold up the commands behind it.
+    '''
+
+    def __init__(self, device, disk, command_ep=4, status_ep=3, data_in_ep=1, data_out_ep=2):
+        self.device = device
+        self.disk = disk
+        self.command_ep = command_ep
+        self.status_ep = status_ep
+        self.data_in_ep = data_in_ep
+        self.data_out_ep = data_out_ep
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.commands = {}  # tag -> UASCommand
+            self.data_queue = deque()  # commands waiting for their data phase
+            self.active = None  # command in its data phase
+            self.status_queue = deque()  # IUs waiting for status pipe URBs
+
+    def handle_data(self, usb_req):
+        with self.lock:
+            if usb_req.direction == USBIP_DIR_OUT:
+                if usb_req.ep == self.command_ep:
+                    self.handle_iu(usb_req.transfer_buffer)
+                elif usb_req.ep == self.data_out_ep:
+                    self.handle_data_out(usb_req.transfer_buffer)
+                self.device.ack_out(usb_req)
+            else:
+                self.device.park_urb(usb_req)
+            self.pump()
+
+    def handle_iu(self, iu):
+        if len(iu) < 16:
+            log.warning('ignoring %d byte IU', len(iu))
+            return
+        tag, = struct.unpack_from('>H', iu, 2)
+        if iu[0] == IU_ID_COMMAND:
+            cdb_length = 16 + (iu[6] & 0xFC)  # additional CDB length is in dwords, in bits 7:2
+            self.queue_command(UASCommand(tag, self.disk.execute(iu[16:16 + cdb_length])))
+        elif iu[0] == IU_ID_TASK_MGMT:
+            self.handle_task_management(tag, iu[4], struct.unpack_from('>H', iu, 6)[0])
+        else:
+            self.status_queue.append(self.response_iu(tag, RC_INVALID_INFO_UNIT))
+
+    def queue_command(self, uas_command):
+        self.commands[uas_command.tag] = uas_command
+        if uas_command.data_out_remaining:
+            self.data_queue.append(uas_command)
+            self.start_data_phase()
+        else:
+            self.disk.when_complete(uas_command.command, lambda command: self.command_ready(uas_command))
+
+    def command_ready(self, uas_command):
+        # Storage I/O of a command without data-out is done
+        with self.lock:
+            if self.commands.get(uas_command.tag) is not uas_command:
+                return  # Aborted or reset meanwhile
+            uas_command.data_in = uas_command.command.data_in
+            if uas_command.data_in:
+                self.data_queue.append(uas_command)
+                self.start_data_phase()
+            else:
+                self.finish(uas_command)
+            self.pump()
+
+    def start_data_phase(self):
+        if self.active is None and self.data_queue:
+            self.active = self.data_queue.popleft()
+            iu_id = IU_ID_READ_READY if self.active.data_in else IU_ID_WRITE_READY
+            self.status_queue.append(struct.pack('>BxH', iu_id, self.active.tag))
+
+    def handle_data_out(self, data):
+        uas_command = self.active
+        if uas_command is None or not uas_command.data_out_remaining:
+            log.warning('ignoring %d bytes of data-out without a WRITE READY', len(data))
+            return
+        data = data[:uas_command.data_out_remaining]
+        self.disk.write_data(uas_command.command, data)
+        uas_command.data_out_remaining -= len(data)
+        if not uas_command.data_out_remaining:
+            self.end_data_phase()
+
+    def end_data_phase(self):
+        uas_command, self.active = self.active, None
+        self.disk.when_complete(uas_command.command, lambda command: self.writes_done(uas_command))
+        self.start_data_phase()
+
+    def writes_done(self, uas_command):
+        with self.lock:
+            if self.commands.get(uas_command.tag) is uas_command:
+                self.finish(uas_command)
+                self.pump()
+
+    def finish(self, uas_command):
+        self.commands.pop(uas_command.tag, None)
+        command = uas_command.command
+        sense = scsi.sense_data(*command.sense) if command.status != scsi.GOOD else b''
+        self.status_queue.append(struct.pack('>BxHHB7xH', IU_ID_SENSE, uas_command.tag, 0, command.status, len(sense)) + sense)
+
+    def response_iu(self, tag, response_code):
+        return struct.pack('>BxH3xB', IU_ID_RESPONSE, tag, response_code)
+
+    def handle_task_management(self, tag, function, task_tag):
+        if function == TMF_ABORT_TASK:
+            self.abort(lambda uas_command: uas_command.tag == task_tag)
+        elif function in (TMF_ABORT_TASK_SET, TMF_CLEAR_TASK_SET, TMF_LOGICAL_UNIT_RESET, TMF_IT_NEXUS_RESET):
+            self.abort(lambda uas_command: True)
+        else:
+            self.status_queue.append(self.response_iu(tag, RC_TMF_NOT_SUPPORTED))
+            return
+        self.status_queue.append(self.response_iu(tag, RC_TMF_COMPLETE))
+
+    def abort(self, matches):
+        # Aborted commands end without a SENSE IU
+        for uas_command in [uas_command for uas_command in self.commands.values() if matches(uas_command)]:
+            del self.commands[uas_command.tag]
+            if uas_command in self.data_queue:
+                self.data_queue.remove(uas_command)
+            if uas_command is self.active:
+                self.active = None
+        self.start_data_phase()
+
+    def pump(self):
+        while self.status_queue:
+            usb_req = self.device.pop_parked_urb(self.status_ep)
+            if usb_req is None:
+                break
+            iu = self.status_queue.popleft()
+            self.device.send_usb_ret(usb_req, iu, len(iu))
+
+        uas_command = self.active
+        while uas_command is not None and uas_command.data_in:
+            usb_req = self.device.pop_parked_urb(self.data_in_ep)
+            if usb_req is None:
+                break
+            data = uas_command.data_in[:usb_req.transfer_buffer_length]
+            uas_command.data_in = uas_command.data_in[len(data):]
+            self.device.send_usb_ret(usb_req, data, len(data))
+            if not uas_command.data_in:
+                self.end_data_phase()
+                self.pump()  # Status and the next READ READY are ready now
+                return
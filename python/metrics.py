@@ -0,0 +1,179 @@
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from USBIP import USBIP_DIR_IN
+
+
+log = logging.getLogger('usbip.metrics')
+
+# ContainerMetrics counter -> (metric name, help)
+CONTAINER_COUNTERS = {
+    'connections': ('usbip_connections_total', 'Client connections accepted'),
+    'device_lists': ('usbip_device_list_requests_total', 'OP_REQ_DEVLIST requests'),
+    'imports': ('usbip_import_requests_total', 'OP_REQ_IMPORT requests'),
+    'failed_imports': ('usbip_import_failures_total', 'OP_REQ_IMPORT requests for an unknown or busy bus id'),
+    'rejected_urbs': ('usbip_rejected_urbs_total', 'URBs for a devid other than the imported device'),
+    'unlinks': ('usbip_unlink_requests_total', 'USBIP_CMD_UNLINK requests'),
+    'send_batches': ('usbip_send_batches_total', 'sendmsg calls carrying queued replies'),
+    'sent_messages': ('usbip_sent_messages_total', 'Replies sent, divided by send batches gives the mean batch size'),
+}
+
+# storage_counters() key -> (metric name, type, help)
+STORAGE_METRICS = {
+    'hits': ('usbip_block_cache_hits_total', 'counter', 'Block cache lookups that found the extent'),
+    'misses': ('usbip_block_cache_misses_total', 'counter', 'Block cache lookups that read the extent from the image'),
+    'evictions': ('usbip_block_cache_evictions_total', 'counter', 'Extents dropped from the block cache'),
+    'write_backs': ('usbip_block_cache_write_backs_total', 'counter', 'Writes of coalesced dirty blocks to the image'),
+    'flushes': ('usbip_block_cache_flushes_total', 'counter', 'Block cache flushes, periodic or SYNCHRONIZE CACHE'),
+    'cached_bytes': ('usbip_block_cache_bytes', 'gauge', 'Bytes held by the block cache'),
+    'dirty_bytes': ('usbip_block_cache_dirty_bytes', 'gauge', 'Bytes written to the block cache but not to the image'),
+    'chunk_hits': ('usbip_chunk_cache_hits_total', 'counter', 'Base image chunks found decompressed or stored raw'),
+    'chunk_misses': ('usbip_chunk_cache_misses_total', 'counter', 'Base image chunks decompressed on a read'),
+    'allocated_chunks': ('usbip_overlay_chunks', 'gauge', 'Chunks copied to the overlay of a chunked image'),
+    'readahead_hits': ('usbip_readahead_hits_total', 'counter', 'Reads served from prefetched blocks'),
+}
+
+
+def labels(**values):
+    return '{' + ','.join(f'{name}="{value}"' for name, value in values.items()) + '}'
+
+
+def endpoint_labels(busid, key):
+    ep, direction = key
+    return dict(busid=busid, ep=ep, direction='in' if direction == USBIP_DIR_IN else 'out')
+
+
+def request_labels(busid, key):
+    return dict(busid=busid, bmRequestType=f'0x{key[0]:02x}', bRequest=f'0x{key[1]:02x}')
+
+
+def histogram_lines(lines, name, label_values, histogram):
+    cumulative = 0
+    for bound, count in zip(histogram.bounds + ('+Inf',), histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{labels(**label_values, le=bound)} {cumulative}')
+    suffix = labels(**label_values) if label_values else ''
+    lines.append(f'{name}_sum{suffix} {histogram.sum}')
+    lines.append(f'{name}_count{suffix} {histogram.count}')
+
+
+def collect(container):
+    '''
+    Snapshot of the metrics of a container and of the devices it owns, as plain picklable data
+    '''
+    devices = [(usb_dev.busid, usb_dev.busid in container.attached,
+                dict(usb_dev.metrics.snapshot(), storage=usb_dev.storage_counters()))
+               for usb_dev in container.usb_devices if container.owns(usb_dev.busid)]
+    return dict(counters=container.metrics.snapshot(), devices=devices)
+
+
+def busid_order(device):
+    return tuple(int(part) for part in device[0].split('-'))
+
+
+def merge(snapshots):
+    '''
+    Adds up the snapshots of several workers, each reporting the devices it owns
+    '''
+    counters = None
+    devices = []
+    for snapshot in snapshots:
+        devices.extend(snapshot['devices'])
+        if counters is None:
+            counters = dict(snapshot['counters'], batch_sizes=snapshot['counters']['batch_sizes'].copy())
+            continue
+        for name, value in snapshot['counters'].items():
+            if name == 'batch_sizes':
+                counters[name].merge(value)
+            else:
+                counters[name] += value
+    devices.sort(key=busid_order)
+    return dict(counters=counters, devices=devices)
+
+
+def render(container):
+    '''
+    Metrics of a container and its devices in the Prometheus text exposition format
+    '''
+    return render_snapshot(collect(container))
+
+
+def render_snapshot(snapshot):
+    lines = []
+
+    def family(name, metric_type, help_text):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+
+    counters = snapshot['counters']
+    for counter, (name, help_text) in CONTAINER_COUNTERS.items():
+        family(name, 'counter', help_text)
+        lines.append(f'{name} {counters[counter]}')
+    family('usbip_sessions_active', 'gauge', 'Open client connections')
+    lines.append(f'usbip_sessions_active {counters["active_sessions"]}')
+    family('usbip_send_batch_messages', 'histogram', 'Replies merged into one sendmsg')
+    histogram_lines(lines, 'usbip_send_batch_messages', {}, counters['batch_sizes'])
+
+    devices = snapshot['devices']
+    family('usbip_device_attached', 'gauge', '1 if the device is imported by a client')
+    for busid, attached, _ in devices:
+        lines.append(f'usbip_device_attached{labels(busid=busid)} {int(attached)}')
+
+    for field, name, help_text, label_function in (
+            ('urbs', 'usbip_urbs_total', 'URBs submitted', endpoint_labels),
+            ('bytes', 'usbip_bytes_total', 'Payload bytes moved', endpoint_labels),
+            ('control_requests', 'usbip_control_requests_total', 'Control requests', request_labels),
+            ('unhandled', 'usbip_unhandled_requests_total', 'Control requests no handler answered', request_labels)):
+        family(name, 'counter', help_text)
+        for busid, _, device in devices:
+            for key, value in sorted(device[field].items()):
+                lines.append(f'{name}{labels(**label_function(busid, key))} {value}')
+
+    name = 'usbip_urb_latency_seconds'
+    family(name, 'histogram', 'Time from receiving an URB header to sending its USBIP_RET_SUBMIT')
+    for busid, _, device in devices:
+        for key, histogram in sorted(device['latency'].items()):
+            histogram_lines(lines, name, endpoint_labels(busid, key), histogram)
+
+    for key, (name, metric_type, help_text) in STORAGE_METRICS.items():
+        values = [(busid, device['storage'][key]) for busid, _, device in devices if key in device['storage']]
+        if values:
+            family(name, metric_type, help_text)
+            for busid, value in values:
+                lines.append(f'{name}{labels(busid=busid)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    collect = None  # returns the snapshot to render
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = render_snapshot(self.collect()).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+def serve_metrics(container, port=9240, ip='127.0.0.1', collect_snapshot=None):
+    '''
+    Serves GET /metrics for `container`, or for whatever `collect_snapshot()` returns, from a daemon
+    thread. Returns the HTTP server.
+    '''
+    if collect_snapshot is None:
+        def collect_snapshot():
+            return collect(container)
+    handler = type('ContainerMetricsHandler', (MetricsHandler,), dict(collect=staticmethod(collect_snapshot)))
+    server = ThreadingHTTPServer((ip, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    log.info('metrics on http://%s:%d/metrics', ip, port)
+    return server
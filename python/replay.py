@@ -0,0 +1,228 @@
+import argparse
+import hashlib
+import logging
+import mmap
+import threading
+
+from USBIP import BaseStructure, USBDevice, USBContainer, DeviceDescriptor, parse_configuration, USBIP_DIR_IN, EPIPE
+
+
+log = logging.getLogger('usbip.device.replay')
+
+TRACE_MAGIC = b'USBTRACE'
+TRACE_VERSION = 1
+
+
+class TraceHeader(BaseStructure):
+    _byte_order_ = '<'
+    _fields_ = [
+        ('magic', '8s', TRACE_MAGIC),
+        ('version', 'I', TRACE_VERSION),
+        ('record_count', 'I'),
+        ('index_offset', 'Q')
+    ]
+
+
+class TraceIndexEntry(BaseStructure):
+    _byte_order_ = '<'
+    _fields_ = [
+        ('key_hash', 'Q'),
+        ('key_offset', 'Q'),
+        ('key_length', 'I'),
+        ('response_offset', 'Q'),
+        ('response_length', 'I'),
+        ('status', 'i')
+    ]
+
+
+def request_signature(ep, direction, setup, payload):
+    '''
+    Key a request is looked up by. wLength is left out of control requests, replayed responses are
+    truncated to it instead, so a host asking for 8 or 64 bytes of a descriptor gets the same answer.
+    '''
+    key = bytes([ep, direction])
+    if ep == 0:
+        key += bytes(setup[:6])
+    if payload:
+        key += bytes(payload)
+    return key
+
+
+def signature_hash(key):
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+class TraceWriter:
+    '''
+    Records request -> response pairs. A request seen several times keeps every response, in order.
+    '''
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(bytes(TraceHeader().size()))
+        self.entries = []
+        # Responses complete on connection, storage executor and timer threads
+        self.lock = threading.Lock()
+
+    def add(self, key, response, status=0):
+        with self.lock:
+            key_offset = self.file.tell()
+            self.file.write(key)
+            response_offset = self.file.tell()
+            self.file.write(response)
+            self.entries.append(TraceIndexEntry(key_hash=signature_hash(key), key_offset=key_offset,
+                                                key_length=len(key), response_offset=response_offset,
+                                                response_length=len(response), status=status))
+
+    def close(self):
+        with self.lock:
+            index_offset = self.file.tell()
+            for entry in self.entries:
+                self.file.write(entry.pack())
+            self.file.seek(0)
+            self.file.write(TraceHeader(record_count=len(self.entries), index_offset=index_offset).pack())
+            self.file.close()
+
+
+class TraceRecorder:
+    '''
+    Attach to a device as `usb_dev.recorder` to record every URB it answers
+    '''
+
+    def __init__(self, path):
+        self.writer = TraceWriter(path)
+
+    def record_submit(self, usb_req):
+        # The transfer buffer is only valid during the request, keep the key now
+        usb_req.signature = request_signature(usb_req.ep, usb_req.direction, usb_req.setup, usb_req.transfer_buffer)
+
+    def record_complete(self, usb_req, data, status):
+        response = bytes(data) if usb_req.direction == USBIP_DIR_IN and data else b''
+        self.writer.add(usb_req.signature, response, status)
+
+    def close(self):
+        self.writer.close()
+
+
+class Trace:
+    '''
+    Memory-mapped trace. The index is read on the first lookup, responses are served as slices of
+    the mapping.
+    '''
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.mapping = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mapping)
+        self.header = TraceHeader()
+        self.header.unpack_from(self.mapping)
+        if self.header.magic != TRACE_MAGIC or self.header.version != TRACE_VERSION:
+            raise ValueError(f'{path} is not a version {TRACE_VERSION} USB trace')
+        self.index = None
+        self.resolved = {}  # key -> index entries recorded for it
+        self.cursors = {}
+
+    def load_index(self):
+        index = {}
+        entry_format = TraceIndexEntry()._codec().struct
+        end = self.header.index_offset + self.header.record_count * entry_format.size
+        for entry in entry_format.iter_unpack(self.view[self.header.index_offset:end]):
+            index.setdefault(entry[0], []).append(entry[1:])
+        self.index = index
+
+    def matches(self, key):
+        # Index entries recorded for a request signature, in recording order
+        matches = self.resolved.get(key)
+        if matches is None:
+            if self.index is None:
+                self.load_index()
+            entries = self.index.get(signature_hash(key), [])
+            # Hash collisions are resolved by comparing the recorded key, once per distinct request
+            matches = [entry for entry in entries if self.view[entry[0]:entry[0] + entry[1]] == key]
+            self.resolved[key] = matches
+        return matches
+
+    def responses(self, key):
+        '''
+        Every response recorded for a request signature, without moving its cursor
+        '''
+        return [self.view[entry[2]:entry[2] + entry[3]] for entry in self.matches(key)]
+
+    def lookup(self, key):
+        '''
+        Returns (response, status) for a request signature, or None. Repeated requests step through
+        the recorded responses and then keep returning the last one.
+        '''
+        matches = self.matches(key)
+        if not matches:
+            return None
+        cursor = self.cursors.get(key, 0)
+        self.cursors[key] = cursor + 1
+        _, _, response_offset, response_length, status = matches[min(cursor, len(matches) - 1)]
+        return self.view[response_offset:response_offset + response_length], status
+
+    def rewind(self):
+        self.cursors = {}
+
+
+class ReplayDevice(USBDevice):
+    '''
+    Device that answers every URB from a recorded trace. Unknown control requests are stalled,
+    unknown IN URBs stay pending and unknown OUT URBs are acknowledged.
+    '''
+    device_descriptor = None
+    configurations = None
+
+    def __init__(self, trace):
+        self.trace = trace
+        device_descriptor = DeviceDescriptor()
+        device_descriptor.unpack_from(self.recorded_descriptor(0x01))
+        self.device_descriptor = device_descriptor
+        self.configurations = [parse_configuration(self.recorded_descriptor(0x02))]
+        super().__init__()
+        trace.rewind()
+
+    def recorded_descriptor(self, descriptor_type):
+        responses = self.trace.responses(request_signature(0, USBIP_DIR_IN, bytes([0x80, 0x06, 0x00, descriptor_type, 0, 0]), b''))
+        if not responses:
+            raise ValueError(f'trace has no GET_DESCRIPTOR response for descriptor type {descriptor_type}')
+        # Hosts read the configuration header before the whole of it, the longest answer is complete
+        return bytes(max(responses, key=len))
+
+    def handle_usb_request(self, usb_req):
+        self.metrics.record_submit(usb_req)
+        if self.capture is not None:
+            self.capture.record_submit(self, usb_req)
+        found = self.trace.lookup(request_signature(usb_req.ep, usb_req.direction, usb_req.setup, usb_req.transfer_buffer))
+        if found is not None:
+            response, status = found
+            if usb_req.direction == USBIP_DIR_IN:
+                response = response[:usb_req.transfer_buffer_length]
+                self.send_usb_ret(usb_req, response, len(response), status)
+            else:
+                self.send_usb_ret(usb_req, b'', len(usb_req.transfer_buffer or b''), status)
+        elif usb_req.ep == 0:
+            log.info('no recorded response for control request %s', bytes(usb_req.setup).hex())
+            self.send_usb_ret(usb_req, b'', 0, -EPIPE)
+        elif usb_req.direction == USBIP_DIR_IN:
+            self.park_urb(usb_req)
+        else:
+            self.ack_out(usb_req)
+
+    def reset(self):
+        super().reset()
+        self.trace.rewind()  # The next client sees the recording from the start
+
+    def handle_data(self, usb_req):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a device recorded in a USB trace over USB/IP')
+    parser.add_argument('trace', help='trace recorded with --record')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    usb_container = USBContainer()
+    usb_container.add_usb_device(ReplayDevice(Trace(args.trace)))
+    usb_container.run()
@@ -1,144 +1,209 @@
-from USBIP import BaseStructure, USBDevice, USBContainer, DeviceDescriptor, DeviceConfiguration, BOSDescriptor, DeviceQualifierDescriptor, InterfaceDescriptor, EndpointDescriptor
-
-
-samsung_T5_device_descriptor = DeviceDescriptor(bcdUSB=0x0210,
-                                                bDeviceClass=0x0,
-                                                bDeviceSubClass=0x0,
-                                                bDeviceProtocol=0x0,
-                                                bMaxPacketSize0=0x40,
-                                                idVendor=0x04e8,  # Samsung Electronics
-                                                idProduct=0x61f6,  # T5 SSD
-                                                bcdDevice=0x0100,
-                                                iManufacturer=2,
-                                                iProduct=3,
-                                                iSerialNumber=1,
-                                                bNumConfigurations=1)
-serial_number_string = "1234567B859B"  # This was my T5 serial number, yours will be different
-manufacturer_string = "Samsung"
-product_string = "Portable SSD T5 (emulated)"
-
-samsung_T5_device_configuration = DeviceConfiguration(wTotalLength=0x0055,
-                                                      bNumInterfaces=0x1,
-                                                      bConfigurationValue=1,
-                                                      iConfiguration=0x0,  # No string
-                                                      bmAttributes=0x80,  # Valid self-powered
-                                                      bMaxPower=250)  # 500 mA current
-
-
-samsung_T5_BOS_descriptor = BOSDescriptor(wTotalLength=0x002a, bNumDeviceCaps=0x03)
-samsung_T5_device_qualifier_descriptor = DeviceQualifierDescriptor(bcdUSB=samsung_T5_device_descriptor.bcdUSB, bDeviceClass=samsung_T5_device_descriptor.bDeviceClass, bDeviceSubClass=samsung_T5_device_descriptor.bDeviceSubClass, bDeviceProtocol=samsung_T5_device_descriptor.bDeviceProtocol, bMaxPacketSize0=samsung_T5_device_descriptor.bMaxPacketSize0, bNumConfigurations=samsung_T5_device_descriptor.bNumConfigurations)
-
-# BOT - Bulk Only Transport
-samsung_T5_interface_descriptor_BOT = InterfaceDescriptor(bAlternateSetting=0,
-                                                          bNumEndpoints=2,
-                                                          bInterfaceClass=0x08,  # Mass Storage
-                                                          bInterfaceSubClass=0x06,  # SCSI transparent command set
-                                                          bInterfaceProtocol=0x50,  # BOT
-                                                          iInterface=0)
-samsung_T5_interface_descriptor_BOT.endpoints = []
-samsung_T5_interface_descriptor_BOT.endpoints.append(EndpointDescriptor(bEndpointAddress=0x81, bmAttributes=0x02, wMaxPacketSize=512, bInterval=0))
-samsung_T5_interface_descriptor_BOT.endpoints.append(EndpointDescriptor(bEndpointAddress=0x02, bmAttributes=0x02, wMaxPacketSize=512, bInterval=0))
-
-# UAS - USB Attached SCSI
-samsung_T5_interface_descriptor_UAS = InterfaceDescriptor(bAlternateSetting=1,
-                                                          bNumEndpoints=4,
-                                                          bInterfaceClass=0x08,  # Mass Storage
-                                                          bInterfaceSubClass=0x06,  # SCSI transparent command set
-                                                          bInterfaceProtocol=0x62,  # UAS
-                                                          iInterface=0)
-
-
-class PipeUsageClassSpecificDescriptor(BaseStructure):
-    '''
-    I think this is the Pipe Usage Class Specific Descriptor, but I don't have access to 
-    "USB Attached SCSI (UAS) T10/2095-D" which describes it. Wireshark also doesn't know.
-    '''
-    _byte_order_ = '<'
-    _fields_ = [
-        ('bLength', 'B', 4),
-        ('bDescriptorType', 'B', 0x24),  # Pipe Usage Class Specific Descriptor
-        ('bValue', 'H'),
-    ]
-
-
-UAS_endpoint_0 = EndpointDescriptor(bEndpointAddress=0x81, bmAttributes=0x02, wMaxPacketSize=512, bInterval=0)
-UAS_endpoint_0.class_descriptor = PipeUsageClassSpecificDescriptor(bValue=0x0003)
-UAS_endpoint_1 = EndpointDescriptor(bEndpointAddress=0x02, bmAttributes=0x02, wMaxPacketSize=512, bInterval=0)
-UAS_endpoint_1.class_descriptor = PipeUsageClassSpecificDescriptor(bValue=0x0004)
-UAS_endpoint_2 = EndpointDescriptor(bEndpointAddress=0x83, bmAttributes=0x02, wMaxPacketSize=512, bInterval=0)
-UAS_endpoint_2.class_descriptor = PipeUsageClassSpecificDescriptor(bValue=0x0002)
-UAS_endpoint_3 = EndpointDescriptor(bEndpointAddress=0x04, bmAttributes=0x02, wMaxPacketSize=512, bInterval=0)
-UAS_endpoint_3.class_descriptor = PipeUsageClassSpecificDescriptor(bValue=0x0001)
-samsung_T5_interface_descriptor_UAS.endpoints = [UAS_endpoint_0, UAS_endpoint_1, UAS_endpoint_2, UAS_endpoint_3]
-
-samsung_T5_interface = [samsung_T5_interface_descriptor_BOT, samsung_T5_interface_descriptor_UAS]  # List of interface alternatives
-samsung_T5_device_configuration.interfaces = [samsung_T5_interface]
+import argparse
+import logging
+import signal
+from capture import CaptureRing, export_pcap
+from chunked_image import ChunkedImage
+from metrics import serve_metrics
+from replay import TraceRecorder
+from workers import interrupt, run_workers
+from mass_storage import BulkOnlyTransport, UASTransport
+from scsi import SCSIDisk
+from storage import FLUSH_POLICIES, BlockCache, MmapDiskImage, StorageExecutor, parse_size
+from USBIP import USBDevice, USBContainer, control_request
+from device_spec import load_device_spec, spec_path
+
+
+# Descriptors are in devices/samsung_T5.json. The UAS alternate setting's endpoints carry what I think is
+# the Pipe Usage Class Specific Descriptor, but I don't have access to "USB Attached SCSI (UAS) T10/2095-D"
+# which describes it. Wireshark also doesn't know.
+samsung_T5 = load_device_spec(spec_path('samsung_T5.json'))
+serial_number_string = samsung_T5.strings[samsung_T5.device_descriptor.iSerialNumber]  # This was my T5 serial number, yours will be different
+product_string = samsung_T5.strings[samsung_T5.device_descriptor.iProduct]
 
 
 class SamsungT5(USBDevice):
-    configurations = [samsung_T5_device_configuration]
-    device_descriptor = samsung_T5_device_descriptor
-    device_qualifier_descriptor = samsung_T5_device_qualifier_descriptor
-    BOS_descriptor = samsung_T5_BOS_descriptor
-    supported_langagues = [0x0409]  # Only supports English (United States)
-    device_strings = [None, serial_number_string, manufacturer_string, product_string]
-
-    def __init__(self):
+    compiled = samsung_T5
+    device_strings = samsung_T5.strings
+
+    def __init__(self, serial_number=None, storage=None, capture_bytes=16 * 1024 * 1024, io_threads=4,
+                 readahead_bytes=32 * 1024 * 1024, write_cache=None, cache_bytes=64 * 1024 * 1024, flush_interval=1.0):
+        if serial_number is not None:
+            self.device_strings = list(self.device_strings)
+            self.device_strings[self.device_descriptor.iSerialNumber] = serial_number
         super().__init__()
-        self.data_recieved = []
+        self.capture = CaptureRing(max_bytes=capture_bytes) if capture_bytes else None
         self.interface_setting = 0  # Startup with Bulk Only Transport interface setting
+        self.bot = None
+        self.uas = None
+        self.disk = None
+        self.executor = None
+        self.block_cache = None
+        if storage is not None:
+            if write_cache is not None:
+                # Flush policy of a block cache between the SCSI commands and the image
+                storage = self.block_cache = BlockCache(storage, write_cache, max_bytes=cache_bytes,
+                                                        interval=flush_interval)
+            if io_threads:
+                # Storage I/O runs off the connection's thread, 0 threads keeps it inline
+                self.executor = StorageExecutor(storage, io_threads, readahead_bytes)
+            # device_strings is by string descriptor index, its slot 0 stands for the language IDs
+            serial_number = self.device_strings[self.device_descriptor.iSerialNumber]
+            self.disk = SCSIDisk(storage, product=product_string, serial_number=serial_number,
+                                 executor=self.executor)
+            self.bot = BulkOnlyTransport(self, self.disk, in_ep=1)  # Bulk IN 0x81, bulk OUT 0x02
+            # Pipes from the UAS alternate setting's pipe usage descriptors
+            self.uas = UASTransport(self, self.disk, command_ep=4, status_ep=3, data_in_ep=1, data_out_ep=2)
+
+    def reset(self):
+        super().reset()
+        self.interface_setting = 0  # Back to Bulk Only Transport
+        if self.bot is not None:
+            self.bot.reset()
+            self.uas.reset()
+
+    def flush(self):
+        if self.block_cache is not None:
+            self.block_cache.flush()
+
+    def storage_counters(self):
+        counters = self.disk.storage.snapshot() if self.disk is not None else {}
+        if self.executor is not None:
+            counters['readahead_hits'] = self.executor.hits
+        return counters
+
+    def descriptor_entries(self):
+        entries = super().descriptor_entries()
+        if self.device_strings is not self.compiled.strings:
+            # Every T5 gets its own serial number, the other strings come from the spec
+            index = self.device_descriptor.iSerialNumber
+            encoded = self.device_strings[index].encode('utf-16-le')
+            for language in self.compiled.languages:
+                entries[(0x03, index, language)] = bytes([2 + len(encoded), 0x03]) + encoded
+        return entries
 
     def handle_data(self, usb_req):
-        if usb_req.direction == 0:  # USBIP_DIR_OUT
-            self.data_recieved.append(usb_req.transfer_buffer)
-            self.send_usb_ret(usb_req, b'', 0)
+        if self.bot is not None:
+            transport = self.uas if self.interface_setting == 1 else self.bot
+            transport.handle_data(usb_req)
+        elif usb_req.direction == 0:  # USBIP_DIR_OUT
+            self.ack_out(usb_req)  # The capture ring keeps what was sent
         elif usb_req.direction == 1:  # USBIP_DIR_IN
-            raise(NotImplementedError)
-
-    def handle_device_specific_control(self, control_req, usb_req):
-        handled = False
-        if control_req.bmRequestType == 0x80:  # IN:STANDARD:DEVICE request
-            if control_req.bRequest == 0x06:  # GET_DESCRIPTOR
-                descriptor_type, descriptor_index = control_req.wValue.to_bytes(length=2, byteorder='big')
-                if descriptor_type == 0x03:  # String Descriptor
-                    if descriptor_index == 0:
-                        # String Index 0 - List of supported languages
-                        ret_data = bytearray()
-                        for language in self.supported_langagues:
-                            ret_data.extend(language.to_bytes(length=2, byteorder='big'))
-                    else:
-                        ret_data = self.device_strings[descriptor_index].encode('utf-16')
-                    ret = bytearray([2 + len(ret_data), 0x03])
-                    ret.extend(ret_data)
-                    self.send_usb_ret(usb_req, ret, len(ret))
-                    handled = True
-                elif descriptor_type == 0x06:  # Device Qualifier Descriptor
-                    ret = self.device_qualifier_descriptor.pack()
-                    self.send_usb_ret(usb_req, ret, len(ret))
-                    handled = True
-                elif descriptor_type == 0x0F:  # BOS Descriptor
-                    ret = self.BOS_descriptor.pack()
-                    self.send_usb_ret(usb_req, ret, len(ret))
-                    handled = True
-
-        elif control_req.bmRequestType == 0b1_01_00001:  # IN:CLASS:INTERFACE request
-            if control_req.bRequest == 0xFE:  # GET_MAX_LUN
-                ret = bytearray([0])
-                self.send_usb_ret(usb_req, ret, len(ret))
-                handled = True
-
-        elif control_req.bmRequestType == 0b0_00_00001:  # OUT:STANDARD:INTERFACE request
-            if control_req.bRequest == 0x0B:  # SET_INTERFACE
-                assert(control_req.wIndex == 0)  # Only 1 interface
-                self.interface_setting = control_req.wValue
-                self.send_usb_ret(usb_req, b'', 0)
-                handled = True
-
-        if not handled:
-            raise(NotImplementedError)
-
-
-usb_dev = SamsungT5()
-usb_container = USBContainer()
-usb_container.add_usb_device(usb_dev)  # Supports only one device!
-usb_container.run()
+            self.park_urb(usb_req)  # Nothing to send yet, keep it pending until the host unlinks it
+
+    @control_request(0b1_01_00001, 0xFE)  # IN:CLASS:INTERFACE GET_MAX_LUN
+    def handle_get_max_lun(self, control_req, usb_req):
+        ret = bytearray([0])
+        self.send_usb_ret(usb_req, ret, len(ret))
+
+    @control_request(0b0_01_00001, 0xFF)  # OUT:CLASS:INTERFACE Bulk-Only Mass Storage Reset
+    def handle_mass_storage_reset(self, control_req, usb_req):
+        if self.bot is not None:
+            self.bot.reset()
+        self.send_usb_ret(usb_req, b'', 0)
+
+    @control_request(0b0_00_00010, 0x01)  # OUT:STANDARD:ENDPOINT CLEAR_FEATURE (ENDPOINT_HALT)
+    def handle_clear_feature(self, control_req, usb_req):
+        self.send_usb_ret(usb_req, b'', 0)
+
+    @control_request(0b0_00_00001, 0x0B)  # OUT:STANDARD:INTERFACE SET_INTERFACE
+    def handle_set_interface(self, control_req, usb_req):
+        if control_req.wIndex != 0 or control_req.wValue > 1:  # Only 1 interface, with 2 alternate settings
+            self.stall(usb_req)
+            return
+        self.interface_setting = control_req.wValue
+        if self.bot is not None:
+            # Switching between BOT and UAS starts the new transport from scratch
+            self.bot.reset()
+            self.uas.reset()
+        self.send_usb_ret(usb_req, b'', 0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Emulate Samsung T5 SSDs over USB/IP')
+    parser.add_argument('--devices', type=int, default=1, help='number of emulated T5s to export (bus ids 1-1, 1-2, ...)')
+    parser.add_argument('--image', help='raw disk image backing the drive, created sparse if missing. '
+                                            'Extra devices use IMAGE.1, IMAGE.2, ...')
+    parser.add_argument('--size', default='1G', help='size of a newly created image, e.g. 64M, 500G, 2T')
+    parser.add_argument('--base', help='chunked base image shared by all devices, see chunked_image.py. '
+                                       '--image is then the copy-on-write overlay of each device')
+    parser.add_argument('--chunked', action='store_true', help='make --image a chunked overlay without a base, '
+                                                               'it only takes disk space for the chunks written')
+    parser.add_argument('--chunk-cache', type=parse_size, default='64M',
+                        help='memory cap of the decompressed chunks of the base image, shared by all devices')
+    parser.add_argument('--capture-bytes', default='16M', help='memory cap of the URB capture ring of each device, 0 disables it')
+    parser.add_argument('--pcap', default='t5-capture.pcap', help='usbmon pcap file written on SIGUSR1 and on exit')
+    parser.add_argument('--record', help='record every request and response to a trace for replay.py. '
+                                             'Extra devices use RECORD.1, RECORD.2, ...')
+    parser.add_argument('--io-threads', type=int, default=4,
+                        help='storage I/O threads of each device, 0 runs reads and writes on the connection thread')
+    parser.add_argument('--readahead', type=parse_size, default='32M',
+                        help='memory cap of the readahead buffers of each device')
+    parser.add_argument('--write-cache', choices=FLUSH_POLICIES,
+                        help='cache blocks in memory and write them to the image on every write (write-through), '
+                             'every --flush-interval seconds (periodic) or on SYNCHRONIZE CACHE (sync)')
+    parser.add_argument('--cache-size', type=parse_size, default='64M', help='memory cap of the block cache of each device')
+    parser.add_argument('--flush-interval', type=float, default=1.0, help='seconds between periodic write-backs')
+    parser.add_argument('--nagle', action='store_true', help="leave Nagle's algorithm on for client sockets")
+    parser.add_argument('--send-buffer', type=parse_size, help='SO_SNDBUF of client sockets')
+    parser.add_argument('--receive-buffer', type=parse_size, help='SO_RCVBUF of client sockets')
+    parser.add_argument('--max-batch', type=int, default=64, help='most replies merged into one sendmsg')
+    parser.add_argument('--port', type=int, default=3240, help='TCP port to serve USB/IP on')
+    parser.add_argument('--metrics-port', type=int, help='serve Prometheus metrics on http://127.0.0.1:PORT/metrics')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log every URB with a hex dump of its data')
+    parser.add_argument('-q', '--quiet', action='store_true', help='only log warnings and errors')
+    parser.add_argument('--asyncio', action='store_true', help='serve clients concurrently on an asyncio event loop')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='serve from this many processes sharing the port, each owning a shard of the devices. '
+                             'Workers use asyncio and do not keep URB captures')
+    args = parser.parse_args()
+    if args.workers > 1 and args.record:
+        parser.error('--record needs a single worker')
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING if args.quiet else logging.INFO,
+                        format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    usb_container = USBContainer(tcp_nodelay=not args.nagle, send_buffer_size=args.send_buffer,
+                                 receive_buffer_size=args.receive_buffer, max_batch=args.max_batch)
+    for i in range(args.devices):
+        # Every T5 gets its own serial number so the host can tell them apart
+        serial_number = serial_number_string if i == 0 else f'{serial_number_string[:-4]}{i:04X}'
+        storage = None
+        if args.image:
+            path = args.image if i == 0 else f'{args.image}.{i}'
+            if args.base or args.chunked:
+                storage = ChunkedImage(path, args.base, parse_size(args.size), args.chunk_cache)
+            else:
+                storage = MmapDiskImage(path, parse_size(args.size))
+        elif args.base:
+            storage = ChunkedImage(None, args.base, cache_bytes=args.chunk_cache)  # The base as it is, read-only
+        usb_dev = SamsungT5(serial_number, storage, parse_size(args.capture_bytes) if args.workers == 1 else 0,
+                            args.io_threads, args.readahead, args.write_cache, args.cache_size, args.flush_interval)
+        if args.record:
+            usb_dev.recorder = TraceRecorder(args.record if i == 0 else f'{args.record}.{i}')
+        usb_container.add_usb_device(usb_dev)
+
+    def write_capture(*_):
+        rings = [usb_dev.capture for usb_dev in usb_container.usb_devices if usb_dev.capture is not None]
+        if rings:
+            export_pcap(args.pcap, rings)
+            logging.info('wrote %s', args.pcap)
+
+    signal.signal(signal.SIGUSR1, write_capture)
+    if args.workers == 1:
+        signal.signal(signal.SIGTERM, interrupt)  # Stop like on Ctrl-C, so caches are flushed and the pcap written
+    if args.metrics_port and args.workers == 1:
+        serve_metrics(usb_container, args.metrics_port)
+    try:
+        if args.workers > 1:
+            run_workers(usb_container, args.workers, port=args.port, metrics_port=args.metrics_port)
+        elif args.asyncio:
+            usb_container.run_async(port=args.port)
+        else:
+            usb_container.run(port=args.port)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        write_capture()
+        for usb_dev in usb_container.usb_devices:
+            usb_dev.flush()
+            if usb_dev.recorder is not None:
+                usb_dev.recorder.close()
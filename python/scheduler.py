@@ -0,0 +1,172 @@
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+from USBIP import USBIP_DIR_IN, USB_SPEED_HIGH
+
+
+log = logging.getLogger('usbip.scheduler')
+
+
+class TimerWheel:
+    '''
+    Hashed timer wheel run by one daemon thread. A timer lands in slot `deadline tick % slots` and
+    fires on the first tick at or after its deadline. The thread sleeps until the next occupied
+    slot, and without a timeout while no timer is armed, so idle devices cost nothing.
+    '''
+
+    def __init__(self, tick=0.001, slots=512):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.origin = time.monotonic()
+        self.current = 0  # last tick processed
+        self.pending = 0
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def now(self):
+        return int((time.monotonic() - self.origin) / self.tick)
+
+    def schedule(self, delay, callback):
+        '''
+        Calls `callback()` from the wheel thread after `delay` seconds. Returns a handle for cancel.
+        '''
+        with self.condition:
+            deadline = max(math.ceil((time.monotonic() - self.origin + delay) / self.tick), self.current + 1)
+            timer = [deadline, callback]
+            self.slots[deadline % len(self.slots)].append(timer)
+            self.pending += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='timer-wheel', daemon=True)
+                self.thread.start()
+            self.condition.notify()
+            return timer
+
+    def cancel(self, timer):
+        with self.condition:
+            timer[1] = None  # Dropped when its slot comes around
+
+    def expire(self, now):
+        # Collects the timers due by `now` from every slot passed since the last call
+        expired = []
+        for tick in range(self.current + 1, min(now, self.current + len(self.slots)) + 1):
+            slot = self.slots[tick % len(self.slots)]
+            if slot:
+                expired.extend(timer for timer in slot if timer[0] <= now)
+                slot[:] = [timer for timer in slot if timer[0] > now]
+        self.current = now
+        self.pending -= len(expired)
+        return expired
+
+    def next_timeout(self, now):
+        for tick in range(now + 1, now + len(self.slots) + 1):
+            if self.slots[tick % len(self.slots)]:
+                return max(0.0, self.origin + tick * self.tick - time.monotonic())
+        return None
+
+    def run(self):
+        while 1:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                expired = self.expire(self.now())
+                if not expired:
+                    self.condition.wait(self.next_timeout(self.current))
+                    continue
+            for _, callback in expired:
+                if callback is None:
+                    continue
+                try:
+                    callback()
+                except Exception:
+                    log.exception('timer callback failed')
+
+
+shared_wheel_lock = threading.Lock()
+shared_wheel = None
+
+
+def get_shared_wheel():
+    '''
+    The timer wheel every InterruptEndpoint uses unless given another one
+    '''
+    global shared_wheel
+    with shared_wheel_lock:
+        if shared_wheel is None:
+            shared_wheel = TimerWheel()
+        return shared_wheel
+
+
+def interrupt_interval(bInterval, speed):
+    '''
+    Polling period in seconds of an interrupt endpoint: bInterval frames of 1 ms at low and full
+    speed, 2^(bInterval-1) microframes of 125 us at high speed and above
+    '''
+    if speed >= USB_SPEED_HIGH:
+        return (1 << (min(max(bInterval, 1), 16) - 1)) * 0.000125
+    return max(bInterval, 1) * 0.001
+
+
+class InterruptEndpoint:
+    '''
+    Interrupt IN endpoint served at most once per bInterval. IN URBs are parked on the device and
+    completed from the timer wheel, with a report the device pushed or, when none is queued, with
+    what `poll()` returns. While there is nothing to send, URBs stay parked and no timer is armed.
+    '''
+
+    def __init__(self, device, endpoint, poll=None, wheel=None, max_reports=32):
+        self.device = device
+        self.ep = endpoint.bEndpointAddress & 0x0F
+        self.interval = interrupt_interval(endpoint.bInterval, device.speed)
+        self.poll = poll
+        self.wheel = wheel if wheel is not None else get_shared_wheel()
+        self.reports = deque(maxlen=max_reports)  # The oldest reports are dropped if nobody polls
+        self.lock = threading.Lock()
+        self.timer = None
+        self.next_service = 0.0  # monotonic time of the next allowed completion
+
+    def has_urb(self):
+        return bool(self.device.pending_urbs.get((self.ep, USBIP_DIR_IN)))
+
+    def submit(self, usb_req):
+        self.device.park_urb(usb_req)
+        self.arm()
+
+    def push(self, data):
+        with self.lock:
+            self.reports.append(bytes(data))
+        self.arm()
+
+    def reset(self):
+        # The host is gone, forget its queued reports and the timer armed for its URBs
+        with self.lock:
+            if self.timer is not None:
+                self.wheel.cancel(self.timer)
+                self.timer = None
+            self.reports.clear()
+            self.next_service = 0.0
+
+    def arm(self):
+        with self.lock:
+            if self.timer is not None or not self.has_urb() or not (self.reports or self.poll is not None):
+                return
+            self.timer = self.wheel.schedule(max(0.0, self.next_service - time.monotonic()), self.service)
+
+    def service(self):
+        with self.lock:
+            self.timer = None
+            if not self.has_urb():
+                return  # Unlinked since the timer was armed
+            data = self.reports.popleft() if self.reports else self.poll() if self.poll is not None else None
+            if data is None:
+                return  # Idle, the next push arms the timer again
+            usb_req = self.device.pop_parked_urb(self.ep)
+            if usb_req is None:
+                self.reports.appendleft(data)
+                return
+            self.next_service = time.monotonic() + self.interval
+        data = data[:usb_req.transfer_buffer_length]
+        self.device.send_usb_ret(usb_req, data, len(data))
+        self.arm()
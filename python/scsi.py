@@ -0,0 +1,276 @@
+import logging
+import struct
+import threading
+
+
+log = logging.getLogger('usbip.scsi')
+
+# Status codes
+GOOD = 0x00
+CHECK_CONDITION = 0x02
+
+# Sense keys
+NO_SENSE = 0x00
+NOT_READY = 0x02
+MEDIUM_ERROR = 0x03
+ILLEGAL_REQUEST = 0x05
+UNIT_ATTENTION = 0x06
+DATA_PROTECT = 0x07
+
+# Opcodes
+TEST_UNIT_READY = 0x00
+REQUEST_SENSE = 0x03
+INQUIRY = 0x12
+MODE_SENSE_6 = 0x1A
+START_STOP_UNIT = 0x1B
+PREVENT_ALLOW_MEDIUM_REMOVAL = 0x1E
+READ_CAPACITY_10 = 0x25
+READ_10 = 0x28
+WRITE_10 = 0x2A
+SYNCHRONIZE_CACHE_10 = 0x35
+MODE_SENSE_10 = 0x5A
+READ_16 = 0x88
+WRITE_16 = 0x8A
+SYNCHRONIZE_CACHE_16 = 0x91
+SERVICE_ACTION_IN_16 = 0x9E
+READ_CAPACITY_16 = 0x10  # SERVICE ACTION IN(16) service action
+
+
+def sense_data(key, asc, ascq):
+    '''
+    Fixed format sense data
+    '''
+    return bytes([0x70, 0, key, 0, 0, 0, 0, 10, 0, 0, 0, 0, asc, ascq, 0, 0, 0, 0])
+
+
+class SCSICommand:
+    '''
+    One CDB and the state of its data phase. Data-in commands carry their response in `data_in`,
+    data-out commands expect `data_out_length` bytes passed to SCSIDisk.write_data.
+    '''
+
+    def __init__(self, cdb):
+        self.cdb = bytes(cdb)
+        self.opcode = self.cdb[0] if self.cdb else None
+        self.status = GOOD
+        self.data_in = None
+        self.data_out_length = 0
+        self.data_out_received = 0
+        self.data_out_written = 0
+        self.partial = None  # tail of a data-out chunk that did not end on a block boundary
+        self.lba = 0
+        self.sense = (NO_SENSE, 0x00, 0x00)  # key, ASC and ASCQ of a CHECK CONDITION
+        self.pending = 0  # storage I/O still running, see SCSIDisk.when_complete
+        self.on_complete = None
+
+
+class SCSIDisk:
+    '''
+    Direct access block device (SBC) command set on top of a BlockStorage backend, shared by the
+    Bulk-Only and UAS transports. With a storage.StorageExecutor, reads, writes and cache flushes
+    run on its threads and the transports wait for them with when_complete.
+    '''
+
+    def __init__(self, storage, vendor='Samsung', product='Portable SSD T5', revision='0', serial_number='',
+                 executor=None):
+        self.storage = storage
+        self.executor = executor
+        self.lock = threading.Lock()
+        self.vendor = vendor
+        self.product = product
+        self.revision = revision
+        self.serial_number = serial_number
+        self.sense = (NO_SENSE, 0x00, 0x00)  # of the last failed Bulk-Only command, for REQUEST SENSE
+        self.handlers = {
+            TEST_UNIT_READY: self.test_unit_ready,
+            REQUEST_SENSE: self.request_sense,
+            INQUIRY: self.inquiry,
+            MODE_SENSE_6: self.mode_sense,
+            MODE_SENSE_10: self.mode_sense,
+            START_STOP_UNIT: self.no_data,
+            PREVENT_ALLOW_MEDIUM_REMOVAL: self.no_data,
+            READ_CAPACITY_10: self.read_capacity_10,
+            SERVICE_ACTION_IN_16: self.service_action_in_16,
+            READ_10: self.read,
+            READ_16: self.read,
+            WRITE_10: self.write,
+            WRITE_16: self.write,
+            SYNCHRONIZE_CACHE_10: self.synchronize_cache,
+            SYNCHRONIZE_CACHE_16: self.synchronize_cache,
+        }
+
+    def execute(self, cdb):
+        command = SCSICommand(cdb)
+        handler = self.handlers.get(command.opcode)
+        if handler is None:
+            log.debug('unsupported SCSI opcode %s', command.opcode)
+            self.check_condition(command, ILLEGAL_REQUEST, 0x20, 0x00)  # Invalid command operation code
+        else:
+            handler(command)
+        return command
+
+    def start_io(self, command, future, data_in=False):
+        with self.lock:
+            command.pending += 1
+        future.add_done_callback(lambda future: self.io_done(command, future, data_in))
+
+    def io_done(self, command, future, data_in):
+        try:
+            result = future.result()
+        except OSError:
+            log.exception('storage I/O failed')
+            # Unrecovered read error or write error. The data phase goes on, only the status changes.
+            command.sense = (MEDIUM_ERROR, 0x11 if data_in else 0x0C, 0x00)
+            command.status = CHECK_CONDITION
+            if data_in:
+                command.data_in = None
+        else:
+            if data_in:
+                command.data_in = result
+        with self.lock:
+            command.pending -= 1
+            callback = command.on_complete if not command.pending else None
+            if callback is not None:
+                command.on_complete = None
+        if callback is not None:
+            callback(command)
+
+    def when_complete(self, command, callback):
+        '''
+        Calls `callback(command)` once the storage I/O started for `command` is done. That is right
+        away without an executor, otherwise possibly from an executor thread.
+        '''
+        with self.lock:
+            if command.pending:
+                command.on_complete = callback
+                return
+        callback(command)
+
+    def check_condition(self, command, key, asc, ascq):
+        command.sense = (key, asc, ascq)
+        command.status = CHECK_CONDITION
+        command.data_in = None
+        command.data_out_length = 0
+
+    def allocation_length(self, command):
+        if command.opcode in (INQUIRY, MODE_SENSE_10):
+            return struct.unpack_from('>H', command.cdb, 3 if command.opcode == INQUIRY else 7)[0]
+        if command.opcode == SERVICE_ACTION_IN_16:
+            return struct.unpack_from('>I', command.cdb, 10)[0]
+        return command.cdb[4]
+
+    def respond(self, command, data):
+        command.data_in = data[:self.allocation_length(command)]
+
+    def no_data(self, command):
+        pass
+
+    def test_unit_ready(self, command):
+        pass
+
+    def request_sense(self, command):
+        # Reports the last Bulk-Only failure once, UAS sends each command's sense in its SENSE IU
+        sense, self.sense = self.sense, (NO_SENSE, 0x00, 0x00)
+        self.respond(command, sense_data(*sense))
+
+    def inquiry(self, command):
+        evpd, page = command.cdb[1] & 0x01, command.cdb[2]
+        if not evpd:
+            data = bytearray([0x00,  # Direct access block device
+                              0x00,  # Not removable
+                              0x06,  # SPC-4
+                              0x02,  # Response data format
+                              31, 0, 0, 0])
+            data.extend(self.vendor.encode('ascii')[:8].ljust(8))
+            data.extend(self.product.encode('ascii')[:16].ljust(16))
+            data.extend(self.revision.encode('ascii')[:4].ljust(4))
+            self.respond(command, bytes(data))
+        elif page == 0x00:  # Supported VPD pages
+            self.respond(command, bytes([0x00, 0x00, 0x00, 2, 0x00, 0x80]))
+        elif page == 0x80:  # Unit serial number
+            serial_number = self.serial_number.encode('ascii')
+            self.respond(command, bytes([0x00, 0x80, 0x00, len(serial_number)]) + serial_number)
+        else:
+            self.check_condition(command, ILLEGAL_REQUEST, 0x24, 0x00)  # Invalid field in CDB
+
+    def mode_sense(self, command):
+        device_specific = 0x80 if self.storage.read_only else 0x00  # Write protect
+        pages = b''
+        if command.cdb[2] & 0x3F in (0x08, 0x3F):
+            # Caching mode page. WCE tells the host it has to send SYNCHRONIZE CACHE, changeable values are none.
+            wce = 0x04 if self.storage.write_back and command.cdb[2] >> 6 != 1 else 0x00
+            pages = bytes([0x08, 0x12, wce]) + bytes(17)
+        if command.opcode == MODE_SENSE_6:
+            self.respond(command, bytes([3 + len(pages), 0, device_specific, 0]) + pages)
+        else:
+            self.respond(command, struct.pack('>HBB4x', 6 + len(pages), 0, device_specific) + pages)
+
+    def read_capacity_10(self, command):
+        last_lba = min(self.storage.block_count - 1, 0xFFFFFFFF)  # 0xFFFFFFFF tells the host to use READ CAPACITY(16)
+        command.data_in = struct.pack('>II', last_lba, self.storage.block_size)
+
+    def service_action_in_16(self, command):
+        if command.cdb[1] & 0x1F != READ_CAPACITY_16:
+            self.check_condition(command, ILLEGAL_REQUEST, 0x24, 0x00)
+            return
+        self.respond(command, struct.pack('>QI20x', self.storage.block_count - 1, self.storage.block_size))
+
+    def transfer_range(self, command):
+        if command.opcode in (READ_16, WRITE_16):
+            return struct.unpack_from('>QI', command.cdb, 2)
+        lba, = struct.unpack_from('>I', command.cdb, 2)
+        count, = struct.unpack_from('>H', command.cdb, 7)
+        return lba, count
+
+    def check_range(self, command, lba, count):
+        if lba + count > self.storage.block_count:
+            self.check_condition(command, ILLEGAL_REQUEST, 0x21, 0x00)  # Logical block address out of range
+            return False
+        return True
+
+    def read(self, command):
+        lba, count = self.transfer_range(command)
+        if self.check_range(command, lba, count):
+            command.lba = lba
+            if self.executor is not None:
+                self.start_io(command, self.executor.read(lba, count), data_in=True)
+            else:
+                command.data_in = self.storage.payload(lba, count)
+
+    def write(self, command):
+        lba, count = self.transfer_range(command)
+        if self.storage.read_only:
+            self.check_condition(command, DATA_PROTECT, 0x27, 0x00)  # Write protected
+        elif self.check_range(command, lba, count):
+            command.lba = lba
+            command.data_out_length = count * self.storage.block_size
+
+    def write_data(self, command, data):
+        '''
+        Stores the next chunk of a data-out phase
+        '''
+        block_size = self.storage.block_size
+        data = data[:command.data_out_length - command.data_out_received]
+        command.data_out_received += len(data)
+        if command.partial is not None or len(data) % block_size:
+            # Hosts normally send whole blocks, but keep unaligned chunks until a block is complete
+            buffer = (command.partial or bytearray()) + data
+            aligned = len(buffer)
+            if command.data_out_received < command.data_out_length:
+                aligned -= aligned % block_size
+            data = memoryview(buffer)[:aligned]
+            command.partial = buffer[aligned:] if aligned < len(buffer) else None
+        if data:
+            lba = command.lba + command.data_out_written // block_size
+            if self.executor is not None:
+                # The transfer buffer is reused once the URB is answered, the executor gets a copy
+                self.start_io(command, self.executor.write(lba, bytes(data)))
+            else:
+                self.storage.write(lba, data)
+            command.data_out_written += len(data)
+
+    def synchronize_cache(self, command):
+        if self.executor is not None:
+            self.start_io(command, self.executor.flush())
+        else:
+            self.storage.flush()
@@ -0,0 +1,550 @@
+import logging
+import mmap
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+from USBIP import FileRegion
+
+
+log = logging.getLogger('usbip.storage')
+
+# Reads at least this long are sent from the image file with sendfile, when the storage allows it.
+# Shorter ones are cheaper to batch into one sendmsg with the replies around them.
+SENDFILE_MIN_LENGTH = 64 * 1024
+
+
+class BlockStorage(ABC):
+    '''
+    Abstract Base Class for the block devices behind an emulated drive
+    '''
+    block_size = 512
+    read_only = False
+    mapped = False  # reads return views of the page cache, see prefetch
+    write_back = False  # writes may sit in a volatile cache until flush
+
+    @property
+    @abstractmethod
+    def block_count(self): pass
+
+    @abstractmethod
+    def read(self, lba, count):
+        '''
+        Returns `count` blocks starting at `lba` as a bytes-like object
+        '''
+        pass
+
+    def read_region(self, lba, count):
+        '''
+        Returns `count` blocks starting at `lba` as a FileRegion the server can sendfile, or None if
+        the blocks are not stored as is in a file
+        '''
+        return None
+
+    def payload(self, lba, count):
+        '''
+        What a READ of these blocks sends: a FileRegion for long reads when possible, else read()
+        '''
+        if count * self.block_size >= SENDFILE_MIN_LENGTH:
+            region = self.read_region(lba, count)
+            if region is not None:
+                return region
+        return self.read(lba, count)
+
+    def prefetch(self, lba, count):
+        '''
+        Mapped storage: starts reading these blocks into the page cache
+        '''
+        pass
+
+    def fault_in(self, lba, count):
+        '''
+        Mapped storage: waits until these blocks are in the page cache
+        '''
+        pass
+
+    @abstractmethod
+    def write(self, lba, data):
+        pass
+
+    def flush(self):
+        pass
+
+    def snapshot(self):
+        '''
+        Counters and gauges for the metrics, see metrics.STORAGE_METRICS
+        '''
+        return {}
+
+    def close(self):
+        pass
+
+
+class MmapDiskImage(BlockStorage):
+    '''
+    Raw disk image mapped into memory. Reads return memoryview slices of the mapping, so
+    sector data comes straight from the page cache without being copied. With `sendfile`, large
+    reads are served as file regions instead, which the kernel sends without mapping them.
+    '''
+
+    mapped = True
+
+    def __init__(self, path, size=None, block_size=512, read_only=False, sendfile=True):
+        self.path = path
+        self.block_size = block_size
+        self.read_only = read_only
+        self.sendfile = sendfile and hasattr(os, 'sendfile')
+        if size is not None and not os.path.exists(path):
+            with open(path, 'wb') as image:
+                image.truncate(size)  # Sparse, blocks are only allocated once written
+        self.file = open(path, 'rb' if read_only else 'r+b')
+        self.mapping = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ if read_only else mmap.ACCESS_WRITE)
+        self.view = memoryview(self.mapping)
+        self._block_count = len(self.mapping) // block_size
+
+    @property
+    def block_count(self):
+        return self._block_count
+
+    def read(self, lba, count):
+        return self.view[lba * self.block_size:(lba + count) * self.block_size]
+
+    def read_region(self, lba, count):
+        if not self.sendfile:
+            return None
+        # The mapping is shared, so sendfile sees what was written through it
+        return FileRegion(self.file.fileno(), lba * self.block_size, count * self.block_size)
+
+    def prefetch(self, lba, count):
+        offset = lba * self.block_size
+        start = offset - offset % mmap.PAGESIZE
+        length = min((lba + count) * self.block_size, len(self.mapping)) - start
+        if length > 0:
+            self.mapping.madvise(mmap.MADV_WILLNEED, start, length)
+
+    def fault_in(self, lba, count):
+        self.prefetch(lba, count)
+        offset = lba * self.block_size
+        end = min((lba + count) * self.block_size, len(self.mapping))
+        fd = self.file.fileno()
+        for page in range(offset - offset % mmap.PAGESIZE, end, mmap.PAGESIZE):
+            # pread waits for the page without the GIL, a fault on the mapping would hold it
+            os.pread(fd, 1, page)
+
+    def write(self, lba, data):
+        offset = lba * self.block_size
+        self.view[offset:offset + len(data)] = data
+
+    def flush(self):
+        if not self.read_only:
+            self.mapping.flush()
+
+    def close(self):
+        self.flush()
+        self.view.release()
+        try:
+            self.mapping.close()
+        except BufferError:
+            pass  # A read is still being sent, the mapping goes away with its last view
+        self.file.close()
+
+
+# BlockCache flush policies
+WRITE_THROUGH = 'write-through'
+PERIODIC = 'periodic'
+ON_SYNC = 'sync'
+FLUSH_POLICIES = (WRITE_THROUGH, PERIODIC, ON_SYNC)
+
+
+def dirty_runs(bitmap):
+    # (first block, block count) of each run of set bits
+    while bitmap:
+        first = (bitmap & -bitmap).bit_length() - 1
+        clear = ~(bitmap >> first)
+        count = (clear & -clear).bit_length() - 1
+        yield first, count
+        bitmap &= ~(((1 << count) - 1) << first)
+
+
+class BlockCache(BlockStorage):
+    '''
+    Caches another BlockStorage in extents of `extent_blocks`, dropping the least recently used once
+    they take more than `max_bytes`. Every extent has a bitmap of its dirty blocks, written back in
+    runs with the runs of adjacent extents merged into one write. `policy` decides when:
+    write-through writes every block right away, periodic about `interval` seconds after a block
+    is dirtied, sync on flush (SYNCHRONIZE CACHE) only. Eviction writes back in every policy. A
+    failed write-back leaves its blocks dirty and fails the write or flush that caused it. Writes
+    to an extent that is not cached do not read it, its other blocks are read once needed.
+    '''
+
+    def __init__(self, storage, policy=ON_SYNC, extent_blocks=128, max_bytes=64 * 1024 * 1024, interval=1.0):
+        if policy not in FLUSH_POLICIES:
+            raise ValueError(f'unknown flush policy {policy}')
+        self.storage = storage
+        self.policy = policy
+        self.write_back = policy != WRITE_THROUGH
+        self.block_size = storage.block_size
+        self.read_only = storage.read_only
+        self.extent_blocks = extent_blocks
+        self.max_extents = max(1, max_bytes // (extent_blocks * storage.block_size))
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.dirtied = threading.Condition(self.lock)
+        self.extents = OrderedDict()  # extent index -> bytearray, least recently used first
+        self.dirty = {}  # extent index -> bitmap of dirty blocks, bit 0 is the extent's first block
+        self.valid = {}  # extent index -> bitmap of the blocks read or written, for partly filled extents
+        self.flusher = None  # thread of the periodic policy, started by the first dirty block
+        self.closed = False
+        self.counters = dict(hits=0, misses=0, evictions=0, write_backs=0, flushes=0)
+
+    @property
+    def block_count(self):
+        return self.storage.block_count
+
+    def pieces(self, lba, count):
+        # (extent index, first block in the extent, block count, blocks before it) covering the range
+        done = 0
+        while done < count:
+            index, first = divmod(lba + done, self.extent_blocks)
+            blocks = min(self.extent_blocks - first, count - done)
+            yield index, first, blocks, done
+            done += blocks
+
+    def extent_length(self, index):
+        return min(self.extent_blocks, self.block_count - index * self.extent_blocks)
+
+    def extent(self, index, first, blocks):
+        # The cached extent with blocks first..first + blocks valid, read from the storage on a
+        # miss. Called with the lock held.
+        data = self.extents.get(index)
+        if data is None:
+            self.counters['misses'] += 1
+            data = bytearray(self.storage.read(index * self.extent_blocks, self.extent_length(index)))
+            self.insert(index, data)
+            return data
+        self.extents.move_to_end(index)
+        missing = ~self.valid.get(index, -1) & (((1 << blocks) - 1) << first)
+        if not missing:
+            self.counters['hits'] += 1
+            return data
+        self.counters['misses'] += 1
+        base = index * self.extent_blocks
+        block_size = self.block_size
+        for start, count in dirty_runs(missing):
+            data[start * block_size:(start + count) * block_size] = self.storage.read(base + start, count)
+        self.validate(index, missing)
+        return data
+
+    def validate(self, index, bitmap):
+        valid = self.valid[index] | bitmap
+        if valid == (1 << self.extent_length(index)) - 1:
+            del self.valid[index]
+        else:
+            self.valid[index] = valid
+
+    def insert(self, index, data):
+        self.extents[index] = data
+        while len(self.extents) > self.max_extents:
+            evicted = next(iter(self.extents))
+            if evicted in self.dirty:
+                self.write_back_extents(self.dirty_neighbours(evicted))
+            del self.extents[evicted]
+            self.valid.pop(evicted, None)
+            self.counters['evictions'] += 1
+
+    def read(self, lba, count):
+        block_size = self.block_size
+        result = bytearray(count * block_size)
+        with self.lock:
+            for index, first, blocks, done in self.pieces(lba, count):
+                result[done * block_size:(done + blocks) * block_size] = \
+                    self.extent(index, first, blocks)[first * block_size:(first + blocks) * block_size]
+        return result
+
+    def read_region(self, lba, count):
+        with self.lock:
+            if any(index in self.dirty for index, _, _, _ in self.pieces(lba, count)):
+                return None  # The storage has older data
+        return self.storage.read_region(lba, count)
+
+    def write(self, lba, data):
+        block_size = self.block_size
+        data = memoryview(data)
+        with self.lock:
+            for index, first, blocks, done in self.pieces(lba, len(data) // block_size):
+                piece = data[done * block_size:(done + blocks) * block_size]
+                written = ((1 << blocks) - 1) << first
+                extent = self.extents.get(index)
+                if extent is None:
+                    # Nothing to read, the rest of the extent is read when it is needed
+                    self.counters['misses'] += 1
+                    extent = bytearray(self.extent_length(index) * block_size)
+                    if blocks < self.extent_length(index):
+                        self.valid[index] = 0
+                    self.insert(index, extent)
+                else:
+                    self.counters['hits'] += 1
+                    self.extents.move_to_end(index)
+                if index in self.valid:
+                    self.validate(index, written)
+                extent[first * block_size:(first + blocks) * block_size] = piece
+                if self.write_back:
+                    self.dirty[index] = self.dirty.get(index, 0) | written
+            if not self.write_back:
+                self.storage.write(lba, data)
+                self.counters['write_backs'] += 1
+            elif self.policy == PERIODIC:
+                if self.flusher is None:
+                    self.flusher = threading.Thread(target=self.flush_periodically, name='block-cache', daemon=True)
+                    self.flusher.start()
+                self.dirtied.notify()
+
+    def dirty_neighbours(self, index):
+        # Dirty extents adjacent to `index`, which their runs may continue
+        first = last = index
+        while first - 1 in self.dirty:
+            first -= 1
+        while last + 1 in self.dirty:
+            last += 1
+        return range(first, last + 1)
+
+    def write_back_extents(self, indexes):
+        # Writes the dirty runs of the extents, in order of index, merging runs that touch
+        block_size = self.block_size
+        bitmaps = {index: self.dirty.pop(index) for index in indexes}
+        try:
+            start = end = None
+            pieces = []
+            for index, bitmap in bitmaps.items():
+                base = index * self.extent_blocks
+                view = memoryview(self.extents[index])
+                for first, count in dirty_runs(bitmap):
+                    if base + first != end and pieces:
+                        self.write_run(start, pieces)
+                        pieces = []
+                    if not pieces:
+                        start = base + first
+                    pieces.append(view[first * block_size:(first + count) * block_size])
+                    end = base + first + count
+            if pieces:
+                self.write_run(start, pieces)
+        except OSError:
+            for index, bitmap in bitmaps.items():
+                self.dirty[index] = self.dirty.get(index, 0) | bitmap
+            raise
+
+    def write_run(self, lba, pieces):
+        self.storage.write(lba, pieces[0] if len(pieces) == 1 else b''.join(pieces))
+        self.counters['write_backs'] += 1
+
+    def flush(self):
+        with self.lock:
+            self.write_back_extents(sorted(self.dirty))
+            self.counters['flushes'] += 1
+        self.storage.flush()
+
+    def flush_periodically(self):
+        while 1:
+            with self.lock:
+                while not self.dirty and not self.closed:
+                    self.dirtied.wait()
+                if self.closed:
+                    return
+            time.sleep(self.interval)  # Writes coming meanwhile go out with this flush
+            try:
+                self.flush()
+            except OSError:
+                log.exception('periodic write-back failed, the blocks stay dirty')
+
+    def snapshot(self):
+        with self.lock:
+            dirty_blocks = sum(bitmap.bit_count() for bitmap in self.dirty.values())
+            return dict(self.storage.snapshot(), **self.counters,
+                        cached_bytes=sum(len(data) for data in self.extents.values()),
+                        dirty_bytes=dirty_blocks * self.block_size)
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.closed = True
+            self.dirtied.notify()
+        self.storage.close()
+
+
+def completed(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+class StorageExecutor:
+    '''
+    Runs the reads and writes of a BlockStorage on a pool of `threads`, so waiting for the disk holds
+    up the command that needs it and not the connection. Reads that continue the previous one are
+    a sequential stream: the extents after it are prefetched, up to `max_readahead` of them. Mapped
+    storage prefetches into the page cache, and each read waits on the pool for its own pages. Other
+    storage reads the extents into a buffer cache of at most `cache_bytes`, each extent dropped once
+    it is read.
+    '''
+
+    def __init__(self, storage, threads=4, cache_bytes=32 * 1024 * 1024, max_readahead=8):
+        self.storage = storage
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix='storage')
+        self.cache_bytes = cache_bytes
+        self.max_readahead = max_readahead
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()  # lba -> (count, data) of prefetched extents, oldest first
+        self.cached_bytes = 0
+        self.inflight = {}  # lba -> (count, future) of prefetches still reading
+        self.inflight_bytes = 0
+        self.next_lba = None  # where a sequential stream continues
+        self.streak = 0
+        self.writes = {}  # future -> (lba, end) of writes not done yet, no prefetch overlaps them
+        self.hits = 0  # reads served from prefetched extents
+
+    def sequential(self, lba, count):
+        # Number of extents to keep prefetched ahead of this read, growing with the stream
+        with self.lock:
+            self.streak = min(self.streak + 1, self.max_readahead) if lba == self.next_lba else 0
+            self.next_lba = lba + count
+            return self.streak if count else 0
+
+    def read(self, lba, count):
+        '''
+        Returns a Future of the payload of `count` blocks starting at `lba`
+        '''
+        window = self.sequential(lba, count)
+        if self.storage.mapped:
+            if window:
+                self.pool.submit(self.storage.prefetch, lba + count, window * count)
+            return self.pool.submit(self.load_mapped, lba, count)
+        with self.lock:
+            future = self.take(lba, count)
+        if future is None:
+            future = self.pool.submit(self.load, lba, count)
+        for extent in range(1, window + 1):
+            self.prefetch_extent(lba + extent * count, count)
+        return future
+
+    def load(self, lba, count):
+        return bytes(self.storage.read(lba, count))
+
+    def load_mapped(self, lba, count):
+        # In the page cache before the payload is sent, so the connection does not fault on the disk
+        self.storage.fault_in(lba, count)
+        return self.storage.payload(lba, count)
+
+    def take(self, lba, count):
+        # A prefetched or still prefetching extent starting at `lba`, sliced to `count` blocks
+        length = count * self.storage.block_size
+        entry = self.cache.pop(lba, None)
+        if entry is not None:
+            self.cached_bytes -= len(entry[1])
+            if entry[0] >= count:
+                self.hits += 1
+                return completed(memoryview(entry[1])[:length])
+        entry = self.inflight.pop(lba, None)
+        if entry is None:
+            return None
+        self.inflight_bytes -= entry[0] * self.storage.block_size
+        if entry[0] < count:
+            return None
+        self.hits += 1
+        future = Future()
+
+        def loaded(prefetch):
+            if prefetch.exception() is not None:
+                future.set_exception(prefetch.exception())
+            else:
+                future.set_result(memoryview(prefetch.result())[:length])
+        entry[1].add_done_callback(loaded)
+        return future
+
+    def writing(self, lba, count):
+        # Whether a write still in progress overlaps the blocks. Called with the lock held.
+        return any(start < lba + count and lba < end for start, end in self.writes.values())
+
+    def prefetch_extent(self, lba, count):
+        length = count * self.storage.block_size
+        with self.lock:
+            if lba + count > self.storage.block_count or lba in self.cache or lba in self.inflight:
+                return
+            if self.cached_bytes + self.inflight_bytes + length > self.cache_bytes:
+                return
+            if self.writing(lba, count):
+                return  # It would read the blocks from before the write
+            future = self.pool.submit(self.load, lba, count)
+            self.inflight[lba] = (count, future)
+            self.inflight_bytes += length
+        future.add_done_callback(lambda future: self.prefetched(lba, count, future))
+
+    def prefetched(self, lba, count, future):
+        with self.lock:
+            entry = self.inflight.get(lba)
+            if entry is None or entry[1] is not future:
+                return  # Already handed to a read, or dropped by a write
+            del self.inflight[lba]
+            self.inflight_bytes -= count * self.storage.block_size
+            if future.exception() is not None or self.writing(lba, count):
+                return
+            data = future.result()
+            self.cache[lba] = (count, data)
+            self.cached_bytes += len(data)
+            while self.cached_bytes > self.cache_bytes:
+                _, (_, evicted) = self.cache.popitem(last=False)
+                self.cached_bytes -= len(evicted)
+
+    def write(self, lba, data):
+        '''
+        Returns a Future of the write of `data`, which must not change until it is done
+        '''
+        end = lba + len(data) // self.storage.block_size
+        with self.lock:
+            for cached_lba, (count, cached) in list(self.cache.items()):
+                if cached_lba < end and lba < cached_lba + count:
+                    del self.cache[cached_lba]
+                    self.cached_bytes -= len(cached)
+            for inflight_lba, (count, _) in list(self.inflight.items()):
+                if inflight_lba < end and lba < inflight_lba + count:
+                    del self.inflight[inflight_lba]
+                    self.inflight_bytes -= count * self.storage.block_size
+            future = self.pool.submit(self.storage.write, lba, data)
+            self.writes[future] = (lba, end)
+        future.add_done_callback(self.written)
+        return future
+
+    def written(self, future):
+        with self.lock:
+            self.writes.pop(future, None)
+
+    def flush(self):
+        '''
+        Returns a Future of flushing the storage once every write issued so far is done
+        '''
+        with self.lock:
+            writes = list(self.writes)
+        # The writes were queued before this task, so they are running or done by the time it waits
+        return self.pool.submit(self.flush_after, writes)
+
+    def flush_after(self, writes):
+        wait(writes)
+        for future in writes:
+            future.result()  # A failed write fails the flush too
+        self.storage.flush()
+
+    def close(self):
+        self.pool.shutdown()
+
+
+def parse_size(text):
+    '''
+    Parses sizes like 512, 64M, 500G or 2T (binary units)
+    '''
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
@@ -0,0 +1,138 @@
+import socket
+import struct
+
+from USBIP import (USBIPHeader, USBInterface, OP_REP_DevList, OP_REP_DevListDevice, OP_REP_Import, USBIP_CMD_Submit,
+                   USBIP_RET_Submit, USBIP_CMD_Unlink, USBIP_RET_Unlink, USBIPReader, IsoPacketDescriptors, sendmsg_all,
+                   USBIP_DIR_IN, USBIP_DIR_OUT, USBIP_CMD_SUBMIT, USBIP_CMD_UNLINK, USBIP_RET_SUBMIT, URB_ISO_ASAP)
+
+
+class USBIPClient:
+    '''
+    Userspace stand-in for `usbip attach` and vhci-hcd, enough to drive a USBContainer over TCP without
+    root. URBs can be pipelined with submit and receive, or sent one at a time with transfer.
+    '''
+
+    def __init__(self, host='127.0.0.1', port=3240):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = USBIPReader(self.sock)
+        self.devid = None
+        self.seqnum = 0
+        self.in_flight = {}  # seqnum -> direction, RET_SUBMIT does not carry it
+        self.completed = {}  # completions received while waiting for another URB
+        self.iso_completed = {}  # seqnum -> (IsoPacketDescriptors, start_frame) of completed isochronous URBs
+        self.cmd = USBIP_CMD_Submit(command=USBIP_CMD_SUBMIT, transfer_flags=0, start_frame=0, number_of_packets=0,
+                                    interval=0)
+        self.ret = USBIP_RET_Submit()
+
+    def read(self, size):
+        data = self.reader.read_exactly(size)
+        if data is None:
+            raise ConnectionResetError('server closed the connection')
+        return data
+
+    def device_list(self):
+        '''
+        Returns the exported devices as OP_REP_DevListDevice objects, each with an `interfaces` list
+        '''
+        self.sock.sendall(USBIPHeader(command=0x8005, status=0).pack())
+        reply = OP_REP_DevList(base=USBIPHeader())
+        reply.unpack(self.read(reply.size()))
+        devices = []
+        for _ in range(reply.nExportedDevice):
+            device = OP_REP_DevListDevice()
+            device.unpack(self.read(device.size()))
+            device.interfaces = []
+            for _ in range(device.bNumInterfaces):
+                interface = USBInterface()
+                interface.unpack(self.read(interface.size()))
+                device.interfaces.append(interface)
+            devices.append(device)
+        return devices
+
+    def import_device(self, busid):
+        self.sock.sendall(USBIPHeader(command=0x8003, status=0).pack() + busid.encode('ascii').ljust(32, b'\0'))
+        header = USBIPHeader()
+        data = bytes(self.read(header.size()))
+        header.unpack(data)
+        if header.status != 0:
+            raise ConnectionRefusedError(f'import of {busid} failed')
+        reply = OP_REP_Import(base=USBIPHeader())
+        reply.unpack(data + bytes(self.read(reply.size() - header.size())))
+        self.devid = (reply.busnum << 16) | reply.devnum
+        return reply
+
+    def submit(self, ep, direction, length, setup=b'', data=b'', iso_packets=None, interval=0):
+        '''
+        Sends a USBIP_CMD_SUBMIT and returns its seqnum. Isochronous URBs pass their IsoPacketDescriptors.
+        '''
+        self.seqnum += 1
+        cmd = self.cmd
+        cmd.init_from_dict(seqnum=self.seqnum, devid=self.devid, direction=direction, ep=ep,
+                           transfer_buffer_length=len(data) if direction == USBIP_DIR_OUT else length,
+                           setup=setup, interval=interval,
+                           transfer_flags=URB_ISO_ASAP if iso_packets is not None else 0,
+                           number_of_packets=iso_packets.count if iso_packets is not None else 0)
+        self.in_flight[self.seqnum] = direction
+        if iso_packets is None:
+            sendmsg_all(self.sock, (cmd.pack(), data))
+        else:
+            sendmsg_all(self.sock, (cmd.pack(), data, iso_packets.to_bytes()))
+        return self.seqnum
+
+    def receive(self):
+        '''
+        Waits for the next reply. Returns (seqnum, status, data), data is None for a RET_UNLINK.
+        '''
+        header = self.read(self.ret.size())
+        if struct.unpack_from('>I', header)[0] != USBIP_RET_SUBMIT:
+            unlink = USBIP_RET_Unlink()
+            unlink.unpack(header)
+            return unlink.seqnum, unlink.status, None
+        ret = self.ret
+        ret.unpack(header)
+        direction = self.in_flight.pop(ret.seqnum, USBIP_DIR_OUT)
+        data = bytes(self.read(ret.actual_length)) if direction == USBIP_DIR_IN and ret.actual_length else b''
+        if 0 < ret.number_of_packets < 0xffffffff:
+            iso_packets = IsoPacketDescriptors.from_bytes(self.read(ret.number_of_packets * IsoPacketDescriptors.descriptor_size))
+            self.iso_completed[ret.seqnum] = (iso_packets, ret.start_frame)
+        return ret.seqnum, ret.status, data
+
+    def wait(self, seqnum):
+        '''
+        Returns (status, data) of a submitted URB, keeping the completions of others for later
+        '''
+        while seqnum not in self.completed:
+            completed, status, data = self.receive()
+            self.completed[completed] = (status, data)
+        return self.completed.pop(seqnum)
+
+    def transfer(self, ep, direction, length=0, setup=b'', data=b''):
+        return self.wait(self.submit(ep, direction, length, setup, data))
+
+    def iso_transfer(self, ep, direction, lengths, data=b'', interval=1):
+        '''
+        Isochronous URB with packets of `lengths` bytes. Returns (status, data, IsoPacketDescriptors, start_frame),
+        IN data holds the packets back to back, without padding.
+        '''
+        iso_packets = IsoPacketDescriptors.from_lengths(lengths)
+        seqnum = self.submit(ep, direction, sum(lengths), data=data, iso_packets=iso_packets, interval=interval)
+        status, data = self.wait(seqnum)
+        return (status, data) + self.iso_completed.pop(seqnum)
+
+    def control(self, bmRequestType, bRequest, wValue=0, wIndex=0, wLength=0, data=b''):
+        setup = struct.pack('<BBHHH', bmRequestType, bRequest, wValue, wIndex, wLength or len(data))
+        direction = USBIP_DIR_IN if bmRequestType & 0x80 else USBIP_DIR_OUT
+        return self.transfer(0, direction, wLength, setup, data)
+
+    def get_descriptor(self, descriptor_type, index=0, language=0, length=255):
+        return self.control(0x80, 0x06, (descriptor_type << 8) | index, language, length)
+
+    def unlink(self, seqnum):
+        self.seqnum += 1
+        self.sock.sendall(USBIP_CMD_Unlink(command=USBIP_CMD_UNLINK, seqnum=self.seqnum, devid=self.devid,
+                                           direction=0, ep=0, unlink_seqnum=seqnum, padding=b'').pack())
+        return self.seqnum
+
+    def close(self):
+        self.sock.close()
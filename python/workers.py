@@ -0,0 +1,215 @@
+import asyncio
+import logging
+import os
+import pickle
+import selectors
+import signal
+import socket
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import collect, merge, serve_metrics
+
+
+log = logging.getLogger('usbip.workers')
+
+MAX_HANDOFF_MESSAGE = 4096  # bus id and whatever the first worker had read past the OP_REQ_IMPORT
+
+
+def send_message(sock, data):
+    sock.sendall(struct.pack('>I', len(data)) + data)
+
+
+def receive_message(sock):
+    # Length-prefixed message, or None once the peer is gone
+    header = b''
+    while len(header) < 4:
+        chunk = sock.recv(4 - len(header))
+        if not chunk:
+            return None
+        header += chunk
+    length, = struct.unpack('>I', header)
+    data = bytearray()
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            return None
+        data.extend(chunk)
+    return bytes(data)
+
+
+def interrupt(*_):
+    raise KeyboardInterrupt
+
+
+class Worker:
+    '''
+    Supervisor side of a worker process
+    '''
+
+    def __init__(self, index, pid, handoff, metrics):
+        self.index = index
+        self.pid = pid
+        self.handoff = handoff  # SOCK_SEQPACKET, client sockets travel over it as SCM_RIGHTS
+        self.metrics = metrics  # SOCK_STREAM, metrics requests and pickled snapshots
+        self.metrics_lock = threading.Lock()
+
+
+class Supervisor:
+    '''
+    Forks worker processes that all accept USB/IP connections on the same port with SO_REUSEPORT
+    and serve them on their own asyncio event loop. Devices are sharded round robin by bus id.
+    Every worker answers device lists for all devices, but a worker receiving an import for a
+    device it does not own passes the client socket to the owner, relayed by the supervisor. The
+    supervisor serves the merged metrics of all workers.
+
+    Devices are created before forking, so each worker has a copy of all of them and only uses
+    its own shard. Memory-mapped images are shared with the workers, not copied.
+    '''
+
+    def __init__(self, container, workers):
+        self.container = container
+        self.worker_count = workers
+        self.workers = []
+        self.stopping = False
+
+    def run(self, ip='0.0.0.0', port=3240, metrics_port=None):
+        container = self.container
+        container.shard_owner = {usb_dev.busid: index % self.worker_count
+                                 for index, usb_dev in enumerate(container.usb_devices)}
+        for index in range(self.worker_count):
+            handoff, worker_handoff = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            metrics, worker_metrics = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+            pid = os.fork()
+            if pid == 0:
+                for worker in self.workers:  # Inherited ends of the other workers' channels
+                    worker.handoff.close()
+                    worker.metrics.close()
+                handoff.close()
+                metrics.close()
+                self.run_worker(index, worker_handoff, worker_metrics, ip, port)
+            worker_handoff.close()
+            worker_metrics.close()
+            self.workers.append(Worker(index, pid, handoff, metrics))
+            log.info('worker %d (pid %d) owns %s', index, pid,
+                     ', '.join(busid for busid, owner in container.shard_owner.items() if owner == index))
+
+        if metrics_port:
+            serve_metrics(container, metrics_port, collect_snapshot=self.collect)
+        signal.signal(signal.SIGTERM, self.stop)
+        try:
+            self.relay()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self, *_):
+        if self.stopping:
+            return
+        self.stopping = True
+        for worker in self.workers:
+            try:
+                os.kill(worker.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for worker in self.workers:
+            os.waitpid(worker.pid, 0)
+        raise SystemExit(0)
+
+    def relay(self):
+        # Forwards handed-off client sockets to the worker owning the requested bus id
+        selector = selectors.DefaultSelector()
+        for worker in self.workers:
+            selector.register(worker.handoff, selectors.EVENT_READ, worker)
+        while selector.get_map():
+            for key, _ in selector.select():
+                message, fds, _, _ = socket.recv_fds(key.fileobj, MAX_HANDOFF_MESSAGE, 1)
+                if not message:
+                    log.error('worker %d exited', key.data.index)
+                    selector.unregister(key.fileobj)
+                    continue
+                try:
+                    busid = message.split(b'\0', 1)[0].decode('ascii')
+                    owner = self.workers[self.container.shard_owner[busid]]
+                    socket.send_fds(owner.handoff, [message], fds)
+                except (KeyError, OSError):
+                    log.exception('could not hand over a connection')
+                finally:
+                    for fd in fds:
+                        os.close(fd)
+
+    def collect(self):
+        snapshots = []
+        for worker in self.workers:
+            with worker.metrics_lock:
+                try:
+                    send_message(worker.metrics, b'collect')
+                    data = receive_message(worker.metrics)
+                except OSError:
+                    data = None
+            if data is not None:
+                snapshots.append(pickle.loads(data))
+        return merge(snapshots)
+
+    def run_worker(self, index, handoff, metrics, ip, port):
+        status = 0
+        container = self.container
+        try:
+            signal.signal(signal.SIGTERM, interrupt)  # Stop like on Ctrl-C, so devices get flushed
+            container.worker_index = index
+
+            def hand_off(conn, busid, buffered):
+                socket.send_fds(handoff, [busid.encode('ascii') + b'\0' + buffered], [conn.fileno()])
+
+            container.handoff = hand_off
+            asyncio.run(self.serve_worker(handoff, metrics, ip, port))
+        except KeyboardInterrupt:
+            pass
+        except BaseException:
+            log.exception('worker %d failed', index)
+            status = 1
+        finally:
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)  # The SIGINT of a Ctrl-C is followed by the supervisor's SIGTERM
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            for usb_dev in container.usb_devices:
+                if container.owns(usb_dev.busid):
+                    try:
+                        usb_dev.flush()
+                    except Exception:
+                        log.exception('could not flush %s', usb_dev.busid)
+                        status = 1
+            os._exit(status)
+
+    async def serve_worker(self, handoff, metrics, ip, port):
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor()
+        sessions = set()
+
+        def adopt(conn, busid, buffered):
+            task = loop.create_task(self.container.serve_connection_async(conn, 'handoff', executor, busid, buffered))
+            sessions.add(task)
+            task.add_done_callback(sessions.discard)
+
+        def receive_handoffs():
+            while 1:
+                message, fds, _, _ = socket.recv_fds(handoff, MAX_HANDOFF_MESSAGE, 1)
+                if not message:
+                    os._exit(0)  # The supervisor is gone
+                busid, buffered = message.split(b'\0', 1)
+                conn = socket.socket(fileno=fds[0])
+                conn.setblocking(False)
+                loop.call_soon_threadsafe(adopt, conn, busid.decode('ascii'), buffered)
+
+        def answer_metrics():
+            while receive_message(metrics) is not None:
+                send_message(metrics, pickle.dumps(collect(self.container)))
+
+        threading.Thread(target=receive_handoffs, name='handoff', daemon=True).start()
+        threading.Thread(target=answer_metrics, name='metrics', daemon=True).start()
+        await self.container.serve(ip, port, executor, reuse_port=True)
+
+
+def run_workers(container, workers, ip='0.0.0.0', port=3240, metrics_port=None):
+    Supervisor(container, workers).run(ip, port, metrics_port)
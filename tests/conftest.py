@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# Device specs are compiled into a throwaway cache, not the user's ~/.cache. Set before device_spec is imported.
+device_cache = tempfile.TemporaryDirectory(prefix='usbip-devices-')
+os.environ['USBIP_DEVICE_CACHE'] = device_cache.name
+
+# The modules are flat files in python/, run from there
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'python'))
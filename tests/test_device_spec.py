@@ -0,0 +1,56 @@
+import importlib
+import json
+
+from device_spec import CompiledDevice, compile_spec, read_cache, spec_hash, spec_path, write_cache
+from samsung_T5_emulate import SamsungT5
+from storage import BlockStorage
+
+USBHID = importlib.import_module('hid-mouse').USBHID
+
+
+class ZeroStorage(BlockStorage):
+    block_count = 2048
+
+    def read(self, lba, count):
+        return bytes(count * self.block_size)
+
+    def write(self, lba, data):
+        pass
+
+
+def test_hid_mouse_descriptors_match_the_hand_written_ones():
+    table = USBHID().get_descriptor_table()
+    assert table[(0x01, 0, 0)] == bytes.fromhex('120110010000000806270000000000000001')
+    # But for bInterval, 10 ms instead of 255 since the timer wheel honours it
+    assert table[(0x02, 0, 0)] == bytes.fromhex('0902220001010080320904000001030102000921010000012234000705810308000a')
+
+
+def test_inquiry_serial_follows_the_serial_string_index():
+    with open(spec_path('samsung_T5.json')) as spec_file:
+        spec = json.load(spec_file)
+    # Serial number moved to the last string
+    spec['strings'] = spec['strings'][1:] + spec['strings'][:1]
+    for field in ('iManufacturer', 'iProduct', 'iSerialNumber'):
+        spec['device'][field] = (spec['device'][field] - 2) % len(spec['strings']) + 1
+
+    class ReorderedT5(SamsungT5):
+        compiled = CompiledDevice(compile_spec(spec), None)
+        device_strings = compiled.strings
+
+    t5 = ReorderedT5(storage=ZeroStorage(), capture_bytes=0, io_threads=0)
+    assert t5.disk.serial_number == '1234567B859B'
+
+
+def test_compiled_specs_are_cached_as_json(tmp_path):
+    with open(spec_path('samsung_T5.json')) as spec_file:
+        spec = json.load(spec_file)
+    key, compiled = spec_hash(spec), compile_spec(spec)
+    write_cache(str(tmp_path), key, compiled)
+    cache_file = tmp_path / f'{key}.json'
+    json.loads(cache_file.read_text())
+    cached, device = read_cache(str(tmp_path), key), CompiledDevice(compiled, key)
+    assert cached.raw_configuration == device.raw_configuration
+    assert cached.entries == device.entries and cached.strings == device.strings
+
+    cache_file.write_text('{"device": "12"}')
+    assert read_cache(str(tmp_path), key) is None  # Compiled again instead
@@ -0,0 +1,11 @@
+import importlib
+
+USBHID = importlib.import_module('hid-mouse').USBHID
+
+
+def test_reset_restarts_reports():
+    mouse = USBHID()
+    while mouse.random_report() is not None:
+        pass
+    mouse.reset()  # What a detach does
+    assert mouse.random_report() is not None
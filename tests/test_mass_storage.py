@@ -0,0 +1,111 @@
+import struct
+import threading
+import time
+from collections import deque
+from types import SimpleNamespace
+
+import scsi
+from mass_storage import CBW_SIGNATURE, IU_ID_COMMAND, IU_ID_SENSE, BulkOnlyTransport, CommandBlockWrapper, UASTransport
+from scsi import SCSIDisk
+from storage import StorageExecutor
+from USBIP import USBIP_DIR_IN, USBIP_DIR_OUT
+from test_storage import MemoryStorage
+
+
+class Pipes:
+    '''
+    The parts of a USBDevice the transports use, keeping what was sent
+    '''
+
+    def __init__(self):
+        self.parked = {}
+        self.sent = []
+
+    def ack_out(self, usb_req):
+        pass
+
+    def park_urb(self, usb_req):
+        self.parked.setdefault(usb_req.ep, deque()).append(usb_req)
+
+    def pop_parked_urb(self, ep, direction=USBIP_DIR_IN):
+        parked = self.parked.get(ep)
+        return parked.popleft() if parked else None
+
+    def send_usb_ret(self, usb_req, usb_res, usb_len, status=0):
+        self.sent.append((usb_req.ep, bytes(usb_res)))
+
+
+class FailingStorage(MemoryStorage):
+    '''
+    The first write fails, the later ones wait for `release`
+    '''
+
+    def __init__(self, block_count):
+        super().__init__(block_count)
+        self.writes = 0
+        self.release.clear()
+
+    def write(self, lba, data):
+        self.writes += 1
+        if self.writes == 1:
+            raise OSError('bad block')
+        super().write(lba, data)
+
+
+def urb(ep, direction, data=b'', length=0):
+    return SimpleNamespace(ep=ep, direction=direction, transfer_buffer=data, transfer_buffer_length=length or len(data))
+
+
+def command_iu(tag, cdb):
+    return struct.pack('>BxHBxBx8x16s', IU_ID_COMMAND, tag, 0, 0, cdb)
+
+
+def test_uas_sense_belongs_to_its_command():
+    pipes = Pipes()
+    storage = FailingStorage(64)
+    executor = StorageExecutor(storage, threads=2)
+    disk = SCSIDisk(storage, executor=executor)
+    uas = UASTransport(pipes, disk)
+    try:
+        uas.handle_data(urb(4, USBIP_DIR_OUT, command_iu(1, struct.pack('>BBIBHB', 0x2A, 0, 0, 0, 2, 0))))
+        write = uas.commands[1].command
+        uas.handle_data(urb(2, USBIP_DIR_OUT, bytes(512)))  # Its first block fails
+        while write.pending:
+            time.sleep(0.001)
+        uas.handle_data(urb(2, USBIP_DIR_OUT, bytes(512)))  # The second one is held back
+        uas.handle_data(urb(4, USBIP_DIR_OUT, command_iu(2, bytes([0x55]) + bytes(5))))  # Fails meanwhile
+        storage.release.set()
+        while write.pending:
+            time.sleep(0.001)
+        for _ in range(4):
+            uas.handle_data(urb(3, USBIP_DIR_IN, length=64))
+    finally:
+        executor.close()
+    senses = {}
+    for ep, iu in pipes.sent:
+        if iu[0] == IU_ID_SENSE:
+            tag, status = struct.unpack_from('>HxxB', iu, 2)
+            senses[tag] = (status, iu[16 + 2], iu[16 + 12])
+    assert senses == {1: (scsi.CHECK_CONDITION, scsi.MEDIUM_ERROR, 0x0C),
+                      2: (scsi.CHECK_CONDITION, scsi.ILLEGAL_REQUEST, 0x20)}
+
+
+def test_bot_request_sense_reports_the_failed_command():
+    pipes = Pipes()
+    bot = BulkOnlyTransport(pipes, SCSIDisk(MemoryStorage(64)))
+
+    def command(tag, cdb, length):
+        cbw = CommandBlockWrapper(dCBWSignature=CBW_SIGNATURE, dCBWTag=tag, dCBWDataTransferLength=length,
+                                  bmCBWFlags=0x80, bCBWLUN=0, bCBWCBLength=len(cdb), CBWCB=cdb)
+        bot.handle_data(urb(2, USBIP_DIR_OUT, cbw.pack()))
+        for _ in range(2 if length else 1):
+            bot.handle_data(urb(1, USBIP_DIR_IN, length=512))
+
+    command(1, bytes([0x55]) + bytes(5), 0)
+    command(2, bytes([scsi.REQUEST_SENSE, 0, 0, 0, 18, 0]), 18)
+    command(3, bytes([scsi.REQUEST_SENSE, 0, 0, 0, 18, 0]), 18)
+    csws = [data for _, data in pipes.sent if len(data) == 13]
+    assert [csw[12] for csw in csws] == [1, 0, 0]  # Failed, then passed
+    sense = [data for _, data in pipes.sent if len(data) == 18]
+    assert (sense[0][2], sense[0][12]) == (scsi.ILLEGAL_REQUEST, 0x20)
+    assert sense[1][2] == scsi.NO_SENSE  # Reported once
@@ -0,0 +1,57 @@
+import importlib
+import os
+import socket
+import threading
+
+from USBIP import USBContainer
+from replay import ReplayDevice, Trace, TraceRecorder
+from usbip_client import USBIPClient
+
+USBHID = importlib.import_module('hid-mouse').USBHID
+
+
+def serve(usb_dev):
+    usb_container = USBContainer()
+    usb_container.add_usb_device(usb_dev)
+    listener = socket.create_server(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+
+    def accept():
+        while 1:
+            conn, _ = listener.accept()
+            threading.Thread(target=usb_container.serve_connection, args=(conn,), daemon=True).start()
+    threading.Thread(target=accept, daemon=True).start()
+    return port
+
+
+def connect(port):
+    client = USBIPClient('127.0.0.1', port)
+    client.sock.settimeout(5)
+    return client
+
+
+def test_record_then_replay(tmp_path):
+    path = os.path.join(tmp_path, 'mouse.trace')
+    mouse = USBHID()
+    mouse.recorder = TraceRecorder(path)
+    client = connect(serve(mouse))
+    client.import_device('1-1')
+    # Like a host enumerating: the configuration header first, then all of it
+    status, device = client.get_descriptor(0x01, length=18)
+    status, header = client.get_descriptor(0x02, length=9)
+    total_length = int.from_bytes(header[2:4], 'little')
+    status, configuration = client.get_descriptor(0x02, length=total_length)
+    assert status == 0 and len(configuration) == total_length > 9
+    client.close()
+    mouse.recorder.close()
+
+    replay = ReplayDevice(Trace(path))
+    client = connect(serve(replay))
+    devices = client.device_list()
+    assert len(devices) == 1
+    assert len(devices[0].interfaces) == devices[0].bNumInterfaces == 1
+    client.close()
+    client = connect(serve(replay))
+    client.import_device('1-1')
+    assert client.get_descriptor(0x01, length=18) == (0, device)
+    client.close()
@@ -0,0 +1,41 @@
+import os
+import signal
+import socket
+import struct
+import subprocess
+import sys
+
+import pytest
+
+from benchmark import BenchmarkResult, BulkOnlyClient, connect
+
+T5 = os.path.join(os.path.dirname(__file__), '..', 'python', 'samsung_T5_emulate.py')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.mark.parametrize('mode', [[], ['--asyncio']])
+def test_sigterm_writes_back_the_cache_and_the_capture(tmp_path, mode):
+    image, pcap = tmp_path / 't5.img', tmp_path / 't5.pcap'
+    port = free_port()
+    server = subprocess.Popen([sys.executable, T5, '--image', str(image), '--size', '1M', '--write-cache', 'sync',
+                               '--pcap', str(pcap), '--port', str(port), '-q'] + mode)
+    try:
+        client = connect(port)
+        client.import_device('1-1')
+        data = os.urandom(4096)
+        BulkOnlyClient(client).command(BenchmarkResult('write'), struct.pack('>BBIBHB', 0x2A, 0, 8, 0, 8, 0), data=data)
+        # Only in the cache, SYNCHRONIZE CACHE was not sent
+        server.send_signal(signal.SIGTERM)
+        assert server.wait(timeout=10) == 0
+        client.close()
+    finally:
+        server.kill()
+    with open(image, 'rb') as image_file:
+        image_file.seek(8 * 512)
+        assert image_file.read(len(data)) == data
+    assert pcap.stat().st_size > 0
@@ -0,0 +1,80 @@
+import threading
+
+from storage import BlockStorage, MmapDiskImage, StorageExecutor
+
+
+class MemoryStorage(BlockStorage):
+    '''
+    Not mapped, so the executor keeps its own readahead buffers. Writes wait for `release`.
+    '''
+
+    def __init__(self, block_count):
+        self.data = bytearray(block_count * self.block_size)
+        self.release = threading.Event()
+        self.release.set()
+
+    @property
+    def block_count(self):
+        return len(self.data) // self.block_size
+
+    def read(self, lba, count):
+        return bytes(self.data[lba * self.block_size:(lba + count) * self.block_size])
+
+    def write(self, lba, data):
+        self.release.wait()
+        self.data[lba * self.block_size:lba * self.block_size + len(data)] = data
+
+
+def test_readahead_skips_blocks_being_written():
+    storage = MemoryStorage(1024)
+    executor = StorageExecutor(storage, threads=4)
+    try:
+        storage.release.clear()
+        written = executor.write(24, b'\xAA' * 4096)
+        for lba in (0, 8, 16):  # Sequential, prefetches 24 onwards while the write is held back
+            executor.read(lba, 8).result()
+        storage.release.set()
+        written.result()
+        assert bytes(executor.read(24, 8).result()) == b'\xAA' * 4096
+    finally:
+        executor.close()
+
+
+def test_readahead_serves_sequential_reads():
+    storage = MemoryStorage(1024)
+    storage.data[:] = bytes(range(256)) * (len(storage.data) // 256)
+    executor = StorageExecutor(storage, threads=4)
+    try:
+        for lba in range(0, 256, 8):
+            assert bytes(executor.read(lba, 8).result()) == storage.read(lba, 8)
+        assert executor.hits
+    finally:
+        executor.close()
+
+
+class HeldImage(MmapDiskImage):
+    '''
+    Mapped image whose pages only arrive once `release` is set
+    '''
+
+    def __init__(self, path, size):
+        super().__init__(path, size)
+        self.release = threading.Event()
+
+    def fault_in(self, lba, count):
+        self.release.wait()
+        super().fault_in(lba, count)
+
+
+def test_mapped_reads_wait_for_the_disk_on_the_pool(tmp_path):
+    storage = HeldImage(str(tmp_path / 'disk.img'), 1024 * 512)
+    storage.write(16, b'\x55' * 4096)
+    executor = StorageExecutor(storage, threads=4)
+    try:
+        future = executor.read(16, 8)
+        assert not future.done()  # The caller is not held up by the disk
+        storage.release.set()
+        assert bytes(future.result()) == b'\x55' * 4096
+    finally:
+        executor.close()
+        storage.close()